@@ -11,16 +11,28 @@ import attr
 import collections
 import traceback
 import time
-import pandas
-import scipy.spatial as sc_spatial
-import scipy.interpolate as sc_interpolate
+import re
+import pickle
+import contextlib
 import atexit
+import multiprocessing
+import concurrent.futures as cf
 
 src_path = os.path.dirname(os.path.abspath(__file__))
 
-from bgem.gmsh import gmsh_io
-from bgem.polygons import polygons
+# Heavy modules (bgem, scipy, matplotlib) and the modules depending on them
+# are imported where they are used, samples not using them do not pay for the imports.
+import checkpoint
 import fracture
+import gmsh_stream
+import mesh_cache
+import profiling
+import sample_summary
+import task_graph
+import tensor_store
+
+# Matplotlib is not thread safe, effective tensors may be plotted from concurrent sample tasks.
+_plot_lock = threading.Lock()
 
 
 def in_file(base):
@@ -56,43 +68,174 @@ def substitute_placeholders(file_in, file_out, params):
 
 
 
+class CoreBudget:
+    """
+    Counting semaphore for the cores reserved by the sample.
+    Concurrent Flow123d runs take the cores for their MPI processes from the budget,
+    so a sample never uses more cores then it has reserved.
+    """
+    def __init__(self, n_cores):
+        self.n_cores = n_cores
+        self._free = n_cores
+        self._cond = threading.Condition()
+
+    def acquire(self, n):
+        n = min(n, self.n_cores)
+        with self._cond:
+            self._cond.wait_for(lambda: self._free >= n)
+            self._free -= n
+        return n
+
+    def release(self, n):
+        with self._cond:
+            self._free += n
+            self._cond.notify_all()
+
+
+# Linear solver settings used if the config has no `solver_policy`, the original template values.
+default_solver = dict(r_tol=1.0e-6, a_tol=1.0e-10, options="")
+
+
+def choose_solver(config_dict, n_elements, contrast):
+    """
+    Linear solver settings from the `solver_policy` table of the config.
+    The first rule with n_elements <= max_elements and contrast <= max_contrast is used,
+    missing limits match anything, missing settings are taken from `default_solver`.
+    :param n_elements: Number of mesh elements.
+    :param contrast: Ratio of the maximal and the minimal conductivity (times cross-section).
+    :return: dict(r_tol, a_tol, options)
+    """
+    for rule in config_dict.get('solver_policy') or []:
+        if n_elements <= float(rule.get('max_elements', np.inf)) and contrast <= float(rule.get('max_contrast', np.inf)):
+            return {key: rule.get(key, value) for key, value in default_solver.items()}
+    return dict(default_solver)
+
+
+# Thread counts of the numerical libraries, one thread per MPI process.
+_single_thread_env = dict(OMP_NUM_THREADS="1", OPENBLAS_NUM_THREADS="1", MKL_NUM_THREADS="1")
+
+
 class FlowThread(threading.Thread):
 
 
-    def __init__(self, basename, outer_regions, config_dict):
+    def __init__(self, basename, outer_regions, config_dict, output_fields, result_file, out_dir=None, load=None,
+                 n_processes=1, core_budget=None, solver=None, stages=None, stage_key=None):
+        """
+        :param basename: Basename of the flow problem (mesh and fields files).
+        :param out_dir: Output directory and basename of the run files, `basename` by default.
+        :param load: Optional single pressure gradient [px, py] to solve,
+            otherwise `n_pressure_loads` directions are solved as pseudo time steps.
+        :param n_processes: Number of MPI processes, Flow123d is started by the `flow_mpi.command` if greater then 1.
+        :param core_budget: Optional CoreBudget to take the cores from.
+        :param solver: Linear solver settings dict(r_tol, a_tol, options), see `choose_solver`.
+        :param stages: Optional checkpoint.StageMarkers, the run is the stage 'flow_<out_dir>' with the key `stage_key`.
+            Without markers an existing result file is accepted.
+        """
         self.base = basename
+        # run statistics for the sample summary, see `run`
+        self.stats = {}
+        self.stages = stages
+        self.stage_key = stage_key
+        self.solver = dict(default_solver) if solver is None else solver
+        self.n_processes = n_processes
+        self.core_budget = core_budget
+        # MPI launch of Flow123d replacing the `flow_executable`, '{n}' is the number of processes
+        self.mpi_command = (config_dict.get('flow_mpi', None) or {}).get('command', None)
+        self.out_dir = basename if out_dir is None else out_dir
         self.outer_regions_list = outer_regions
-        self.flow_args = config_dict["flow_executable"].copy()
-        n_steps = config_dict["n_pressure_loads"]
-        t = np.pi * np.arange(0, n_steps) / n_steps
-        self.p_loads = np.array([np.cos(t), np.sin(t)]).T
+        self.output_fields = output_fields
+        self.result_file = result_file
+        self.flow_executable = config_dict["flow_executable"].copy()
+        self.flow_args = []
+        if load is None:
+            n_steps = config_dict["n_pressure_loads"]
+            t = np.pi * np.arange(0, n_steps) / n_steps
+            self.p_loads = np.array([np.cos(t), np.sin(t)]).T
+            self.bc_pressure = "cos(Pi * t / {0})*x + sin(Pi * t / {0})*y".format(n_steps)
+        else:
+            self.p_loads = np.array([load], dtype=float)
+            self.bc_pressure = "{}*x + {}*y".format(*self.p_loads[0])
         super().__init__()
 
     def run(self):
-        in_f = in_file(self.base)
-        out_dir = self.base
-        # n_loads = len(self.p_loads)
-        # flow_in = "flow_{}.yaml".format(self.base)
+        in_f = in_file(self.out_dir)
+        out_dir = self.out_dir
         params = dict(
             mesh_file=mesh_file(self.base),
             fields_file=fields_file(self.base),
             outer_regions=str(self.outer_regions_list),
-            n_steps=len(self.p_loads)
+            n_steps=len(self.p_loads),
+            bc_pressure=self.bc_pressure,
+            output_fields=str(self.output_fields),
+            r_tol=self.solver['r_tol'],
+            a_tol=self.solver['a_tol'],
+            petsc_options=self.solver['options']
             )
         substitute_placeholders("flow_templ.yaml", in_f, params)
         self.flow_args.extend(['--output_dir', out_dir, in_f])
 
-        if os.path.exists(os.path.join(out_dir, "flow_fields.msh")):
+        result_path = os.path.join(out_dir, self.result_file)
+        stage_name = "flow_" + out_dir
+        if self.stages is None:
+            if os.path.exists(result_path):
+                self.stats = dict(reused=True)
+                return True
+        elif self.stages.is_done(stage_name, self.stage_key):
+            self.stats = dict(reused=True)
             return True
-        with open(self.base + "_stdout", "w") as stdout:
-            with open(self.base + "_stderr", "w") as stderr:
-                completed = subprocess.run(self.flow_args, stdout=stdout, stderr=stderr)
-            print("Exit status: ", completed.returncode)
-            status = completed.returncode == 0
-        conv_check = self.check_conv_reasons(os.path.join(out_dir, "flow123.0.log"))
+        else:
+            self.stages.reset(stage_name, [result_path])
+        n_proc = self.n_processes
+        if self.core_budget is not None:
+            n_proc = self.core_budget.acquire(n_proc)
+        start = time.time()
+        # failed start of the run if not set by the run
+        returncode = None
+        rusage = None
+        try:
+            args = self.flow_executable
+            if n_proc > 1:
+                args = [arg.replace("{n}", str(n_proc)) for arg in self.mpi_command]
+            args = args + self.flow_args
+            env = dict(os.environ, **_single_thread_env)
+            with open(self.out_dir + "_stdout", "w") as stdout:
+                with open(self.out_dir + "_stderr", "w") as stderr:
+                    process = subprocess.Popen(args, stdout=stdout, stderr=stderr, env=env)
+                    # resource usage of this run only (including the MPI processes waited for by mpiexec)
+                    _, wait_status, rusage = os.wait4(process.pid, 0)
+                    returncode = os.WEXITSTATUS(wait_status) if os.WIFEXITED(wait_status) \
+                        else -os.WTERMSIG(wait_status)
+                    # reaped by wait4, Popen must not wait for the PID again (it may be reused by another run)
+                    process.returncode = returncode
+        except OSError:
+            print("Failed to start Flow123d: ", args)
+            traceback.print_exc()
+        finally:
+            if self.core_budget is not None:
+                self.core_budget.release(n_proc)
+        print("Exit status: ", returncode)
+        status = returncode == 0
+        log_file = os.path.join(out_dir, "flow123.0.log")
+        conv_check = status and self.check_conv_reasons(log_file)
         print("converged: ", conv_check)
+        self.stats = dict(wall=time.time() - start, n_processes=n_proc,
+                          iterations=self.read_iterations(log_file), status=status, converged=conv_check)
+        if rusage is not None:
+            self.stats.update(cpu=rusage.ru_utime + rusage.ru_stime, peak_rss_mb=rusage.ru_maxrss / 1024)
+        if status and self.stages is not None:
+            self.stages.mark(stage_name, self.stage_key, [result_path])
         return status  # and conv_check
 
+    @staticmethod
+    def read_iterations(log_fname):
+        """
+        Total number of the linear solver iterations reported in the Flow123d log, None if there is no log.
+        """
+        if not os.path.exists(log_fname):
+            return None
+        with open(log_fname, "r") as f:
+            return sum(int(n) for n in re.findall(r"number of iterations is (\d+)", f.read()))
+
     def check_conv_reasons(self, log_fname):
         with open(log_fname, "r") as f:
             for line in f:
@@ -123,6 +266,50 @@ class Region:
             assert dim == self.dim, "Can not create shape of dim: {} in region '{}' of dim: {}.".format(dim, self.name, self.dim)
         return active
 
+def polygon_area(points):
+    """
+    Area of a simple polygon given by its vertices (shoelace formula).
+    """
+    x, y = np.array(points, dtype=float).T
+    return 0.5 * abs(x @ np.roll(y, -1) - y @ np.roll(x, -1))
+
+
+def element_geometry(mesh, ele_ids):
+    """
+    Region IDs, barycenters and volumes of the given elements of a GmshIO mesh.
+    Volumes are the lengths of the line elements and the areas of the triangles.
+    :param mesh: GmshIO mesh object.
+    :param ele_ids: Sequence of element IDs.
+    :return: (reg_ids, centers, volumes); arrays of shapes (N,), (N, 3), (N,)
+    """
+    elements = [mesh.elements[eid] for eid in ele_ids]
+    reg_ids = np.array([tags[0] - 10000 for el_type, tags, node_ids in elements], dtype=int)
+    n_nodes = np.array([len(node_ids) for el_type, tags, node_ids in elements], dtype=int)
+    centers = np.zeros((len(elements), 3))
+    volumes = np.zeros(len(elements))
+    for n in np.unique(n_nodes):
+        idx = np.nonzero(n_nodes == n)[0]
+        coords = np.array([[mesh.nodes[nid] for nid in elements[i][2]] for i in idx])
+        centers[idx] = np.mean(coords, axis=1)
+        if n == 2:
+            volumes[idx] = np.linalg.norm(coords[:, 1] - coords[:, 0], axis=1)
+        elif n == 3:
+            volumes[idx] = 0.5 * np.linalg.norm(np.cross(coords[:, 1] - coords[:, 0], coords[:, 2] - coords[:, 0]), axis=1)
+        else:
+            assert n == 1
+    return reg_ids, centers, volumes
+
+
+def frame_values(frame, ele_ids):
+    """
+    Values of the ElementDataFrame reordered to the given element IDs.
+    """
+    if np.array_equal(frame.ele_ids, ele_ids):
+        return frame.values
+    sorter = np.argsort(frame.ele_ids)
+    return frame.values[sorter[np.searchsorted(frame.ele_ids, ele_ids, sorter=sorter)]]
+
+
 def gmsh_mesh_bulk_elements(mesh):
     """
     Generator of IDs of bulk elements.
@@ -141,6 +328,13 @@ def gmsh_mesh_bulk_elements(mesh):
 
 
 class BulkBase(ABC):
+    def prepare(self, mesh, eids):
+        """
+        Optional batch preprocessing of all bulk elements before `element_data` is called for them.
+        :param eids: IDs of the bulk elements.
+        """
+        pass
+
     @abstractmethod
     def element_data(self, mesh, eid):
         """
@@ -187,41 +381,103 @@ class BulkMicroScale(BulkBase):
 
     def element_data(self, mesh, eid):
         if self.microscale_tensors is None:
-            self.microscale_tensors = self.microscale.effective_tensor_from_bulk()
+            self.microscale_tensors = self.microscale.effective_tensor()
         return 1.0, self.microscale_tensors[eid]
 
 class BulkFromFine(BulkBase):
     def __init__(self, fine_problem):
-        points, values = fine_problem.bulk_field()
-        self.mean_val = np.mean(values)
+        # The fine fields may not exist yet, interpolation is set up on the first use.
+        self.fine_problem = fine_problem
+        self.config_dict = fine_problem.config_dict
+        self.interp = None
+        self.tensors = {}
+        # (points, volumes, tensors) of the fine bulk elements, see `fine_tensors`
+        self._fine_tensors = None
+
+    def __getstate__(self):
+        """
+        Pickled without the fine problem, just with its bulk tensors (MicroscaleCells workers).
+        The interpolation is set up again on the first use.
+        """
+        self.fine_tensors()
+        state = dict(self.__dict__, fine_problem=None, interp=None)
+        state.pop('tree', None)
+        state.pop('values', None)
+        return state
+
+    def fine_tensors(self):
+        """
+        Bulk tensors of the fine problem, see `FlowProblem.bulk_tensors`, taken on the first use.
+        """
+        if self._fine_tensors is None:
+            self._fine_tensors = self.fine_problem.bulk_tensors()
+        return self._fine_tensors
+
+    def setup_interpolation(self):
+        import scipy.spatial as sc_spatial
+        import scipy.interpolate as sc_interpolate
+        points, volumes, tensors = self.fine_tensors()
+        values = np.array([tensors[:, 0, 0], tensors[:, 0, 1], tensors[:, 1, 1]])
         tria = sc_spatial.Delaunay(points)
-        #print("Values, shape:", values.shape)
-        self.interp =  sc_interpolate.LinearNDInterpolator(tria, values.T, fill_value=0)
-        self.interp_nearest = sc_interpolate.LinearNDInterpolator(points, values.T)
+        self.interp = sc_interpolate.LinearNDInterpolator(tria, values.T, fill_value=np.nan)
+        # nearest value for the points out of the convex hull of the fine barycenters
+        self.tree = sc_spatial.cKDTree(points)
+        self.values = values.T
+
+    def prepare(self, mesh, eids):
+        """
+        Compute tensors of all given elements at once, using the method given by
+        the `bulk_from_fine` config section:
+        interpolate - linear interpolation of the fine tensors to the element barycenters,
+        remap - volume weighted average of the fine elements with barycenters in the element.
+        """
+        options = self.config_dict.get('bulk_from_fine', {})
+        _, centers, _ = element_geometry(mesh, eids)
+        centers = centers[:, 0:2]
+        if options.get('method', 'interpolate') == 'remap':
+            cond = self.remap_fine(mesh, eids, options.get('average', 'arithmetic'))
+        else:
+            cond = self.interpolate(centers)
+        e_min = np.linalg.eigvalsh(cond)[:, 0]
+        not_positive = e_min < 1e-20
+        if np.any(not_positive):
+            for e, tn, center in zip(e_min[not_positive], cond[not_positive], centers[not_positive]):
+                print(e, tn, center)
+            assert False, "Interpolated tensors are not positive definite."
+        self.tensors.update(zip(eids, cond))
+
+    def interpolate(self, centers):
+        if self.interp is None:
+            self.setup_interpolation()
+        v = self.interp(centers)
+        outside = np.any(np.isnan(v), axis=1)
+        if np.any(outside):
+            _, nearest = self.tree.query(centers[outside])
+            v[outside] = self.values[nearest]
+        v00, v01, v11 = v.T
+        return np.stack([v00, v01, v01, v11], axis=1).reshape(-1, 2, 2)
+
+    def remap_fine(self, mesh, eids, average):
+        import remap
+        points, volumes, tensors = self.fine_tensors()
+        vertices = np.array([[mesh.nodes[nid][0:2] for nid in mesh.elements[eid][2]] for eid in eids])
+        return remap.remap_tensors(points, volumes, tensors, vertices.reshape(-1, 3, 2), average)
 
     def element_data(self, mesh, eid):
-        el_type, tags, node_ids = mesh.elements[eid]
-        center = np.mean([np.array(mesh.nodes[nid]) for nid in node_ids], axis=0)
-        v = self.interp(center[0:2])
-        if np.alltrue(v == 0):
-            #v = self.interp_nearest(center[0:2])
-            v = [[self.mean_val,0,self.mean_val]]
-        #print("V, shape:", v.shape)
-        v00, v01, v11 = v[0]
-        cond = np.array([[v00, v01], [v01, v11]])
-        #print("cond, shape: ", cond.shape)
-        e0, e1 = np.linalg.eigvalsh(cond)
-        if e0 < 1e-20 or e1 < 1e-20:
-            print(e0, e1, v, center)
-            assert False
-        return 1.0, cond
+        if eid not in self.tensors:
+            self.prepare(mesh, [eid])
+        return 1.0, self.tensors[eid]
 
 
 
 
 class BulkChoose(BulkBase):
-    def __init__(self, finer_level_path):
-        self.cond_tn = np.array(pandas.read_csv(finer_level_path, sep=' '))
+    def __init__(self, finer_level_path, finer_level_count=None):
+        """
+        :param finer_level_path: Store of the microscale tensors of the finer level, see tensor_store.py.
+        :param finer_level_count: Number of the stored tensors used (snapshot), all if None.
+        """
+        self.cond_tn = tensor_store.load(finer_level_path, tensor_store.pool_size(finer_level_path, finer_level_count))
 
 
     def element_data(self, mesh, eid):
@@ -260,7 +516,9 @@ def tensor_3d_flatten(tn_2d):
     return tn3d.ravel()
 
 
-def write_fields(mesh, basename, bulk_model, fracture_model):
+def compute_fields(mesh, bulk_model, fracture_model):
+    bulk_eids = [el_id for el_id, (el_type, tags, node_ids) in gmsh_mesh_bulk_elements(mesh) if len(node_ids) > 2]
+    bulk_model.prepare(mesh, bulk_eids)
     elem_ids = []
     cond_tn_field = []
     cs_field = []
@@ -274,13 +532,29 @@ def write_fields(mesh, basename, bulk_model, fracture_model):
             cs, cond_tn = bulk_model.element_data(mesh, el_id)
         cs_field.append(np.array(cs))
         cond_tn_field.append(tensor_3d_flatten(cond_tn))
+    return elem_ids, cs_field, cond_tn_field
+
 
+def write_fields(mesh, basename, elem_ids, cs_field, cond_tn_field):
     fname = fields_file(basename)
-    with open(fname, "w") as fout:
+    with checkpoint.atomic_open(fname, "w") as fout:
         mesh.write_ascii(fout)
         mesh.write_element_data(fout, elem_ids, 'conductivity_tensor', np.array(cond_tn_field))
         mesh.write_element_data(fout, elem_ids, 'cross_section', np.array(cs_field).reshape(-1, 1))
-    return elem_ids, cs_field, cond_tn_field
+
+
+@attr.s(auto_attribs=True)
+class RunSolution:
+    loads: np.array
+    # Pressure gradients solved by the run, shape (n_loads, 2).
+    ele_ids: np.array
+    # Element IDs, shape (N,).
+    cross_sections: np.array
+    # Element cross-sections, shape (N,).
+    velocities: np.array
+    # Element velocities, shape (n_loads, N, 2).
+    pressures: np.array = None
+    # Element pressures, shape (n_loads, N); only if requested.
 
 
 @attr.s(auto_attribs=True)
@@ -310,22 +584,40 @@ class FlowProblem:
     # One group is specified by the tuple of bulk and fracture region ID.
     group_positions: Dict[int, np.array] = attr.ib(factory=dict)
     # Centers of macro elements.
+    group_areas: Dict[int, float] = attr.ib(factory=dict)
+    # Areas of macro elements.
     skip_decomposition:bool = False
+    need_fields: bool = False
+    # Velocity and pressure fields are used by other problems, written even in the 'balance' tensor mode.
+    stages: Any = None
+    # Optional checkpoint.StageMarkers of the sample, completed Flow123d runs are not repeated.
+    role: str = None
+    # Role of the problem selecting its config (fine, coarse, coarse_ref), the basename by default;
+    # set for the problems with generated basenames, e.g. the batches of MicroscaleCells.
 
 
     # created later
-    mesh:gmsh_io.GmshIO = None
+    mesh: Any = None
+    # gmsh_io.GmshIO
 
     # safe conductivities produced by `make_fields`
     _elem_ids: Any = None
+    _cs_field: Any = None
     _cond_tn_field: Any = None
+    # solution of the in-process solver, see `solve_darcy`
+    _inprocess_run: Any = None
+    # result of `effective_tensor`
+    cond_tensors: Any = None
+    # Flow123d run threads and the in-process solve statistics, see `run`
+    threads: List[Any] = attr.ib(factory=list)
+    inprocess_stats: Any = None
 
     @classmethod
-    def make_fine(cls, i_level, fr_range, fractures, finer_level_path, config_dict):
+    def make_fine(cls, i_level, fr_range, fractures, finer_level_path, config_dict, finer_level_count=None):
         level_dict = config_dict['levels'][i_level]
         bulk_conductivity = level_dict['bulk_conductivity']
         if bulk_conductivity.get('choose_from_finer_level', False):
-            bulk_model = BulkChoose(finer_level_path)
+            bulk_model = BulkChoose(finer_level_path, finer_level_count)
         else:
             bulk_model = BulkFields(**bulk_conductivity)
         return FlowProblem(i_level, "fine",
@@ -339,17 +631,63 @@ class FlowProblem:
                            fr_range, fractures, bulk_model, config_dict)
 
     @classmethod
-    def make_microscale(cls, i_level, fr_range, fractures, fine_flow, config_dict):
+    def make_microscale(cls, i_level, fr_range, fractures, fine_flow, config_dict, basename="coarse_ref"):
         # use bulk fields from the fine level
         bulk_model = BulkFromFine(fine_flow)
 
-        return FlowProblem(i_level, "coarse_ref",
-                           fr_range, fractures, bulk_model, config_dict)
+        return FlowProblem(i_level, basename,
+                           fr_range, fractures, bulk_model, config_dict, role="coarse_ref")
 
 
     @property
     def pressure_loads(self):
-        return self.thread.p_loads
+        """
+        Unit pressure gradients for which the flux responses are fitted.
+        """
+        n_steps = self.config_dict["n_pressure_loads"]
+        t = np.pi * np.arange(0, n_steps) / n_steps
+        return np.array([np.cos(t), np.sin(t)]).T
+
+    @property
+    def linear_loads(self):
+        """
+        Solve just the X and Y unit loads and synthesize responses to `pressure_loads`.
+        """
+        return self.config_dict.get('linear_loads', False)
+
+    def flow_runs(self):
+        """
+        :return: List of (output_dir, loads) for the Flow123d runs of the problem.
+        """
+        if self.linear_loads:
+            return [("{}_load_{}".format(self.basename, i), load[None, :]) for i, load in enumerate(np.eye(2))]
+        else:
+            return [(self.basename, self.pressure_loads)]
+
+    def combine_responses(self, run_responses, run_loads):
+        """
+        Combine the flux responses of the individual runs into responses to `pressure_loads`.
+        The Darcy flow is linear in the boundary pressure, so responses to the unit loads
+        determine the response to any other load.
+        :param run_responses: List of arrays (n_groups, n_run_loads, 2), one for every run.
+        :param run_loads: List of arrays (n_run_loads, 2), loads solved by the runs.
+        :return: Array (n_groups, n_loads, 2).
+        """
+        responses = np.concatenate(run_responses, axis=1)
+        solved_loads = np.concatenate(run_loads)
+        if np.array_equal(solved_loads, self.pressure_loads):
+            return responses
+        coef = self.pressure_loads @ np.linalg.pinv(solved_loads)
+        return np.einsum('ij,gjc->gic', coef, responses)
+
+    @property
+    def tensor_mode(self):
+        """
+        Method of the effective tensor computation configured for this problem:
+        'bulk' - volume average of the velocity field,
+        'balance' - boundary fluxes from the water balance.
+        """
+        return self.config_dict.get('effective_tensor', {}).get(self.role or self.basename, 'bulk')
 
     def add_region(self, name, dim, mesh_step=0.0, boundary=False):
         reg = Region(name, dim, boundary, mesh_step)
@@ -363,6 +701,7 @@ class FlowProblem:
         :param outer_polygon: [np.array[2], ..] Vertices of the outer polygon.
         :return: (PolygonDecomposition, side_regions)
         """
+        from bgem.polygons import polygons
         pd = polygons.PolygonDecomposition(tol)
         last_pt = outer_polygon[-1]
         side_regions = []
@@ -372,6 +711,7 @@ class FlowProblem:
             diff = np.array(pt) - np.array(last_pt)
             normal = np.array([diff[1], -diff[0]])
             reg.normal =  normal / np.linalg.norm(normal)
+            reg.midpoint = (np.array(pt) + np.array(last_pt)) / 2
             side_regions.append(reg)
 
             sub_segments = pd.add_line(last_pt, pt, deformability=0)
@@ -461,7 +801,10 @@ class FlowProblem:
         lx, ly = geom["domain_box"]
         self.outer_polygon = [[-lx / 2, -ly / 2], [+lx / 2, -ly / 2], [+lx / 2, +ly / 2], [-lx / 2, +ly / 2]]
         pd, self.side_regions = self.init_decomposition(self.outer_polygon, bulk_reg, tol=self.mesh_step)
+        for reg in self.side_regions:
+            reg.group = 0
         self.group_positions[0] = np.mean(self.outer_polygon, axis=0)
+        self.group_areas[0] = polygon_area(self.outer_polygon)
 
         # extract fracture lines larger then the mesh step
         self.fracture_lines = self.fractures.get_lines(self.fr_range)
@@ -470,9 +813,28 @@ class FlowProblem:
             self.reg_to_group[reg.id] = 0
         self.decomp = pd
 
+    def mesh_cache_key(self, cache, *items):
+        """
+        Key of the problem mesh in the mesh cache, None if the cache is not used.
+        :param items: Problem specific mesh inputs, beside the fracture lines, the domain and the mesher options.
+        """
+        if cache is None:
+            return None
+        import geometry_2d as geom
+        fracture_lines = self.fractures.get_lines(self.fr_range)
+        return mesh_cache.make_key(fracture_lines, self.config_dict["geometry"]["domain_box"],
+                                   self.config_dict["gmsh_executable"], mesh_cache.file_digest(geom.__file__),
+                                   *items)
+
     def make_mesh(self):
         import geometry_2d as geom
         mesh_file = "mesh_{}.msh".format(self.basename)
+        cache = mesh_cache.MeshCache.from_config(self.config_dict)
+        mesh_key = None
+        if not os.path.exists(mesh_file):
+            mesh_key = self.mesh_cache_key(cache, self.fr_range)
+            if mesh_key is not None:
+                cache.fetch(mesh_key, mesh_file)
         self.skip_decomposition = os.path.exists(mesh_file)
         self.make_fracture_network()
         if not self.skip_decomposition:
@@ -483,7 +845,10 @@ class FlowProblem:
             step_range = (self.mesh_step * 0.9, self.mesh_step *1.1)
             g2d.call_gmsh(gmsh_executable, step_range)
             self.mesh = g2d.modify_mesh()
+            if mesh_key is not None:
+                cache.store(mesh_key, g2d.msh_file)
         else:
+            from bgem.gmsh import gmsh_io
             self.mesh = gmsh_io.GmshIO()
             with open(mesh_file, "r") as f:
                 self.mesh.read(f)
@@ -493,6 +858,7 @@ class FlowProblem:
     def make_fields(self):
         """
         Calculate the conductivity and the cross-section fields, write into a GMSH file.
+        The file is not written for problems solved in-process.
 
         :param cond_tensors_2d: Dictionary of the conductivities determined from a subscale
         calculation.
@@ -500,37 +866,72 @@ class FlowProblem:
         :return:
         """
         fracture_model = FractureModel(self.fractures, self.reg_to_fr, **self.config_dict['fracture_model'])
-        elem_ids, cs_field, cond_tn_field = write_fields(self.mesh, self.basename, self.bulk_model, fracture_model)
+        elem_ids, cs_field, cond_tn_field = compute_fields(self.mesh, self.bulk_model, fracture_model)
+        if not self.solve_inprocess:
+            write_fields(self.mesh, self.basename, elem_ids, cs_field, cond_tn_field)
 
         self._elem_ids = elem_ids
+        self._cs_field = cs_field
         self._cond_tn_field = cond_tn_field
 
-    def bulk_field(self):
-        assert self._elem_ids is not None
+    def load_fields(self):
+        """
+        Read the fields written by `make_fields` of the previous (interrupted) calculation of the sample.
+        The fields are computed if there is no fields file (problems solved in-process).
+        """
+        fname = fields_file(self.basename)
+        if not os.path.exists(fname):
+            self.make_fields()
+            return
+        fields = gmsh_stream.read_element_data(fname, ['conductivity_tensor', 'cross_section'])
+        cond_frame = fields['conductivity_tensor'][0]
+        self._elem_ids = cond_frame.ele_ids.tolist()
+        self._cs_field = list(frame_values(fields['cross_section'][0], cond_frame.ele_ids)[:, 0])
+        self._cond_tn_field = list(cond_frame.values)
 
-        points = []
-        values00 = []
-        values11 = []
-        values01 = []
-        for eid, tensor in zip(self._elem_ids, self._cond_tn_field):
-            el_type, tags, node_ids = self.mesh.elements[eid]
-            if len(node_ids) > 2:
-                center = np.mean([np.array(self.mesh.nodes[nid]) for nid in node_ids], axis=0)
-                points.append(center[0:2])
-                # tensor is flatten 3x3
-                values00.append(tensor[0])
-                values01.append(tensor[1])
-                values11.append(tensor[4])
+    def bulk_field(self):
+        """
+        :return: (points, values); barycenters (N, 2) of the bulk elements and
+            their tensor components (3, N): C00, C01, C11
+        """
+        points, volumes, tensors = self.bulk_tensors()
+        return points, np.array([tensors[:, 0, 0], tensors[:, 0, 1], tensors[:, 1, 1]])
 
-        return np.array(points), np.array([values00, values01, values11])
+    def bulk_tensors(self):
+        """
+        :return: (points, volumes, tensors); barycenters (N, 2), volumes (N,)
+            and conductivity tensors (N, 2, 2) of the bulk elements
+        """
+        assert self._elem_ids is not None
+        ele_ids = np.array(self._elem_ids)
+        is_bulk = np.array([len(self.mesh.elements[eid][2]) > 2 for eid in ele_ids], dtype=bool)
+        _, centers, volumes = element_geometry(self.mesh, ele_ids[is_bulk])
+        # tensors are flatten 3x3
+        tensors = np.array(self._cond_tn_field)[is_bulk].reshape(-1, 3, 3)[:, 0:2, 0:2]
+        return centers[:, 0:2], volumes, tensors
 
 
 
-    def elementwise_mesh(self, coarse_mesh, mesh_step, bounding_polygon):
+    def elementwise_mesh(self, coarse_mesh, mesh_step, bounding_polygon, eids=None):
+        """
+        Mesh every coarse triangle as a separate subdomain with its own regions.
+        :param eids: Optional subset of the coarse element IDs to mesh, all triangles by default.
+        """
         import geometry_2d as geom
         from bgem.polygons.plot_polygons import plot_decomp_segments
 
+        if eids is not None:
+            eids = set(eids)
         mesh_file = "mesh_{}.msh".format(self.basename)
+        cache = mesh_cache.MeshCache.from_config(self.config_dict)
+        mesh_key = None
+        if cache is not None and not os.path.exists(mesh_file):
+            # regions are named after the coarse elements, so the element IDs are part of the key
+            cells = [(eid, np.array([coarse_mesh.nodes[nid][:2] for nid in nodes]))
+                     for eid, (tele, tags, nodes) in coarse_mesh.elements.items()
+                     if tele == 2 and (eids is None or eid in eids)]
+            mesh_key = self.mesh_cache_key(cache, mesh_step, bounding_polygon, cells)
+            cache.fetch(mesh_key, mesh_file)
         if os.path.exists(mesh_file):
             # just initialize reg_to_group map
             self.skip_decomposition = True
@@ -549,6 +950,8 @@ class FlowProblem:
             #print("Geometry for eid: ", eid)
             if tele != 2:
                 continue
+            if eids is not None and eid not in eids:
+                continue
             prefix = "el_{:03d}_".format(eid)
             outer_polygon = np.array([coarse_mesh.nodes[nid][:2] for nid in nodes])
             # set mesh step to maximal height of the triangle
@@ -559,6 +962,7 @@ class FlowProblem:
             self.mesh_step = min(self.mesh_step, area / np.linalg.norm(outer_polygon[0] - outer_polygon[2]))
 
             self.group_positions[eid] = np.mean(outer_polygon, axis=0)
+            self.group_areas[eid] = polygon_area(outer_polygon)
             #edge_sizes = np.linalg.norm(outer_polygon[:, :] - np.roll(outer_polygon, -1, axis=0), axis=1)
             #diam = np.max(edge_sizes)
 
@@ -575,6 +979,7 @@ class FlowProblem:
                 side_reg.name = "." + prefix + side_reg.name[1:]
                 side_reg.sub_reg.name = "." + prefix + side_reg.sub_reg.name[1:]
                 self.reg_to_group[side_reg.id] = eid
+                side_reg.group = eid
                 normals.append(side_reg.normal)
                 shifts.append(side_reg.normal @ outer_polygon[i_side])
             self.side_regions.extend(side_regions)
@@ -603,6 +1008,7 @@ class FlowProblem:
                 g2d.add_compoud(pd)
 
         if self.skip_decomposition:
+            from bgem.gmsh import gmsh_io
             self.mesh = gmsh_io.GmshIO()
             with open(mesh_file, "r") as f:
                 self.mesh.read(f)
@@ -613,6 +1019,8 @@ class FlowProblem:
         gmsh_executable = self.config_dict["gmsh_executable"]
         g2d.call_gmsh(gmsh_executable, step_range)
         self.mesh = g2d.modify_mesh()
+        if mesh_key is not None:
+            cache.store(mesh_key, g2d.msh_file)
 
 
 
@@ -621,85 +1029,148 @@ class FlowProblem:
 
 
 
-    def run(self):
+    @property
+    def n_processes(self):
+        """
+        Number of MPI processes of a Flow123d run, given by the number of mesh elements
+        and limited by the cores reserved for the sample. Always 1 without the `flow_mpi.command`.
+        """
+        mpi_config = self.config_dict.get('flow_mpi', None) or {}
+        if not mpi_config.get('command', None):
+            return 1
+        n_elements = len(self._elem_ids) if self._elem_ids is not None else len(self.mesh.elements)
+        n_proc = int(np.ceil(n_elements / mpi_config.get('elements_per_process', 50000)))
+        return max(1, min(n_proc, self.config_dict.get('n_cores', 3)))
+
+    @property
+    def conductivity_contrast(self):
+        """
+        Ratio of the maximal and the minimal element conductivity, multiplied by the cross-section.
+        """
+        cond = np.array(self._cond_tn_field).reshape(-1, 9)
+        scalar = np.array(self._cs_field, dtype=float).reshape(-1) * (cond[:, 0] + cond[:, 4]) / 2
+        return np.max(scalar) / np.min(scalar)
+
+    @property
+    def solver(self):
+        """
+        Linear solver settings of the Flow123d runs, see `choose_solver`.
+        """
+        n_elements = len(self._elem_ids)
+        contrast = self.conductivity_contrast
+        solver = choose_solver(self.config_dict, n_elements, contrast)
+        print("Solver for {}, elements: {} contrast: {:.3g} : {}".format(self.basename, n_elements, contrast, solver))
+        return solver
+
+    @property
+    def solve_inprocess(self):
+        """
+        Solve the problem by the in-process `darcy_solver` instead of Flow123d,
+        used for meshes with at most `inprocess_solver.max_elements` elements.
+        """
+        max_elements = self.config_dict.get('inprocess_solver', {}).get('max_elements', 0)
+        return len(self.mesh.elements) <= max_elements
+
+    def outer_region_names(self):
         outer_reg_names = []
         for reg in self.side_regions:
             outer_reg_names.append(reg.name)
             outer_reg_names.append(reg.sub_reg.name)
-        self.thread = FlowThread(self.basename, outer_reg_names, self.config_dict)
-
-        self.thread.start()
-        return self.thread
-
-    # def effective_tensor_from_balance(self, side_regions):
-    #     """
-    #     :param mesh: GmshIO mesh object.
-    #     :param side_regions: List of side regions with the "normal" attribute.
-    #     :return:
-    #     """
-    #     loads = self.pressure_loads
-    #     with open(os.path.join(self.basename, "water_balance.yaml")) as f:
-    #         balance = yaml.load(f, Loader=yaml.FullLoader)['data']
-    #     flux_response = np.zeros_like(loads)
-    #     reg_map = {}
-    #     for reg in side_regions:
-    #         reg_map[reg.name] = reg
-    #         reg_map[reg.sub_reg.name] = reg
-    #     for entry in balance:
-    #         reg = reg_map.get(entry['region'], None)
-    #         bc_influx = entry['data'][0]
-    #         if reg is not None:
-    #             flux_response[entry['time']] += reg.normal * bc_influx
-    #     flux_response /= len(side_regions)
-    #     #flux_response *= np.array([100, 1])[None, :]
-    #
-    #
-    #     # least square fit for the symmetric conductivity tensor
-    #     rhs = flux_response.flatten()
-    #     # columns for the tensor values: C00, C01, C11
-    #     pressure_matrix = np.zeros((len(rhs), 3))
-    #     for i_load, (p0, p1) in enumerate(loads):
-    #         i0 = 2 * i_load
-    #         i1 = i0 + 1
-    #         pressure_matrix[i0] = [p0, p1, 0]
-    #         pressure_matrix[i1] = [0, p0, p1]
-    #     C = np.linalg.lstsq(pressure_matrix, rhs, rcond=None)[0]
-    #     cond_tn = np.array([[C[0], C[1]], [C[1], C[2]]])
-    #     self.plot_effective_tensor(flux_response, cond_tn, label)
-    #     #print(cond_tn)
-    #     return cond_tn
-
-    def element_volume(self, mesh, nodes):
-        nodes = np.array([mesh.nodes[nid] for nid in  nodes])
-        if len(nodes) == 1:
-            return 0
-        elif len(nodes) == 2:
-            return np.linalg.norm(nodes[1] - nodes[0])
-        elif len(nodes) == 3:
-            return np.linalg.norm(np.cross(nodes[1] - nodes[0], nodes[2] - nodes[0]))
-        else:
-            assert False
-
+        return outer_reg_names
 
-    def effective_tensor_from_bulk(self):
+    def run(self, core_budget=None):
         """
-        :param bulk_regions: mapping reg_id -> tensor_group_id, groups of regions for which the tensor will be computed.
-        :return: {group_id: conductivity_tensor} List of effective tensors.
+        Start Flow123d runs of the problem in separate threads.
+        Small problems are solved in-process right away, see `solve_inprocess`.
+        :param core_budget: Optional CoreBudget shared by concurrent runs of the sample.
+        :return: self, use `join` to wait for the runs.
         """
-        bulk_regions = self.reg_to_group
-        out_mesh = gmsh_io.GmshIO()
-        with open(os.path.join(self.basename, "flow_fields.msh"), "r") as f:
-            out_mesh.read(f)
-        time_idx = 0
-        time, field_cs = out_mesh.element_data['cross_section'][time_idx]
-        ele_reg_vol = {eid: (tags[0] - 10000, self.element_volume(out_mesh, nodes))
-                       for eid, (tele, tags, nodes) in out_mesh.elements.items()}
-
-
-        assert len(field_cs) == len(ele_reg_vol)
-        velocity_field = out_mesh.element_data['velocity_p0']
+        self.threads = []
+        if self.solve_inprocess:
+            start = time.time()
+            cpu_start = time.thread_time()
+            self._inprocess_run = self.solve_darcy()
+            self.inprocess_stats = dict(wall=time.time() - start, cpu=time.thread_time() - cpu_start)
+            return self
+        outer_reg_names = self.outer_region_names()
+        if self.tensor_mode == 'balance' and not self.need_fields:
+            output_fields, result_file = [], "water_balance.yaml"
+        else:
+            output_fields, result_file = ['pressure_p0', 'velocity_p0', 'cross_section'], "flow_fields.msh"
+        solver = self.solver
+        for out_dir, loads in self.flow_runs():
+            load = loads[0] if self.linear_loads else None
+            stage_key = None
+            if self.stages is not None:
+                stage_key = self.stages.key("flow_" + out_dir, (solver, loads.tolist(), output_fields),
+                                            [self.basename + "_fields"])
+            thread = FlowThread(self.basename, outer_reg_names, self.config_dict, output_fields, result_file,
+                                out_dir=out_dir, load=load,
+                                n_processes=self.n_processes, core_budget=core_budget, solver=solver,
+                                stages=self.stages, stage_key=stage_key)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def join(self):
+        """
+        Wait for all Flow123d runs of the problem.
+        """
+        for thread in self.threads:
+            thread.join()
 
+    def solve_darcy(self):
+        """
+        Solve all `pressure_loads` by the in-process P1 solver, using the mesh and the fields
+        computed by `make_fields`. The fields file is not needed.
+        :return: RunSolution with element pressures.
+        """
+        import darcy_solver
+        mesh = self.mesh
+        node_ids = list(mesh.nodes.keys())
+        node_idx = {nid: i for i, nid in enumerate(node_ids)}
+        nodes = np.array([mesh.nodes[nid] for nid in node_ids])
+
+        ele_ids = np.array(self._elem_ids, dtype=int)
+        cs = np.array(self._cs_field, dtype=float).reshape(-1)
+        cond = np.array(self._cond_tn_field).reshape(-1, 3, 3)[:, 0:2, 0:2]
+        ele_nodes = [[node_idx[nid] for nid in mesh.elements[eid][2]] for eid in ele_ids]
+        is_line = np.array([len(e_nodes) == 2 for e_nodes in ele_nodes], dtype=bool)
+        tri_idx = np.nonzero(~is_line)[0]
+        line_idx = np.nonzero(is_line)[0]
+        triangles = np.array([ele_nodes[i] for i in tri_idx], dtype=int).reshape(-1, 3)
+        lines = np.array([ele_nodes[i] for i in line_idx], dtype=int).reshape(-1, 2)
+        # isotropic fracture tensors, the conductivity in the fracture direction
+        tangents = nodes[lines[:, 1], 0:2] - nodes[lines[:, 0], 0:2]
+        tangents /= np.linalg.norm(tangents, axis=1)[:, None]
+        line_cond = np.einsum('la,lab,lb->l', tangents, cond[line_idx], tangents)
+
+        outer_tags = set()
+        for name in self.outer_region_names():
+            if name in mesh.physical:
+                outer_tags.add(mesh.physical[name])
+        dirichlet_nodes = [node_idx[nid] for el_type, tags, e_nodes in mesh.elements.values()
+                           if (tags[0], len(e_nodes) - 1) in outer_tags for nid in e_nodes]
+
+        print("In-process solve, elements: ", len(ele_ids))
+        solver = darcy_solver.DarcySolver2d(nodes, triangles, cond[tri_idx], lines, line_cond, cs[line_idx],
+                                            dirichlet_nodes)
         loads = self.pressure_loads
+        pressure, tri_velocity, line_velocity = solver.solve(loads)
+        velocities = np.zeros((len(loads), len(ele_ids), 2))
+        velocities[:, tri_idx] = tri_velocity
+        velocities[:, line_idx] = line_velocity
+        pressures = np.zeros((len(loads), len(ele_ids)))
+        pressures[:, tri_idx] = np.mean(pressure[:, triangles], axis=2)
+        pressures[:, line_idx] = np.mean(pressure[:, lines], axis=2)
+        return RunSolution(loads, ele_ids, cs, velocities, pressures)
+
+    def tensor_groups(self):
+        """
+        :return: (group_idx, group_labels); group_idx maps group_id -> i_group,
+        group_labels are the longest region names of the groups.
+        """
+        bulk_regions = self.reg_to_group
         group_idx = {group_id: i_group for i_group, group_id in enumerate(set(bulk_regions.values()))}
         n_groups = len(group_idx)
         group_labels = n_groups * ['_']
@@ -708,20 +1179,132 @@ class FlowProblem:
             old_label = group_labels[i_group]
             new_label = self.regions[reg_id].name
             group_labels[i_group] = old_label if len(old_label) > len(new_label) else new_label
+        return group_idx, group_labels
+
+    def effective_tensor(self):
+        """
+        Compute effective tensors using the method given by `tensor_mode`.
+        The in-process solution provides just the element velocities, so the bulk average is used.
+        Tensors are computed just once.
+        :return: {group_id: conductivity_tensor}
+        """
+        if self.cond_tensors is not None:
+            return self.cond_tensors
+        if self.tensor_mode == 'balance' and self._inprocess_run is None:
+            return self.effective_tensor_from_balance()
+        else:
+            return self.effective_tensor_from_bulk()
 
-        n_directions = len(loads)
-        flux_response = np.zeros((n_groups, n_directions, 2))
-        area = np.zeros((n_groups, n_directions))
+    def effective_tensor_from_balance(self):
+        """
+        Effective tensors from the boundary fluxes of the water balance.
+        The mean velocity of a group is given by the boundary integral:
+            -u_mean = 1/|G| int_boundary (x - x_G) * influx ds ~ 1/|G| sum_sides (x_side - x_G) * side_influx
+        |G| is the area of the group, the same as in `effective_tensor_from_bulk`.
+        The water balance gives just the total influx of every boundary side, so the integral is approximated
+        by the side midpoints x_side; exact only for a flux uniform along each side, e.g. for homogeneous groups.
+        :return: {group_id: conductivity_tensor}
+        """
+        group_idx, group_labels = self.tensor_groups()
+        reg_map = {}
+        for reg in self.side_regions:
+            reg_map[reg.name] = reg
+            reg_map[reg.sub_reg.name] = reg
+
+        run_responses = []
+        runs_loads = []
+        for out_dir, run_loads in self.flow_runs():
+            n_directions = len(run_loads)
+            runs_loads.append(run_loads)
+            with open(os.path.join(out_dir, "water_balance.yaml")) as f:
+                balance = yaml.safe_load(f)['data']
+            flux_response = np.zeros((len(group_idx), n_directions, 2))
+            for entry in balance:
+                reg = reg_map.get(entry['region'].strip("\"'"), None)
+                i_time = int(round(entry['time']))
+                if reg is None or i_time >= n_directions:
+                    continue
+                bc_influx = entry['data'][0]
+                shift = reg.midpoint - self.group_positions[reg.group]
+                flux_response[group_idx[reg.group], i_time] += shift * bc_influx
+            for group_id, i_group in group_idx.items():
+                flux_response[i_group] /= self.group_areas[group_id]
+            run_responses.append(flux_response)
+        flux_response = self.combine_responses(run_responses, runs_loads)
+        return self.fit_tensors(flux_response, group_idx, group_labels)
+
+    def velocity_runs(self, pressure=False):
+        """
+        Generator of the element velocities for the solved pressure loads. One item for every
+        Flow123d run (only the needed fields are read from its output) or the single in-process solution.
+        :param pressure: Read also the element pressures.
+        :return: RunSolution
+        """
+        if self._inprocess_run is not None:
+            yield self._inprocess_run
+            return
+        for out_dir, run_loads in self.flow_runs():
+            steps = range(len(run_loads))
+            field_names = ['cross_section', 'velocity_p0'] + (['pressure_p0'] if pressure else [])
+            fields = gmsh_stream.read_element_data(
+                os.path.join(out_dir, "flow_fields.msh"), field_names,
+                time_indices={'cross_section': [0], 'velocity_p0': steps, 'pressure_p0': steps})
+            cs_frame = fields['cross_section'][0]
+            ele_ids = cs_frame.ele_ids
+            velocities = np.zeros((len(run_loads), len(ele_ids), 2))
+            for frame in fields['velocity_p0']:
+                velocities[frame.time_idx] = frame_values(frame, ele_ids)[:, 0:2]
+            pressures = None
+            if pressure:
+                pressures = np.zeros((len(run_loads), len(ele_ids)))
+                for frame in fields['pressure_p0']:
+                    pressures[frame.time_idx] = frame_values(frame, ele_ids)[:, 0]
+            yield RunSolution(run_loads, ele_ids, cs_frame.values[:, 0], velocities, pressures)
+
+    def effective_tensor_from_bulk(self):
+        """
+        The mean velocity of a group is the integral of the velocity times the cross-section over the bulk
+        and fracture elements of the group divided by the area of the group (the sum of its bulk triangle areas).
+        :return: {group_id: conductivity_tensor} List of effective tensors.
+        """
+        bulk_regions = self.reg_to_group
+        group_idx, group_labels = self.tensor_groups()
+        n_groups = len(group_idx)
+        ele_ids = None
+        run_responses = []
+        runs_loads = []
         print("Averaging velocities ...")
-        for i_time, (time, velocity) in velocity_field.items():
-            for eid, ele_vel in velocity.items():
-                reg_id, vol = ele_reg_vol[eid]
-                cs = field_cs[eid][0]
-                volume = cs * vol
-                i_group = group_idx[bulk_regions[reg_id]]
-                flux_response[i_group, i_time, :] += -(volume * np.array(ele_vel[0:2]))
-                area[i_group, i_time] += volume
-        flux_response /= area[:, :, None]
+        for solution in self.velocity_runs():
+            run_loads, velocities = solution.loads, solution.velocities
+            n_directions = len(run_loads)
+            runs_loads.append(run_loads)
+            if ele_ids is None or not np.array_equal(ele_ids, solution.ele_ids):
+                # The mesh is the same as self.mesh, geometry computed once for all runs.
+                ele_ids = solution.ele_ids
+                reg_ids, _, ele_vol = element_geometry(self.mesh, ele_ids)
+                used_regs, ele_reg_idx = np.unique(reg_ids, return_inverse=True)
+                ele_group = np.array([group_idx[bulk_regions[reg_id]] for reg_id in used_regs], dtype=int)[ele_reg_idx]
+                volume = solution.cross_sections * ele_vol
+                is_bulk = np.array([len(self.mesh.elements[eid][2]) == 3 for eid in ele_ids], dtype=bool)
+                area = np.bincount(ele_group[is_bulk], weights=ele_vol[is_bulk], minlength=n_groups)
+
+            flux_response = np.zeros((n_groups, n_directions, 2))
+            for i_load in range(n_directions):
+                for ax in range(2):
+                    flux_response[:, i_load, ax] = \
+                        -np.bincount(ele_group, weights=volume * velocities[i_load, :, ax], minlength=n_groups)
+            flux_response /= area[:, None, None]
+            run_responses.append(flux_response)
+        flux_response = self.combine_responses(run_responses, runs_loads)
+        return self.fit_tensors(flux_response, group_idx, group_labels)
+
+    def fit_tensors(self, flux_response, group_idx, group_labels):
+        """
+        Least square fit of the symmetric conductivity tensors to the flux responses.
+        :param flux_response: Array (n_groups, n_loads, 2) of the mean fluxes -u for the pressure loads.
+        :return: {group_id: conductivity_tensor}
+        """
+        loads = self.pressure_loads
         cond_tensors = {}
         print("Fitting tensors ...")
         for group_id, i_group in group_idx.items():
@@ -774,6 +1357,10 @@ class FlowProblem:
         :return:
         """
 
+        with _plot_lock:
+            self._plot_effective_tensor(fluxes, cond_tn, label)
+
+    def _plot_effective_tensor(self, fluxes, cond_tn, label):
         import matplotlib.pyplot as plt
 
         e_val, e_vec = np.linalg.eigh(cond_tn)
@@ -808,12 +1395,340 @@ class FlowProblem:
             cond_tn=[self.cond_tensors[eid].tolist() for eid in self.cond_tensors.keys()]
         )
 
+    def metrics(self):
+        """
+        Size of the problem and statistics of its runs, for the cost breakdown in the sample summary.
+        """
+        n_nodes = [len(nodes) for el_type, tags, nodes in self.mesh.elements.values()] if self.mesh else []
+        return dict(
+            n_fractures=len(set(self.reg_to_fr.values())),
+            n_elements=len(n_nodes),
+            n_fracture_elements=n_nodes.count(2),
+            n_bulk_elements=n_nodes.count(3),
+            n_nodes=len(self.mesh.nodes) if self.mesh else 0,
+            n_groups=len(self.cond_tensors) if self.cond_tensors is not None else 0,
+            runs=[thread.stats for thread in self.threads] if self.inprocess_stats is None else [self.inprocess_stats]
+        )
+
+
+
+class FineSolutionUpscaling:
+    """
+    Tensors of the coarse elements fitted directly to the solution of the fine problem,
+    an alternative to the coarse_ref problem (`coarse_upscaling: fine_solution`).
+
+    Fine elements are binned into the coarse triangles by their barycenters. For every load, the mean flux -u
+    of a coarse element is the cross-section weighted average of the fine velocities and the mean pressure
+    gradient is the least square linear fit of the fine bulk pressures. The symmetric tensor is then
+    fitted by least squares over the loads. Elements of the fractures larger then the coarse step
+    are not included as these fractures are part of the coarse mesh.
+    """
+    def __init__(self, fine_problem, fr_max_size, coarse_problem=None):
+        """
+        :param fine_problem: Solved fine FlowProblem.
+        :param fr_max_size: The coarse mesh step, upper limit of the included fracture sizes.
+        :param coarse_problem: FlowProblem with the coarse mesh, can be set later.
+        """
+        self.basename = "coarse_ref"
+        self.fine_problem = fine_problem
+        self.fr_max_size = fr_max_size
+        self.coarse_problem = coarse_problem
+        self.group_positions = {}
+        self.cond_tensors = None
+
+    def coarse_elements(self):
+        mesh = self.coarse_problem.mesh
+        eids = [eid for eid, (el_type, tags, node_ids) in mesh.elements.items() if el_type == 2]
+        vertices = np.array([[mesh.nodes[nid][0:2] for nid in mesh.elements[eid][2]] for eid in eids])
+        return eids, vertices.reshape(-1, 3, 2)
+
+    def fine_solution(self):
+        """
+        Solution of all runs of the fine problem.
+        :return: (ele_ids, cross_sections, loads, velocities, pressures)
+        """
+        solutions = list(self.fine_problem.velocity_runs(pressure=True))
+        ele_ids = solutions[0].ele_ids
+        for solution in solutions[1:]:
+            assert np.array_equal(solution.ele_ids, ele_ids)
+        return (ele_ids, solutions[0].cross_sections,
+                np.concatenate([solution.loads for solution in solutions]),
+                np.concatenate([solution.velocities for solution in solutions]),
+                np.concatenate([solution.pressures for solution in solutions]))
+
+    @staticmethod
+    def fit_symmetric(grads, fluxes):
+        """
+        Least square fit of symmetric tensors: flux = C @ grad for all loads.
+        :param grads: Array (n_elements, n_loads, 2).
+        :param fluxes: Array (n_elements, n_loads, 2).
+        :return: Array (n_elements, 2, 2).
+        """
+        gx, gy = grads[:, :, 0], grads[:, :, 1]
+        zero = np.zeros_like(gx)
+        # rows for the flux components, columns for C00, C01, C11
+        A = np.stack([np.stack([gx, gy, zero], axis=2), np.stack([zero, gx, gy], axis=2)], axis=2)
+        normal = np.einsum('nlki,nlkj->nij', A, A)
+        rhs = np.einsum('nlki,nlk->ni', A, fluxes)
+        C = np.linalg.solve(normal, rhs[:, :, None])[:, :, 0]
+        return np.stack([C[:, 0], C[:, 1], C[:, 1], C[:, 2]], axis=1).reshape(-1, 2, 2)
+
+    def effective_tensor(self):
+        """
+        :return: {coarse_element_id: conductivity_tensor}
+        """
+        if self.cond_tensors is not None:
+            return self.cond_tensors
+        fine = self.fine_problem
+        print("Upscaling fine solution ...")
+        ele_ids, cs, loads, velocities, pressures = self.fine_solution()
+        n_loads = len(loads)
+        reg_ids, centers, ele_vol = element_geometry(fine.mesh, ele_ids)
+        centers = centers[:, 0:2]
+        is_bulk = np.array([len(fine.mesh.elements[eid][2]) > 2 for eid in ele_ids], dtype=bool)
+        fr_size = {reg_id: fine.fractures.fractures[i_fr].rx for reg_id, i_fr in fine.reg_to_fr.items()}
+        small_fracture = np.array([fr_size.get(reg_id, np.inf) < self.fr_max_size for reg_id in reg_ids], dtype=bool)
+
+        coarse_eids, vertices = self.coarse_elements()
+        n_coarse = len(coarse_eids)
+        coarse_centers = np.mean(vertices, axis=1)
+        import remap
+        target = remap.TriangleLocator(vertices).locate(centers)
+        target[~(is_bulk | small_fracture)] = -1
+        n_outside = np.sum((target < 0) & (is_bulk | small_fracture))
+        if n_outside > 0:
+            print("Fine elements out of the coarse mesh, not used: {}".format(n_outside))
+        inside = target >= 0
+        target, cs, ele_vol, is_bulk = target[inside], cs[inside], ele_vol[inside], is_bulk[inside]
+        velocities, pressures, centers = velocities[:, inside], pressures[:, inside], centers[inside]
+
+        # mean fluxes
+        volume = cs * ele_vol
+        weight = np.bincount(target, weights=volume, minlength=n_coarse)
+        fluxes = np.zeros((n_coarse, n_loads, 2))
+        for i_load in range(n_loads):
+            for ax in range(2):
+                fluxes[:, i_load, ax] = -np.bincount(target, weights=volume * velocities[i_load, :, ax], minlength=n_coarse)
+        has_data = weight > 0
+        fluxes[has_data] /= weight[has_data, None, None]
+
+        # pressure gradients, linear fit p = a + g . (x - x_c) over the bulk elements
+        b_target = target[is_bulk]
+        b_vol = ele_vol[is_bulk]
+        phi = np.concatenate([np.ones((len(b_target), 1)), centers[is_bulk] - coarse_centers[b_target]], axis=1)
+        normal = np.zeros((n_coarse, 3, 3))
+        for i in range(3):
+            for j in range(3):
+                normal[:, i, j] = np.bincount(b_target, weights=b_vol * phi[:, i] * phi[:, j], minlength=n_coarse)
+        rhs = np.zeros((n_coarse, 3, n_loads))
+        for i in range(3):
+            for i_load in range(n_loads):
+                rhs[:, i, i_load] = np.bincount(b_target, weights=b_vol * phi[:, i] * pressures[i_load][is_bulk],
+                                                minlength=n_coarse)
+        n_bulk = np.bincount(b_target, minlength=n_coarse)
+        scale = np.maximum(normal[:, 0, 0] * np.trace(normal[:, 1:, 1:], axis1=1, axis2=2) ** 2 / 4, 1e-300)
+        fit_ok = (n_bulk >= 3) & (np.abs(np.linalg.det(normal)) > 1e-8 * scale)
+        # applied gradients where the fit is not possible
+        grads = np.broadcast_to(loads, (n_coarse, n_loads, 2)).copy()
+        if np.any(fit_ok):
+            coef = np.linalg.solve(normal[fit_ok], rhs[fit_ok])
+            grads[fit_ok] = coef[:, 1:3, :].transpose(0, 2, 1)
+
+        # -u = C grad p, as for the applied loads
+        load_grads = np.broadcast_to(loads, (n_coarse, n_loads, 2))
+        cond = self.fit_symmetric(grads, fluxes)
+        e_min = np.linalg.eigvalsh(cond)[:, 0]
+        fallback = ~(e_min > 0)
+        if np.any(fallback):
+            cond[fallback] = self.fit_symmetric(load_grads[fallback], fluxes[fallback])
+        if not np.all(has_data):
+            cond[~has_data] = np.mean(cond[has_data], axis=0)
+        print("Coarse elements: {} gradient fit fallback: {} tensor fallback: {} empty: {}".format(
+            n_coarse, np.sum(~fit_ok), np.sum(fallback), np.sum(~has_data)))
+
+        self.cond_tensors = {}
+        for eid, center, tn in zip(coarse_eids, coarse_centers, cond):
+            self.group_positions[eid] = center
+            self.cond_tensors[eid] = tn
+        return self.cond_tensors
+
+    def summary(self):
+        return dict(
+            pos=[self.group_positions[eid].tolist() for eid in self.cond_tensors.keys()],
+            cond_tn=[self.cond_tensors[eid].tolist() for eid in self.cond_tensors.keys()]
+        )
+
+    def metrics(self):
+        return dict(n_groups=len(self.cond_tensors) if self.cond_tensors is not None else 0)
+
+
+# Data of the microscale cell tasks in a worker process, set by `_init_cells`,
+# so it is pickled once per worker and not for every batch.
+_cells_context = {}
+
+
+def _init_cells(context):
+    """
+    Initializer of the MicroscaleCells worker processes.
+    """
+    _cells_context.clear()
+    _cells_context.update(context)
+
+
+def _solve_cells(basename, eids):
+    """
+    Worker of MicroscaleCells: mesh, fields, flow and effective tensors for a batch of coarse elements.
+    Every worker has a single core, Flow123d runs without MPI.
+    :return: {eid: (position, conductivity_tensor)}
+    """
+    ctx = _cells_context
+    start = time.time()
+    config_dict = dict(ctx['config_dict'], flow_mpi=None)
+    problem = FlowProblem(ctx['i_level'], basename, ctx['fr_range'], ctx['fractures'], ctx['bulk_model'],
+                          config_dict, role="coarse_ref")
+    problem.elementwise_mesh(ctx['coarse_mesh'], ctx['mesh_step'], ctx['outer_polygon'], eids=eids)
+    problem.make_fields()
+    problem.run().join()
+    cond_tensors = problem.effective_tensor()
+    # measured cost, used to tune the cost model of MicroscaleCells.batch_size
+    print("Batch {}, cells: {} elements: {} time: {}".format(basename, len(eids), len(problem.mesh.elements),
+                                                             time.time() - start))
+    return {eid: (problem.group_positions[eid], tn) for eid, tn in cond_tensors.items()}
+
+
+class MicroscaleCells:
+    """
+    Microscale problems of the coarse elements solved independently for batches of cells
+    in a pool of spawned processes (`coarse_upscaling: cells`), a core of the sample per process. Every batch is meshed and solved
+    as its own coarse_ref problem. Cells of a failed batch are repeated one by one,
+    cells failing alone get the mean tensor of the others.
+    """
+    def __init__(self, i_level, fr_range, fractures, fine_flow, config_dict):
+        self.basename = "coarse_ref"
+        self.i_level = i_level
+        self.fr_range = fr_range
+        self.fractures = fractures
+        self.fine_flow = fine_flow
+        self.config_dict = config_dict
+        self.group_positions = {}
+        self.cond_tensors = {}
+        # statistics of the last `solve`
+        self.n_batches = None
+        self.n_failed = None
+
+    def batch_size(self, coarse_mesh, eids, mesh_step, n_workers):
+        """
+        Number of cells packed into one microscale problem. Either given by `microscale_cells.batch_size`
+        or 'auto', the cost model of a single run:
+            time = run_overhead + element_cost * n_elements
+        The batch is the smallest one with the overhead below `overhead_fraction` of the run time,
+        but not larger than needed to keep all workers busy.
+        """
+        options = self.config_dict.get('microscale_cells', {})
+        batch_size = options.get('batch_size', 1)
+        if batch_size != 'auto':
+            return max(1, int(batch_size))
+        run_overhead = float(options.get('run_overhead', 2.0))
+        element_cost = float(options.get('element_cost', 1e-4))
+        overhead_fraction = float(options.get('overhead_fraction', 0.2))
+        # elements of a cell estimated from the areas and the equilateral triangle of the mesh step
+        areas = [polygon_area([coarse_mesh.nodes[nid][0:2] for nid in coarse_mesh.elements[eid][2]]) for eid in eids]
+        cell_elements = max(1.0, np.mean(areas) / (np.sqrt(3) / 4 * mesh_step ** 2))
+        cell_cost = element_cost * cell_elements
+        # run_overhead <= overhead_fraction * (run_overhead + batch * cell_cost)
+        min_batch = run_overhead * (1 - overhead_fraction) / (overhead_fraction * cell_cost)
+        max_batch = np.ceil(len(eids) / n_workers)
+        batch_size = int(max(1, min(np.ceil(min_batch), max_batch)))
+        print("Cost model, cell elements: {:.0f} batch size: {}".format(cell_elements, batch_size))
+        return batch_size
+
+    @staticmethod
+    def batches(eids, batch_size):
+        return [eids[i:i + batch_size] for i in range(0, len(eids), batch_size)]
+
+    def solve(self, coarse_problem, mesh_step, core_budget=None):
+        """
+        :param coarse_problem: FlowProblem with the coarse mesh.
+        :param mesh_step: Mesh step of the microscale problems.
+        :param core_budget: Optional CoreBudget of the sample, a core is taken for every worker.
+        """
+        coarse_mesh = coarse_problem.mesh
+        eids = [eid for eid, (tele, tags, nodes) in coarse_mesh.elements.items() if tele == 2]
+        options = self.config_dict.get('microscale_cells', {})
+        n_cores = self.config_dict.get('n_cores', 3)
+        n_workers = min(options.get('n_workers', None) or n_cores, n_cores)
+        if core_budget is not None:
+            n_workers = core_budget.acquire(n_workers)
+        try:
+            self._solve(coarse_problem, mesh_step, eids, n_workers)
+        finally:
+            if core_budget is not None:
+                core_budget.release(n_workers)
+
+    def _solve(self, coarse_problem, mesh_step, eids, n_workers):
+        coarse_mesh = coarse_problem.mesh
+        # Workers are spawned, not forked: the sample process has other stage threads possibly holding locks.
+        # The context is pickled once per worker, the bulk model with just the fine bulk tensors.
+        context = dict(i_level=self.i_level, fr_range=self.fr_range, fractures=self.fractures,
+                       bulk_model=BulkFromFine(self.fine_flow), config_dict=self.config_dict, coarse_mesh=coarse_mesh,
+                       mesh_step=mesh_step, outer_polygon=coarse_problem.outer_polygon)
+
+        batches = self.batches(eids, self.batch_size(coarse_mesh, eids, mesh_step, n_workers))
+        print("Microscale cells: {} batches: {} workers: {}".format(len(eids), len(batches), n_workers))
+        results = {}
+        with cf.ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                                    initializer=_init_cells, initargs=(context,)) as pool:
+            futures = {pool.submit(_solve_cells, "coarse_ref_b{:04d}".format(i), batch): batch
+                       for i, batch in enumerate(batches)}
+            retry = {}
+            for future in cf.as_completed(futures):
+                batch = futures[future]
+                try:
+                    results.update(future.result())
+                except Exception:
+                    print("Microscale batch failed, cells: ", batch)
+                    traceback.print_exc()
+                    if len(batch) > 1:
+                        for eid in batch:
+                            retry[pool.submit(_solve_cells, "coarse_ref_c{:06d}".format(eid), [eid])] = eid
+            for future in cf.as_completed(retry):
+                try:
+                    results.update(future.result())
+                except Exception:
+                    print("Microscale cell failed: ", retry[future])
+                    traceback.print_exc()
+
+        assert results, "All microscale cells failed."
+        mean_tn = np.mean([tn for pos, tn in results.values()], axis=0)
+        for eid in eids:
+            if eid in results:
+                pos, tn = results[eid]
+            else:
+                pos = np.mean([coarse_mesh.nodes[nid][0:2] for nid in coarse_mesh.elements[eid][2]], axis=0)
+                tn = mean_tn
+            self.group_positions[eid] = np.array(pos)
+            self.cond_tensors[eid] = tn
+        print("Microscale cells failed: ", len(eids) - len(results))
+        self.n_batches = len(batches)
+        self.n_failed = len(eids) - len(results)
+
+    def effective_tensor(self):
+        return self.cond_tensors
+
+    def summary(self):
+        return dict(
+            pos=[self.group_positions[eid].tolist() for eid in self.cond_tensors.keys()],
+            cond_tn=[self.cond_tensors[eid].tolist() for eid in self.cond_tensors.keys()]
+        )
+
+    def metrics(self):
+        return dict(n_groups=len(self.cond_tensors), n_batches=self.n_batches, n_failed=self.n_failed)
 
 
 class BothSample:
 
 
-    def __init__(self, sample_config):
+    def __init__(self, sample_config, worker=False):
         """
         Attributes:
         seed,
@@ -822,9 +1737,11 @@ class BothSample:
         do_coarse
         config_path
         :param sample_config:
+        :param worker: Calculated by a persistent worker process after other samples, see `run_worker`.
         """
         # sample_config attributes:
         # finer_level_path - Path to the file with microscale tensors from the previous level. Used for sampling conductivity.
+        # finer_level_count - Number of the microscale tensors to use (tensor_store snapshot), None in older configs.
         # config_path
         # do_coarse
         # h_coarse_step
@@ -832,10 +1749,17 @@ class BothSample:
         # seed
         # i_level
 
+        self.finer_level_count = None
+        self.worker = worker
         self.__dict__.update(sample_config)
+        self.sample_config = sample_config
         np.random.seed(self.seed)
         with open(self.config_path, "r") as f:
             self.config_dict = yaml.load(f) # , Loader=yaml.FullLoader
+        # checkpoint.StageMarkers, created by `calculate` in the sample directory
+        self.stages = None
+        # profiling.Profiler, set by `run` if the profiling is enabled
+        self.profiler = None
 
     def generate_fractures(self):
         geom = self.config_dict["geometry"]
@@ -869,49 +1793,240 @@ class BothSample:
         fr_set = fracture.Fractures(fractures, fr_size_range[0] / 2)
         return fr_set
 
-    def make_summary(self, done_list):
+    fractures_file = "fractures.pkl"
+
+    def save_fractures(self, fr_set):
+        """
+        Store the generated fractures together with the state of the random generator,
+        so the resumed sample draws the same fields.
+        """
+        with checkpoint.atomic_open(self.fractures_file, "wb") as f:
+            pickle.dump((fr_set.fractures, fr_set.epsilon, np.random.get_state()), f)
+        return fr_set
+
+    def load_fractures(self):
+        with open(self.fractures_file, "rb") as f:
+            fractures, epsilon, rng_state = pickle.load(f)
+        np.random.set_state(rng_state)
+        return fracture.Fractures(fractures, epsilon)
+
+    @staticmethod
+    def tensor_data(problem):
+        """
+        Effective tensors and group positions of the problem as plain lists, stored in the stage marker.
+        """
+        eids = list(problem.cond_tensors.keys())
+        return dict(eids=[int(eid) for eid in eids],
+                    pos=[np.asarray(problem.group_positions[eid], dtype=float).tolist() for eid in eids],
+                    cond_tn=[np.asarray(problem.cond_tensors[eid], dtype=float).tolist() for eid in eids])
+
+    @staticmethod
+    def restore_tensors(problem, data):
+        for eid, pos in zip(data['eids'], data['pos']):
+            problem.group_positions[eid] = np.array(pos)
+        problem.cond_tensors = {eid: np.array(tn) for eid, tn in zip(data['eids'], data['cond_tn'])}
+        return problem.cond_tensors
+
+    def add_stage(self, graph, name, fn, deps=(), stage_deps=None, outputs=(), restore=None, tensors_of=None):
+        """
+        Add the task to the graph as a checkpointed stage of the same name, see `checkpoint.StageMarkers.run`.
+        :param deps: Graph dependencies.
+        :param stage_deps: Stages the inputs key depends on, `deps` by default.
+        :param outputs: Output files of the stage.
+        :param restore: Called instead of `fn` when the stage is done, `fn` by default.
+            Should just load the outputs, as `fn` does when they exist.
+        :param tensors_of: The stage computes effective tensors of this problem, these are stored in the marker
+            and restored when the stage is done.
+        """
+        stage_deps = list(deps) if stage_deps is None else stage_deps
+        save = None
+        if tensors_of is not None:
+            save = lambda result: self.tensor_data(tensors_of)
+            restore = lambda data: self.restore_tensors(tensors_of, data)
+        elif restore is None:
+            restore = lambda data: fn()
+        else:
+            restore_fn = restore
+            restore = lambda data: restore_fn()
+        graph.add(name, lambda: self.stages.run(name, fn, deps=stage_deps, outputs=outputs,
+                                                restore=restore, save=save), list(deps))
+
+    @staticmethod
+    def flow_stages(problem):
+        """
+        Names of the stage markers of the Flow123d runs of the problem.
+        """
+        return ["flow_" + out_dir for out_dir, _ in problem.flow_runs()]
+
+    def level_model(self, i_level):
+        """
+        Model of the level: 'flow123d' (default) or 'pipe_network'.
+        """
+        return self.config_dict['levels'][i_level].get('model', 'flow123d')
+
+    def make_summary(self, done_list, metrics):
+        """
+        Write the binary sample summary 'summary.npz' (see sample_summary.py),
+        the YAML summary 'summary.yaml' only with the `summary_yaml` config key.
+        :param metrics: Cost metrics of the sample, see `sample_metrics`. Added to the summary under the 'metrics' key
+            together with the size and run statistics of the problems.
+        """
         results = {problem.basename: problem.summary() for problem in done_list}
-        with open("summary.yaml", "w") as f:
-            yaml.dump(results, f)
+        metrics['problems'] = {problem.basename: problem.metrics() for problem in done_list}
+        sample_summary.write(results, metrics, export_yaml=self.config_dict.get('summary_yaml', False))
 
+    @staticmethod
+    def sample_metrics(start, stage_stats, runs, worker=False):
+        """
+        Wall and CPU time of the sample and of its stages, peak RSS of the sample process and of its Flow123d runs.
+        CPU of the children (Flow123d, gmsh, microscale workers) is counted separately,
+        CPU of a stage is just the time of its thread.
+        The process peak is a lifetime high-water mark, for a persistent worker (`worker`) it covers
+        the previous samples as well and it is reported as 'worker_peak_rss_mb' instead of 'peak_rss_mb'.
+        :param start: os.times() at the start of the sample.
+        :param stage_stats: {stage: dict(start, wall, cpu, process_peak_rss_mb)}
+        :param runs: Statistics of the Flow123d runs of the sample (FlowThread.stats).
+        """
+        end = os.times()
+        run_peaks = [run['peak_rss_mb'] for run in runs if 'peak_rss_mb' in run]
+        return {
+            'wall': end.elapsed - start.elapsed,
+            'cpu': (end.user + end.system) - (start.user + start.system),
+            'children_cpu': (end.children_user + end.children_system) - (start.children_user + start.children_system),
+            'worker_peak_rss_mb' if worker else 'peak_rss_mb': task_graph.peak_rss_mb(),
+            'children_peak_rss_mb': max(run_peaks, default=0.0),
+            'stages': stage_stats}
+
+
+    def run(self):
+        """
+        Calculate the sample, profiled if enabled by SAMPLE_PROFILE or by the `profile` config key.
+        The profiles are written into the sample directory, see profiling.py.
+        """
+        if profiling.enabled(self.config_dict):
+            self.profiler = profiling.Profiler("profile")
+            self.profiler.run(self.calculate)
+        else:
+            self.calculate()
 
     def calculate(self):
-        fractures = self.generate_fractures()
-        # fine problem
-        fine_flow = FlowProblem.make_fine(self.i_level, (self.h_fine_step, np.inf), fractures, self.finer_level_path, self.config_dict)
-        fine_flow.make_mesh()
-        fine_flow.make_fields()
-        fine_flow.run()
+        """
+        Sample stages are executed by a TaskGraph, following their real dependencies:
+
+        fractures -> fine mesh -> fine fields -> fine flow -> fine tensor
+                  -> coarse mesh -> coarse_ref mesh
+        {coarse_ref mesh, fine fields} -> coarse_ref fields -> coarse_ref flow -> coarse_ref tensor
+        {coarse_ref tensor, coarse mesh} -> coarse fields -> coarse flow -> coarse tensor
+
+        With `coarse_upscaling: fine_solution` the coarse_ref problem is replaced by FineSolutionUpscaling,
+        the coarse fields then wait just for the fine flow. With `coarse_upscaling: cells` the coarse_ref
+        mesh and flow are replaced by MicroscaleCells.
+
+        Fractures are generated first as all problems are constructed from them.
+        Levels with `choose_from_finer_level` sample the bulk from the microscale tensors of the finer level,
+        the size of the pool is fixed at the sample start unless given by `finer_level_count` of the sample config.
+        Fields of the fine problem are the only stage drawing random numbers.
+        Flow123d runs take their MPI processes from the `n_cores` reserved for the sample.
+
+        Levels with `model: pipe_network` use the reduced PipeNetworkProblem instead,
+        for the fine problem of such level and for the coarse problem of the next finer level.
+
+        Stages are checkpointed (checkpoint.py), the markers are in the 'stages' directory of the sample.
+        A resubmitted sample reuses the outputs of the done stages: fractures (with the random generator state),
+        meshes, fields files, every Flow123d run and the effective tensors. The decomposition
+        is part of the mesh stage, it is skipped whenever the mesh file is reused.
+        """
+        start_times = os.times()
+        self.stages = checkpoint.StageMarkers(mesh_cache.make_key(self.sample_config, self.config_dict))
+        graph = task_graph.TaskGraph(wrap=None if self.profiler is None else self.profiler.wrap)
+        fractures = graph.measure('fractures', lambda: self.stages.run(
+            'fractures', lambda: self.save_fractures(self.generate_fractures()),
+            outputs=[self.fractures_file], restore=lambda data: self.load_fractures()))
+        if self.finer_level_path is not None and self.finer_level_count is None:
+            # pool of the microscale tensors stored when the sample starts, kept if the sample is resumed
+            self.finer_level_count = self.stages.run(
+                'finer_level_pool', lambda: tensor_store.pool_size(self.finer_level_path),
+                save=lambda n_tensors: int(n_tensors), restore=lambda n_tensors: n_tensors)
+        cores = CoreBudget(self.config_dict.get('n_cores', 3))
         done = []
+        # fine problem
+        if self.level_model(self.i_level) == 'pipe_network':
+            import pipe_network
+            fine_flow = pipe_network.PipeNetworkProblem.make(
+                "fine", self.i_level, (self.h_fine_step, np.inf), fractures, self.finer_level_path, self.config_dict,
+                self.finer_level_count)
+            graph.add('fine_tensor', fine_flow.effective_tensor)
+        else:
+            fine_flow = FlowProblem.make_fine(self.i_level, (self.h_fine_step, np.inf), fractures, self.finer_level_path,
+                                              self.config_dict, self.finer_level_count)
+            fine_flow.stages = self.stages
+            self.add_stage(graph, 'fine_mesh', fine_flow.make_mesh, stage_deps=['fractures'],
+                           outputs=[mesh_file("fine")])
+            self.add_stage(graph, 'fine_fields', fine_flow.make_fields, ['fine_mesh'],
+                           outputs=[fields_file("fine")], restore=fine_flow.load_fields)
+            graph.add('fine_flow', lambda: fine_flow.run(cores).join(), ['fine_fields'])
+            self.add_stage(graph, 'fine_tensor', fine_flow.effective_tensor, ['fine_flow'],
+                           stage_deps=self.flow_stages(fine_flow), tensors_of=fine_flow)
         # coarse problem
-        if self.do_coarse:
-            coarse_ref = FlowProblem.make_microscale(self.i_level, (self.h_fine_step, self.h_coarse_step), fractures, fine_flow, self.config_dict)
+        if self.do_coarse and self.level_model(self.i_level - 1) == 'pipe_network':
+            import pipe_network
+            coarse_flow = pipe_network.PipeNetworkProblem.make(
+                "coarse", self.i_level - 1, (self.h_coarse_step, np.inf), fractures, None, self.config_dict)
+            graph.add('coarse_tensor', coarse_flow.effective_tensor)
+            done.append(coarse_flow)
+        elif self.do_coarse:
+            upscaling = self.config_dict.get('coarse_upscaling', 'coarse_ref')
+            if upscaling == 'fine_solution':
+                coarse_ref = FineSolutionUpscaling(fine_flow, self.h_coarse_step)
+                fine_flow.need_fields = True
+            elif upscaling == 'cells':
+                coarse_ref = MicroscaleCells(self.i_level, (self.h_fine_step, self.h_coarse_step), fractures, fine_flow, self.config_dict)
+            else:
+                coarse_ref = FlowProblem.make_microscale(self.i_level, (self.h_fine_step, self.h_coarse_step), fractures, fine_flow, self.config_dict)
+                coarse_ref.stages = self.stages
             coarse_flow = FlowProblem.make_coarse(self.i_level, (self.h_coarse_step, np.inf), fractures, coarse_ref, self.config_dict)
-
-            # coarse mesh
-            coarse_flow.make_fracture_network()
-            coarse_flow.make_mesh()
-
-            # microscale mesh and run
-            #coarse_ref.make_fracture_network()
-            coarse_ref.elementwise_mesh(coarse_flow.mesh, self.h_fine_step,  coarse_flow.outer_polygon)
-            coarse_ref.make_fields()
-            coarse_ref.run().join()
+            coarse_flow.stages = self.stages
+
+            def coarse_mesh():
+                coarse_flow.make_fracture_network()
+                coarse_flow.make_mesh()
+            self.add_stage(graph, 'coarse_mesh', coarse_mesh, stage_deps=['fractures'], outputs=[mesh_file("coarse")])
+
+            if upscaling == 'fine_solution':
+                # coarse element tensors fitted to the fine solution
+                coarse_ref.coarse_problem = coarse_flow
+                self.add_stage(graph, 'coarse_ref_tensor', coarse_ref.effective_tensor, ['fine_flow', 'coarse_mesh'],
+                               stage_deps=self.flow_stages(fine_flow) + ['coarse_mesh'], tensors_of=coarse_ref)
+            elif upscaling == 'cells':
+                # independent microscale problems for batches of coarse elements
+                self.add_stage(graph, 'coarse_ref_tensor', lambda: coarse_ref.solve(coarse_flow, self.h_fine_step, cores),
+                               ['coarse_mesh', 'fine_fields'], tensors_of=coarse_ref)
+            else:
+                # microscale mesh and run
+                self.add_stage(graph, 'coarse_ref_mesh',
+                               lambda: coarse_ref.elementwise_mesh(coarse_flow.mesh, self.h_fine_step, coarse_flow.outer_polygon),
+                               ['coarse_mesh'], outputs=[mesh_file("coarse_ref")])
+                self.add_stage(graph, 'coarse_ref_fields', coarse_ref.make_fields, ['coarse_ref_mesh', 'fine_fields'],
+                               outputs=[fields_file("coarse_ref")], restore=coarse_ref.load_fields)
+                graph.add('coarse_ref_flow', lambda: coarse_ref.run(cores).join(), ['coarse_ref_fields'])
+                self.add_stage(graph, 'coarse_ref_tensor', coarse_ref.effective_tensor, ['coarse_ref_flow'],
+                               stage_deps=self.flow_stages(coarse_ref), tensors_of=coarse_ref)
             done.append(coarse_ref)
 
-            # coarse fields and run
-            coarse_flow.make_fields()
-            coarse_flow.run()
-            coarse_flow.thread.join()
+            # coarse fields (use coarse_ref tensors) and run
+            self.add_stage(graph, 'coarse_fields', coarse_flow.make_fields, ['coarse_ref_tensor', 'coarse_mesh'],
+                           outputs=[fields_file("coarse")], restore=coarse_flow.load_fields)
+            graph.add('coarse_flow', lambda: coarse_flow.run(cores).join(), ['coarse_fields'])
+            self.add_stage(graph, 'coarse_tensor', coarse_flow.effective_tensor, ['coarse_flow'],
+                           stage_deps=self.flow_stages(coarse_flow), tensors_of=coarse_flow)
             done.append(coarse_flow)
-            coarse_flow.effective_tensor_from_bulk()
-        fine_flow.thread.join()
         done.append(fine_flow)
-        fine_flow.effective_tensor_from_bulk()
-        self.make_summary(done)
-
-
-
+        graph.run(n_workers=self.config_dict.get('sample_workers', 1))
+        runs = [thread.stats for problem in done for thread in getattr(problem, 'threads', [])]
+        metrics = self.sample_metrics(start_times, graph.stats, runs, self.worker)
+        metrics['n_fractures'] = len(fractures.fractures)
+        metrics['finer_level_count'] = self.finer_level_count
+        self.make_summary(done, metrics)
 
 
 
@@ -924,10 +2039,89 @@ class BothSample:
 def finished(start_time):
     sample_time = time.time() - start_time
     time.sleep(1)
-    with open("FINISHED", "w") as f:
+    with checkpoint.atomic_open("FINISHED", "w") as f:
         f.write(f"done\n{sample_time}")
+    # CWD is the sample directory in the level directory
+    sample_summary.append_journal("..", os.path.basename(os.getcwd()), sample_time)
+
+
+@contextlib.contextmanager
+def redirect_output(log_path):
+    """
+    Redirect the stdout and stderr file descriptors into the log file, including the output
+    of the threads and the child processes (gmsh). Restored on exit.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = [os.dup(1), os.dup(2)]
+    with open(log_path, "w") as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, saved_fd in zip([1, 2], saved_fds):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+
+
+def run_sample(sample_dir, sample_config="sample_config.yaml"):
+    """
+    Calculate a single sample in the worker process, isolated from the other samples:
+    the sample directory is the CWD, output goes to its 'both_sample_out' log,
+    the random generator is seeded by the sample config (see BothSample).
+    The FINISHED file is written even if the calculation fails, as by the single sample script.
+    """
+    start_time = time.time()
+    orig_cwd = os.getcwd()
+    os.chdir(sample_dir)
+    try:
+        with redirect_output("both_sample_out"):
+            try:
+                with open(sample_config, "r") as f:
+                    sample_dict = yaml.load(f) # , Loader=yaml.FullLoader
+                BothSample(sample_dict, worker=True).run()
+            except Exception:
+                print("cwd: ", os.getcwd(), "sample config: ", sample_config)
+                traceback.print_exc()
+            finished(start_time)
+    finally:
+        os.chdir(orig_cwd)
+
+
+def run_worker(samples_file):
+    """
+    Persistent worker, calculates the samples listed in the `samples_file` (one directory per line)
+    one by one in the same process, so the interpreter start-up and the imports are paid once.
+    The file is read again after every sample, samples appended meanwhile are processed as well (a queue).
+    Samples with the FINISHED file are skipped.
+    """
+    done = set()
+    while True:
+        with open(samples_file, "r") as f:
+            sample_dirs = [line.strip() for line in f if line.strip()]
+        todo = [d for d in sample_dirs if d not in done]
+        if not todo:
+            break
+        sample_dir = todo[0]
+        done.add(sample_dir)
+        if os.path.exists(os.path.join(sample_dir, "FINISHED")):
+            continue
+        print("Sample: ", sample_dir, flush=True)
+        start_time = time.time()
+        run_sample(sample_dir)
+        print("Sample time: ", time.time() - start_time, flush=True)
+
 
 if __name__ == "__main__":
+    # both_sample.py sample_config.yaml - single sample in CWD
+    # both_sample.py --worker samples.txt - persistent worker, see `run_worker`
+    if sys.argv[1] == "--worker":
+        run_worker(sys.argv[2])
+        sys.exit(0)
+
     start_time = time.time()
     atexit.register(finished, start_time)
     sample_config = sys.argv[1]
@@ -938,6 +2132,4 @@ if __name__ == "__main__":
         print("cwd: ", os.getcwd(), "sample config: ", sample_config)
 
     bs = BothSample(sample_dict)
-    bs.calculate()
-
-
+    bs.run()
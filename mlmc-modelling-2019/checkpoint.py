@@ -0,0 +1,111 @@
+"""
+Stage markers of a sample calculation, used to resume a killed sample at the first incomplete stage.
+
+A marker file is written after a stage is finished. It contains the key of the stage inputs,
+the list of the output files and optional small data (e.g. effective tensors).
+The stage is done if the marker exists, its key matches and all its outputs exist.
+The key of a stage includes the stamps of the stages it depends on, so a rerun stage
+invalidates all the stages depending on it.
+
+Outputs of the stages are written through `atomic_open`, so there are no half-written files
+after a kill. Files written by external programs (Flow123d) are valid only with their marker.
+"""
+import os
+import contextlib
+import threading
+import uuid
+import yaml
+
+import mesh_cache
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode="w"):
+    """
+    Open a temporary file for writing, rename it to `path` after successful close.
+    The temporary file is removed on an exception.
+    """
+    tmp_path = "{}.{}_{}.tmp".format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class StageMarkers:
+    def __init__(self, sample_key, marker_dir="stages"):
+        """
+        :param sample_key: Key of the inputs common to all stages of the sample (sample and main config).
+        :param marker_dir: Directory of the marker files, relative to the sample directory.
+        """
+        self.sample_key = sample_key
+        self.marker_dir = marker_dir
+        os.makedirs(marker_dir, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.marker_dir, name + ".yaml")
+
+    def _read(self, name):
+        try:
+            with open(self._path(name), "r") as f:
+                return yaml.safe_load(f)
+        except FileNotFoundError:
+            return None
+
+    def key(self, name, inputs=(), deps=()):
+        """
+        :param inputs: Stage specific inputs, see `mesh_cache.make_key`.
+        :param deps: Names of the stages the stage depends on, these must be done.
+        :return: Key of the stage inputs.
+        """
+        stamps = [self.stamp(dep) for dep in deps]
+        return mesh_cache.make_key(self.sample_key, name, inputs, stamps)
+
+    def stamp(self, name):
+        """
+        Unique stamp of the last execution of the stage, None if the stage is not done.
+        """
+        marker = self._read(name)
+        return None if marker is None else marker['stamp']
+
+    def is_done(self, name, key):
+        marker = self._read(name)
+        if marker is None or marker['key'] != key:
+            return False
+        return all(os.path.exists(path) for path in marker['outputs'])
+
+    def data(self, name):
+        return self._read(name)['data']
+
+    def reset(self, name, outputs=()):
+        """
+        Remove the marker and the (possibly incomplete) outputs of the stage before it is executed.
+        """
+        for path in [self._path(name)] + list(outputs):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def mark(self, name, key, outputs=(), data=None):
+        marker = dict(key=key, stamp=uuid.uuid4().hex, outputs=list(outputs), data=data)
+        with atomic_open(self._path(name)) as f:
+            yaml.safe_dump(marker, f)
+
+    def run(self, name, fn, inputs=(), deps=(), outputs=(), restore=None, save=None):
+        """
+        Execute the stage unless it is done.
+        :param fn: Stage function, its result is returned.
+        :param outputs: Output files of the stage.
+        :param restore: Called with the stored data instead of `fn` if the stage is done, its result is returned.
+        :param save: Converts the result of `fn` to the data stored in the marker (plain YAML types).
+        """
+        key = self.key(name, inputs, deps)
+        if self.is_done(name, key):
+            print("Stage done: ", name)
+            return None if restore is None else restore(self.data(name))
+        self.reset(name, outputs)
+        result = fn()
+        self.mark(name, key, outputs, None if save is None else save(result))
+        return result
@@ -0,0 +1,96 @@
+"""
+Lightweight in-process Darcy flow solver for small 2D problems with 1D fractures.
+
+Conforming P1 (linear Lagrange) pressure on triangles. Fracture line elements share nodes
+with the triangles (the fractures are embedded into the mesh), their contribution is weighted
+by the cross-section. Element velocities are piecewise constant, as `velocity_p0` of Flow123d.
+Pressure on the outer boundary is the Dirichlet condition p = load . x.
+"""
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+
+
+class DarcySolver2d:
+    def __init__(self, nodes, triangles, tri_cond, lines, line_cond, line_cs, dirichlet_nodes):
+        """
+        :param nodes: Node coordinates, shape (n_nodes, 2).
+        :param triangles: Node indices of triangles, shape (n_tri, 3).
+        :param tri_cond: Conductivity tensors of triangles, shape (n_tri, 2, 2).
+        :param lines: Node indices of fracture elements, shape (n_lines, 2).
+        :param line_cond: Conductivity of fracture elements in their direction, shape (n_lines,).
+        :param line_cs: Cross-section of fracture elements, shape (n_lines,).
+        :param dirichlet_nodes: Indices of the nodes on the outer boundary.
+        """
+        self.nodes = np.asarray(nodes, dtype=float)[:, 0:2]
+        self.triangles = np.asarray(triangles, dtype=int).reshape(-1, 3)
+        self.tri_cond = np.asarray(tri_cond, dtype=float).reshape(-1, 2, 2)
+        self.lines = np.asarray(lines, dtype=int).reshape(-1, 2)
+        self.line_cond = np.asarray(line_cond, dtype=float)
+        self.line_cs = np.asarray(line_cs, dtype=float)
+
+        n_nodes = len(self.nodes)
+        used = np.zeros(n_nodes, dtype=bool)
+        used[self.triangles.ravel()] = True
+        used[self.lines.ravel()] = True
+        is_dirichlet = np.zeros(n_nodes, dtype=bool)
+        is_dirichlet[np.asarray(dirichlet_nodes, dtype=int)] = True
+        is_dirichlet &= used
+        assert np.any(is_dirichlet), "No Dirichlet nodes."
+        self.dirichlet = np.nonzero(is_dirichlet)[0]
+        self.free = np.nonzero(used & ~is_dirichlet)[0]
+
+        self._make_triangle_gradients()
+        self._make_line_geometry()
+        matrix = self._assemble(n_nodes)
+        self.matrix_fd = matrix[self.free, :][:, self.dirichlet]
+        self.lu = spla.splu(matrix[self.free, :][:, self.free].tocsc())
+
+    def _make_triangle_gradients(self):
+        x = self.nodes[self.triangles]          # (n_tri, 3, 2)
+        jac = np.stack([x[:, 1] - x[:, 0], x[:, 2] - x[:, 0]], axis=2)  # columns are the triangle sides
+        self.tri_area = 0.5 * np.abs(np.linalg.det(jac))
+        ref_grad = np.array([[-1.0, 1.0, 0.0], [-1.0, 0.0, 1.0]])
+        # gradients of the barycentric basis functions, shape (n_tri, 2, 3)
+        self.tri_grad = np.linalg.inv(jac).transpose(0, 2, 1) @ ref_grad
+
+    def _make_line_geometry(self):
+        x = self.nodes[self.lines]               # (n_lines, 2, 2)
+        diff = x[:, 1] - x[:, 0]
+        self.line_length = np.linalg.norm(diff, axis=1)
+        self.line_tangent = diff / self.line_length[:, None]
+
+    def _assemble(self, n_nodes):
+        local = np.einsum('t,tai,tab,tbj->tij', self.tri_area, self.tri_grad, self.tri_cond, self.tri_grad)
+        rows = [np.repeat(self.triangles, 3, axis=1).ravel()]
+        cols = [np.tile(self.triangles, (1, 3)).ravel()]
+        values = [local.ravel()]
+
+        conductance = self.line_cs * self.line_cond / self.line_length
+        line_local = conductance[:, None, None] * np.array([[1.0, -1.0], [-1.0, 1.0]])[None, :, :]
+        rows.append(np.repeat(self.lines, 2, axis=1).ravel())
+        cols.append(np.tile(self.lines, (1, 2)).ravel())
+        values.append(line_local.ravel())
+
+        return sp.coo_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(n_nodes, n_nodes)).tocsr()
+
+    def solve(self, loads):
+        """
+        Solve the problem for given pressure gradients.
+        :param loads: Array (n_loads, 2) of the pressure gradients applied on the boundary.
+        :return: (pressure, tri_velocity, line_velocity); arrays of shapes
+            (n_loads, n_nodes), (n_loads, n_tri, 2), (n_loads, n_lines, 2)
+        """
+        loads = np.asarray(loads, dtype=float).reshape(-1, 2)
+        pressure = np.zeros((len(loads), len(self.nodes)))
+        pressure[:, self.dirichlet] = loads @ self.nodes[self.dirichlet].T
+        rhs = -(self.matrix_fd @ pressure[:, self.dirichlet].T)
+        pressure[:, self.free] = self.lu.solve(np.asarray(rhs)).T
+
+        tri_grad_p = np.einsum('tai,lti->lta', self.tri_grad, pressure[:, self.triangles])
+        tri_velocity = -np.einsum('tab,ltb->lta', self.tri_cond, tri_grad_p)
+        p_lines = pressure[:, self.lines]
+        dp_ds = (p_lines[:, :, 1] - p_lines[:, :, 0]) / self.line_length[None, :]
+        line_velocity = -(self.line_cond[None, :] * dp_ds)[:, :, None] * self.line_tangent[None, :, :]
+        return pressure, tri_velocity, line_velocity
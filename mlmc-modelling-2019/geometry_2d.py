@@ -37,6 +37,7 @@ src_path = os.path.dirname(os.path.abspath(__file__))
 from bgem.gmsh import gmsh_io
 from bgem.bspline import brep_writer as bw
 from bgem.polygons import polygons
+import checkpoint
 
 class ShapeInfo:
     # count_by_dim = [0,0,0,0]
@@ -343,11 +344,14 @@ class Geometry2d:
             gmsh_path = "gmsh"
         #call([gmsh_path, "-3", "-rand 1e-10", self.geo_file])
         #call([gmsh_path, "-2", "-format", "msh2", self.geo_file])
+        self.tmp_msh_file = self.basename + ".tmp.msh"
+        # do not accept the mesh of an interrupted run
+        if os.path.exists(self.tmp_msh_file):
+            os.remove(self.tmp_msh_file)
         try:
             subprocess.run([gmsh_path, "-2", "-format", "msh2", self.geo_file], check=True)
         except subprocess.CalledProcessError as e:
             traceback.print_exc()
-        self.tmp_msh_file = self.basename + ".tmp.msh"
         if not os.path.exists(self.tmp_msh_file):
             assert False, "Meshing failed"
         return self.tmp_msh_file
@@ -383,7 +387,7 @@ class Geometry2d:
             new_elements[id] = (el_type, tags, nodes)
         self.mesh.elements = new_elements
         self.msh_file = self.basename + ".msh"
-        with open(self.msh_file, "w") as f:
+        with checkpoint.atomic_open(self.msh_file, "w") as f:
             self.mesh.write_ascii(f)
         return self.mesh
 
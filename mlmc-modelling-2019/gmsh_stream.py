@@ -0,0 +1,151 @@
+"""
+Selective streaming reader of the GMSH 2.2 files (ASCII or binary) produced by Flow123d.
+
+Unlike `bgem.gmsh.gmsh_io.GmshIO.read` it does not build the node and element dictionaries.
+Section headers are scanned, unneeded sections are skipped without parsing and
+only the requested `$ElementData` frames are read into NumPy arrays
+(memory mapped for the binary files).
+"""
+from typing import *
+import numpy as np
+import attr
+
+
+# Number of nodes for the GMSH element types, used to skip binary element blocks.
+_n_type_nodes = {1: 2, 2: 3, 3: 4, 4: 4, 5: 8, 6: 6, 7: 5, 8: 3, 9: 6, 11: 10, 15: 1}
+
+
+@attr.s(auto_attribs=True)
+class ElementDataFrame:
+    time_idx: int
+    # Time step index (the integer tag of the GMSH frame).
+    time: float
+    # Time of the frame.
+    ele_ids: np.array
+    # Element IDs, shape (N,).
+    values: np.array
+    # Field values, shape (N, n_components).
+
+
+class GmshStream:
+    def __init__(self, fname):
+        self.fname = fname
+        self.binary = False
+        self.data_size = 8
+
+    def read_element_data(self, field_names, time_indices=None):
+        """
+        Read selected element fields from the file.
+        :param field_names: Names of the element fields to read, other fields are skipped.
+        :param time_indices: Optional {field_name: collection of time step indices};
+            only these frames of the field are read. All frames are read by default.
+        :return: {field_name: [ElementDataFrame, ...]}, frames sorted by the time step index.
+        """
+        if time_indices is None:
+            time_indices = {}
+        fields = {name: [] for name in field_names}
+        with open(self.fname, "rb") as f:
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                section = line.strip()
+                if section == b"$MeshFormat":
+                    self._read_format(f)
+                elif section == b"$Nodes":
+                    self._skip_nodes(f)
+                elif section == b"$Elements":
+                    self._skip_elements(f)
+                elif section == b"$ElementData":
+                    self._read_element_data(f, fields, time_indices)
+                elif section.startswith(b"$"):
+                    self._skip_to_end(f, section)
+        for frames in fields.values():
+            frames.sort(key=lambda frame: frame.time_idx)
+        return fields
+
+    def _read_format(self, f):
+        version, file_type, data_size = f.readline().split()
+        self.binary = int(file_type) == 1
+        self.data_size = int(data_size)
+        if self.binary:
+            one = np.frombuffer(f.read(4), dtype='<i4')[0]
+            assert one == 1, "Big endian binary GMSH files are not supported."
+            f.readline()
+        self._skip_to_end(f, b"$MeshFormat")
+
+    @staticmethod
+    def _skip_to_end(f, section):
+        end_tag = b"$End" + section[1:]
+        for line in f:
+            if line.strip() == end_tag:
+                return
+        raise EOFError("Missing {} in GMSH file.".format(end_tag))
+
+    @staticmethod
+    def _skip_lines(f, n_lines):
+        for i in range(n_lines):
+            f.readline()
+
+    def _skip_nodes(self, f):
+        n_nodes = int(f.readline())
+        if self.binary:
+            f.seek(n_nodes * (4 + 3 * self.data_size), 1)
+        else:
+            self._skip_lines(f, n_nodes)
+        self._skip_to_end(f, b"$Nodes")
+
+    def _skip_elements(self, f):
+        n_elements = int(f.readline())
+        if self.binary:
+            n_read = 0
+            while n_read < n_elements:
+                el_type, n_follow, n_tags = np.frombuffer(f.read(12), dtype='<i4')
+                f.seek(int(n_follow) * 4 * (1 + n_tags + _n_type_nodes[el_type]), 1)
+                n_read += n_follow
+        else:
+            self._skip_lines(f, n_elements)
+        self._skip_to_end(f, b"$Elements")
+
+    def _read_element_data(self, f, fields, time_indices):
+        n_str_tags = int(f.readline())
+        str_tags = [f.readline().strip().strip(b'"').decode() for i in range(n_str_tags)]
+        n_real_tags = int(f.readline())
+        real_tags = [float(f.readline()) for i in range(n_real_tags)]
+        n_int_tags = int(f.readline())
+        int_tags = [int(f.readline()) for i in range(n_int_tags)]
+        time_idx, n_comp, n_entries = int_tags[0:3]
+        time = real_tags[0] if real_tags else 0.0
+
+        name = str_tags[0]
+        selected = name in fields
+        if selected and name in time_indices:
+            selected = time_idx in time_indices[name]
+
+        if self.binary:
+            record = np.dtype([('id', '<i4'), ('values', '<f8', (n_comp,))])
+            if selected:
+                data = np.memmap(self.fname, dtype=record, mode='r', offset=f.tell(), shape=(n_entries,))
+                ele_ids = np.array(data['id'], dtype=int)
+                values = np.array(data['values']).reshape(n_entries, n_comp)
+                del data
+            f.seek(n_entries * record.itemsize, 1)
+        else:
+            if selected:
+                lines = [f.readline() for i in range(n_entries)]
+                table = np.fromstring(b"".join(lines).decode(), dtype=float, sep=' ')
+                table = table.reshape(n_entries, 1 + n_comp)
+                ele_ids = table[:, 0].astype(int)
+                values = table[:, 1:]
+            else:
+                self._skip_lines(f, n_entries)
+        if selected:
+            fields[name].append(ElementDataFrame(time_idx, time, ele_ids, values))
+        self._skip_to_end(f, b"$ElementData")
+
+
+def read_element_data(fname, field_names, time_indices=None):
+    """
+    Shortcut for `GmshStream(fname).read_element_data(...)`.
+    """
+    return GmshStream(fname).read_element_data(field_names, time_indices)
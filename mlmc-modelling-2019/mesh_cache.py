@@ -0,0 +1,155 @@
+"""
+Content addressed cache of the generated meshes, shared by all samples and levels.
+
+The cache key is a hash of everything the mesh depends on: the (regularized) fracture geometry,
+the mesh step, the domain and the mesher options. Cached meshes are reused by a hard link
+(symbolic link if the cache is on other file system), so the mesh files are never copied.
+Files in the cache are touched on every hit, the least recently used files are removed
+when the total size exceeds the limit. The sample files linked by a hard link survive the eviction.
+"""
+import os
+import glob
+import hashlib
+import shutil
+import threading
+import numpy as np
+
+
+def _update_hash(h, item, decimals):
+    """
+    Feed a nested structure of dicts, lists, arrays and scalars into the hash object.
+    Floats are rounded to `decimals` places to get the same key for the same geometry.
+    """
+    if isinstance(item, dict):
+        h.update(b"d")
+        for key in sorted(item.keys(), key=str):
+            _update_hash(h, key, decimals)
+            _update_hash(h, item[key], decimals)
+    elif isinstance(item, (list, tuple)):
+        h.update(b"l%d" % len(item))
+        for sub_item in item:
+            _update_hash(h, sub_item, decimals)
+    elif isinstance(item, np.ndarray):
+        if item.dtype.kind == 'f':
+            item = np.round(item, decimals) + 0.0  # no negative zeros
+        h.update(b"a" + str(item.shape).encode())
+        h.update(np.ascontiguousarray(item).tobytes())
+    elif isinstance(item, (float, np.floating)):
+        h.update(b"f" + repr(round(float(item), decimals) + 0.0).encode())
+    else:
+        h.update(b"s" + repr(item).encode())
+
+
+def make_key(*items, decimals=8):
+    """
+    :param items: Mesh inputs, nested dicts, lists, numpy arrays, numbers and strings.
+    :param decimals: Floats are rounded to this number of decimal places.
+    :return: Hex digest used as the cache key.
+    """
+    h = hashlib.sha1()
+    _update_hash(h, items, decimals)
+    return h.hexdigest()
+
+
+def file_digest(path):
+    """
+    Digest of a file content, e.g. of the mesher source with the hardwired mesh options.
+    """
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def link_file(src, dst):
+    """
+    Make `dst` a hard link to `src`, a symbolic link if the hard link is not possible.
+    Existing `dst` is replaced.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        os.symlink(os.path.abspath(src), dst)
+
+
+class MeshCache:
+    def __init__(self, cache_dir, max_size):
+        """
+        :param cache_dir: Shared cache directory, created if necessary.
+        :param max_size: Size limit of the cache in bytes.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def from_config(config_dict):
+        """
+        :return: MeshCache given by the `mesh_cache` config key, None if the cache is not used.
+        """
+        cache_config = config_dict.get('mesh_cache', None) or {}
+        cache_dir = cache_config.get('dir', None)
+        if not cache_dir:
+            return None
+        max_size = float(cache_config.get('max_size_gb', 10)) * 2**30
+        return MeshCache(os.path.abspath(cache_dir), max_size)
+
+    def path(self, key, suffix=".msh"):
+        return os.path.join(self.cache_dir, key + suffix)
+
+    def fetch(self, key, target, suffix=".msh"):
+        """
+        Link the cached file to `target`.
+        :return: True if the file was found in the cache.
+        """
+        cached = self.path(key, suffix)
+        if not os.path.exists(cached):
+            return False
+        try:
+            link_file(cached, target)
+        except FileNotFoundError:
+            # evicted meanwhile
+            if os.path.lexists(target):
+                os.remove(target)
+            return False
+        # LRU time stamp
+        os.utime(cached)
+        print("Mesh cache hit: ", target, key)
+        return True
+
+    def store(self, key, source, suffix=".msh"):
+        """
+        Put the file `source` into the cache. The cache entry appears atomically,
+        concurrent stores of the same key are harmless.
+        """
+        cached = self.path(key, suffix)
+        tmp_path = "{}.{}_{}.tmp".format(cached, os.getpid(), threading.get_ident())
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, cached)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used files until the cache size is within the limit.
+        """
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, "*")):
+            if path.endswith(".tmp"):
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
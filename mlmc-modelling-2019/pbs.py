@@ -1,17 +1,36 @@
 import os
 import os.path
+import re
 import shutil
 import subprocess
+import collections
+
+
+def parse_mem(mem):
+    """
+    :param mem: PBS memory limit, e.g. '8gb', '500mb'.
+    :return: Size in bytes.
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kmgt]?)b?\s*", mem.lower())
+    if match is None:
+        raise ValueError("Invalid memory limit: {}".format(mem))
+    value, unit = match.groups()
+    return float(value) * 1024 ** "bkmgt".index(unit or "b")
 
 
 class Pbs:
-    def __init__(self, work_dir=None, job_weight=200000, job_count=0, qsub=None, clean=False):
+    def __init__(self, work_dir=None, job_weight=200000, job_count=0, qsub=None, clean=False, worker_cmd=None,
+                 local_jobs=None):
         """
         :param work_dir: if None, means no logging and just direct execution.
         :param job_weight: Number of simulation elements per job script
         :param job_count: Number of created jobs
         :param qsub: string with qsub command.
         :param clean: bool, if True, create new scripts directory
+        :param worker_cmd: Optional command line of a persistent worker processing all samples of the job,
+            formatted with `samples_file`. The realization lines are not used then, just their `sample_dir`.
+        :param local_jobs: Number of jobs running in parallel without qsub, None - given by the local cores
+            and memory and by the `n_cores` and `mem` of the job, see `pbs_common_setting`.
         """
         # Weight of the single PBS script (putting more small jobs into single PBS job).
         self.job_weight = job_weight
@@ -30,6 +49,19 @@ class Pbs:
         self.qsub_cmd = qsub
         self._pbs_config = None
         self._pbs_header_template = None
+        # Persistent worker command and the sample directories of the current job.
+        self.worker_cmd = worker_cmd
+        self._job_samples = []
+        # Local execution (qsub is None): job scripts started asynchronously, at most `local_jobs` at once.
+        self.local_jobs = local_jobs
+        self._local_queue = collections.deque()
+        self._local_running = {}
+        # job script -> 'queued', 'running', 'done' or 'failed'
+        self.local_state = {}
+        # job script -> sample directories of the job
+        self.job_samples = {}
+        # sample directories of the ended local jobs not yet taken by `ended_samples`
+        self._ended_samples = []
 
         if self.work_dir is not None:
             self.work_dir = os.path.abspath(self.work_dir)
@@ -67,6 +99,8 @@ class Pbs:
         self._pbs_header_template.extend(('touch {pbs_output_dir}/RUNNING', 'rm -f {pbs_output_dir}/QUEUED'))
 
         self._pbs_config = kwargs
+        if self.local_jobs is None:
+            self.local_jobs = self.local_capacity(kwargs.get('n_cores', 1), kwargs.get('mem', None))
         self.clean_script()
 
     def add_realization(self, weight, lines, **kwargs):
@@ -89,8 +123,11 @@ class Pbs:
         #     'touch {output_subdir}/FINISHED',
         #     'echo \\"Finished simulation:\\" \\"{flow123d}\\" \\"{work_dir}\\" \\"{output_subdir}\\"',
         #     '']
-        lines = [line.format(**kwargs) for line in lines]
-        self.pbs_script.extend(lines)
+        if self.worker_cmd is None:
+            lines = [line.format(**kwargs) for line in lines]
+            self.pbs_script.extend(lines)
+        if 'sample_dir' in kwargs:
+            self._job_samples.append(kwargs['sample_dir'])
 
         self._number_of_realizations += 1
         self._current_job_weight += weight
@@ -107,6 +144,11 @@ class Pbs:
         """
         if self.pbs_script is None or self._number_of_realizations == 0:
             return
+        if self.worker_cmd is not None:
+            samples_file = os.path.join(self._job_dir, "samples.txt")
+            with open(samples_file, "w") as f:
+                f.write("\n".join(self._job_samples) + "\n")
+            self.pbs_script.append(self.worker_cmd.format(samples_file=samples_file))
         self.pbs_script.append("touch " + self._job_dir + "/FINISHED")
         self.pbs_script.append("rm -f " + self._job_dir + "/RUNNING")
 
@@ -114,6 +156,7 @@ class Pbs:
         pbs_file = os.path.join(self._job_dir, "{:04d}.sh".format(self._job_count))
 
         self._job_count += 1
+        self.job_samples[pbs_file] = self._job_samples
         with open(pbs_file, "w") as file_writer:
             file_writer.write(script_content)
 
@@ -122,7 +165,9 @@ class Pbs:
 
 
         if self.qsub_cmd is None:
-            subprocess.call(pbs_file)
+            self._local_queue.append(pbs_file)
+            self.local_state[pbs_file] = 'queued'
+            self.poll()
         else:
             process = subprocess.run([self.qsub_cmd, pbs_file], stderr=subprocess.PIPE, stdout=subprocess.PIPE)
             subprocess.call(["touch", os.path.join(self._job_dir, "QUEUED")])
@@ -134,6 +179,49 @@ class Pbs:
         self._current_job_weight = 0
         self._number_of_realizations = 0
 
+    @staticmethod
+    def local_capacity(n_cores, mem=None):
+        """
+        Number of jobs fitting the local machine by the cores and by the physical memory.
+        """
+        n_jobs = max(1, (os.cpu_count() or 1) // max(1, int(n_cores)))
+        if mem is not None:
+            total_mem = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+            n_jobs = min(n_jobs, max(1, int(total_mem // parse_mem(mem))))
+        return n_jobs
+
+    def poll(self):
+        """
+        Update the state of the local jobs, start the queued jobs as the running ones finish.
+        Called by `execute` and periodically by the caller waiting for the results.
+        :return: Number of the queued and running local jobs.
+        """
+        for pbs_file, process in list(self._local_running.items()):
+            if process.poll() is not None:
+                del self._local_running[pbs_file]
+                self.local_state[pbs_file] = 'done' if process.returncode == 0 else 'failed'
+                if process.returncode != 0:
+                    print("Job {} failed, exit code: {}".format(pbs_file, process.returncode))
+                # the script exits 0 even if its samples die, any ended job is terminal for its samples
+                self._ended_samples.extend(self.job_samples.get(pbs_file, []))
+        while self._local_queue and len(self._local_running) < self.local_jobs:
+            pbs_file = self._local_queue.popleft()
+            job_dir = os.path.dirname(pbs_file)
+            # output file as given to PBS by the script header
+            out_file = os.path.join(job_dir, os.path.basename(job_dir) + ".OU")
+            with open(out_file, "w") as out:
+                self._local_running[pbs_file] = subprocess.Popen(pbs_file, stdout=out, stderr=subprocess.STDOUT)
+            self.local_state[pbs_file] = 'running'
+        return len(self._local_queue) + len(self._local_running)
+
+    def ended_samples(self):
+        """
+        Sample directories of the local jobs ended since the last call (whatever their exit code), as found by `poll`.
+        No sample of these jobs is running any more, the completed ones are included and the caller skips them.
+        """
+        ended, self._ended_samples = self._ended_samples, []
+        return ended
+
     def clean_script(self):
         """
         Clean script and keep header
@@ -151,5 +239,6 @@ class Pbs:
         self._pbs_config['job_name'] = "{:04d}".format(self._job_count)
         self._pbs_config['pbs_output_dir'] = self._job_dir
         self.pbs_script = [line.format(**self._pbs_config) for line in self._pbs_header_template]
+        self._job_samples = []
 
 
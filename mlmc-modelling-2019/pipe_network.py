@@ -0,0 +1,261 @@
+"""
+Reduced fracture network (pipe graph) model of the 2D Darcy flow.
+
+Fracture traces clipped to the domain are split at their mutual intersections and at the lines
+of a regular background grid. Trace segments are pipes with the cubic law conductance,
+the bulk is represented by the two point flux approximation on the vertices of the background grid
+and every fracture node is coupled to the vertices of the grid cell containing it.
+The effective tensor of the whole domain follows from two sparse solves for the unit pressure gradients.
+"""
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+
+import tensor_store
+
+
+def clip_segment(p0, p1, box_min, box_max):
+    """
+    Clip the segment to an axis aligned box (Liang-Barsky).
+    :return: (q0, q1) or None if the segment is out of the box.
+    """
+    d = p1 - p0
+    t0, t1 = 0.0, 1.0
+    for ax in range(2):
+        for p, q in [(-d[ax], p0[ax] - box_min[ax]), (d[ax], box_max[ax] - p0[ax])]:
+            if p == 0:
+                if q < 0:
+                    return None
+                continue
+            t = q / p
+            if p < 0:
+                t0 = max(t0, t)
+            else:
+                t1 = min(t1, t)
+    if t0 >= t1:
+        return None
+    return p0 + t0 * d, p0 + t1 * d
+
+
+class PipeNetwork:
+    def __init__(self, traces, apertures, fr_conductivity, domain_box, step, bulk_cond):
+        """
+        :param traces: Array (n_fr, 2, 2) of the fracture trace end points.
+        :param apertures: Cross-sections of the fractures, shape (n_fr,).
+        :param fr_conductivity: Conductivities of the fractures, shape (n_fr,).
+        :param domain_box: [lx, ly], the domain is centered at the origin.
+        :param step: Approximate cell size of the background grid.
+        :param bulk_cond: Bulk conductivity tensor 2x2, the off-diagonal terms are neglected.
+        """
+        self.box_max = np.array(domain_box, dtype=float) / 2
+        self.box_min = -self.box_max
+        self.n_cells = np.maximum(1, np.ceil(2 * self.box_max / step).astype(int))
+        self.h = 2 * self.box_max / self.n_cells
+        self.bulk_diag = np.diag(np.array(bulk_cond, dtype=float))
+        self.tol = 1e-9 * np.min(self.h)
+
+        self.points = []
+        self.edges = []
+        # (node_a, node_b, conductance)
+        self._make_grid()
+        self._make_pipes(np.asarray(traces, dtype=float).reshape(-1, 2, 2), apertures, fr_conductivity)
+
+    def _add_point(self, pt):
+        self.points.append(pt)
+        return len(self.points) - 1
+
+    def _make_grid(self):
+        nx, ny = self.n_cells
+        hx, hy = self.h
+        xs = self.box_min[0] + hx * np.arange(nx + 1)
+        ys = self.box_min[1] + hy * np.arange(ny + 1)
+        self.grid_x, self.grid_y = xs, ys
+        X, Y = np.meshgrid(xs, ys)
+        self.points.extend(np.stack([X.ravel(), Y.ravel()], axis=1))
+        idx = np.arange((nx + 1) * (ny + 1)).reshape(ny + 1, nx + 1)
+        # horizontal edges, half cells on the bottom and top boundary
+        row_weight = np.full(ny + 1, hy)
+        row_weight[[0, -1]] /= 2
+        cond_x = self.bulk_diag[0] * np.repeat(row_weight, nx) / hx
+        # vertical edges, half cells on the left and right boundary
+        col_weight = np.full(nx + 1, hx)
+        col_weight[[0, -1]] /= 2
+        cond_y = self.bulk_diag[1] * np.tile(col_weight, ny) / hy
+        self.edges.extend(zip(idx[:, :-1].ravel(), idx[:, 1:].ravel(), cond_x))
+        self.edges.extend(zip(idx[:-1, :].ravel(), idx[1:, :].ravel(), cond_y))
+        self.grid_idx = idx
+
+    def _make_pipes(self, traces, apertures, fr_conductivity):
+        clipped = []
+        for i_fr, (p0, p1) in enumerate(traces):
+            segment = clip_segment(p0, p1, self.box_min, self.box_max)
+            if segment is not None and np.linalg.norm(segment[1] - segment[0]) > self.tol:
+                clipped.append((i_fr, segment[0], segment[1]))
+
+        # split points of every trace: (t, node)
+        split = [[] for _ in clipped]
+        for k, (i_fr, p0, p1) in enumerate(clipped):
+            d = p1 - p0
+            split[k].append((0.0, self._add_point(p0)))
+            split[k].append((1.0, self._add_point(p1)))
+            for ax, grid_lines in enumerate([self.grid_x, self.grid_y]):
+                if d[ax] != 0:
+                    t = (grid_lines - p0[ax]) / d[ax]
+                    for t_cross in t[(t > 0) & (t < 1)]:
+                        split[k].append((t_cross, self._add_point(p0 + t_cross * d)))
+
+        # mutual intersections, shared nodes
+        if clipped:
+            P0 = np.array([p0 for i_fr, p0, p1 in clipped])
+            D = np.array([p1 - p0 for i_fr, p0, p1 in clipped])
+        for k in range(len(clipped) - 1):
+            rhs = P0[k + 1:] - P0[k]
+            det = D[k, 0] * (-D[k + 1:, 1]) - D[k, 1] * (-D[k + 1:, 0])
+            parallel = np.abs(det) < 1e-14 * np.linalg.norm(D[k]) * np.linalg.norm(D[k + 1:], axis=1)
+            det = np.where(parallel, 1.0, det)
+            t = (rhs[:, 0] * (-D[k + 1:, 1]) - rhs[:, 1] * (-D[k + 1:, 0])) / det
+            s = (D[k, 0] * rhs[:, 1] - D[k, 1] * rhs[:, 0]) / det
+            hit = ~parallel & (t > 0) & (t < 1) & (s > 0) & (s < 1)
+            for j in np.nonzero(hit)[0]:
+                node = self._add_point(P0[k] + t[j] * D[k])
+                split[k].append((t[j], node))
+                split[k + 1 + j].append((s[j], node))
+
+        # pipes between consecutive split points
+        self.fracture_nodes = set()
+        for k, (i_fr, p0, p1) in enumerate(clipped):
+            length = np.linalg.norm(p1 - p0)
+            pipe_cond = apertures[i_fr] * fr_conductivity[i_fr]
+            nodes = sorted(split[k])
+            for (ta, a), (tb, b) in zip(nodes[:-1], nodes[1:]):
+                seg_length = (tb - ta) * length
+                if seg_length > self.tol:
+                    self.edges.append((a, b, pipe_cond / seg_length))
+            self.fracture_nodes.update(node for t, node in nodes)
+        self._couple_to_grid()
+
+    def _couple_to_grid(self):
+        """
+        Connect fracture nodes to the vertices of their grid cells, bilinear weights of the bulk conductivity.
+        """
+        coupling = np.mean(self.bulk_diag)
+        for node in self.fracture_nodes:
+            x = (self.points[node] - self.box_min) / self.h
+            i = np.clip(np.floor(x).astype(int), 0, self.n_cells - 1)
+            wx, wy = np.clip(x - i, 0, 1)
+            weights = [(1 - wx) * (1 - wy), wx * (1 - wy), (1 - wx) * wy, wx * wy]
+            vertices = [self.grid_idx[i[1], i[0]], self.grid_idx[i[1], i[0] + 1],
+                        self.grid_idx[i[1] + 1, i[0]], self.grid_idx[i[1] + 1, i[0] + 1]]
+            for w, v in zip(weights, vertices):
+                if w > 0:
+                    self.edges.append((node, v, coupling * w))
+
+    def matrix(self):
+        a, b, c = (np.array(col) for col in zip(*self.edges))
+        n = len(self.points)
+        rows = np.concatenate([a, b, a, b])
+        cols = np.concatenate([a, b, b, a])
+        values = np.concatenate([c, c, -c, -c])
+        return sp.coo_matrix((values, (rows, cols)), shape=(n, n)).tocsr()
+
+    def effective_tensor(self):
+        """
+        Solve the unit pressure gradients p = x, p = y with the Dirichlet condition on the domain boundary.
+        The mean flux -u = 1/|domain| sum_boundary x * influx = 1/|domain| X^T A p
+        gives directly the columns of the effective tensor.
+        :return: Effective conductivity tensor 2x2.
+        """
+        points = np.array(self.points)
+        on_boundary = np.any((np.abs(points - self.box_min) < self.tol) | (np.abs(points - self.box_max) < self.tol),
+                             axis=1)
+        dirichlet = np.nonzero(on_boundary)[0]
+        free = np.nonzero(~on_boundary)[0]
+        A = self.matrix()
+        pressure = np.zeros((len(points), 2))
+        pressure[dirichlet] = points[dirichlet]
+        if len(free) > 0:
+            lu = spla.splu(A[free, :][:, free].tocsc())
+            rhs = -(A[free, :][:, dirichlet] @ pressure[dirichlet])
+            pressure[free] = lu.solve(np.asarray(rhs))
+        area = np.prod(2 * self.box_max)
+        cond_tn = points.T @ (A @ pressure) / area
+        return (cond_tn + cond_tn.T) / 2
+
+
+class PipeNetworkProblem:
+    """
+    Pipe network counterpart of the FlowProblem, usable as a cheap MLMC level (`model: pipe_network`).
+    Provides a single effective tensor for the whole domain.
+    """
+    def __init__(self, basename, fr_range, fractures, step, bulk_cond, config_dict):
+        """
+        :param basename: Key of the problem in the sample summary.
+        :param fr_range: Size range of the fractures represented by the pipes.
+        :param fractures: The Fractures object with generated fractures.
+        :param step: Cell size of the background grid.
+        :param bulk_cond: Bulk conductivity tensor 2x2.
+        :param config_dict: Global config dictionary.
+        """
+        self.basename = basename
+        self.fr_range = fr_range
+        self.fractures = fractures
+        self.step = step
+        self.bulk_cond = bulk_cond
+        self.config_dict = config_dict
+        self.cond_tensors = None
+        # size of the network, set by `effective_tensor`
+        self.network_size = {}
+
+    @classmethod
+    def make(cls, basename, i_level, fr_range, fractures, finer_level_path, config_dict, finer_level_count=None):
+        """
+        Create the problem from the level configuration. The bulk conductivity is the mean
+        of the microscale tensors of the finer level (`choose_from_finer_level`),
+        or the isotropic conductivity given by the mean of `mean_log_conductivity`.
+        :param finer_level_path: Tensor store of the finer level, None if there is none
+            (e.g. the coarse problem of the next finer level).
+        """
+        level_dict = config_dict['levels'][i_level]
+        bulk_conductivity = level_dict['bulk_conductivity']
+        if bulk_conductivity.get('choose_from_finer_level', False):
+            if finer_level_path is None:
+                raise ValueError("Pipe network of level {} ({}) has `choose_from_finer_level` but no microscale tensors, "
+                                 "set `mean_log_conductivity` of the level.".format(i_level, basename))
+            bulk_cond = tensor_store.load(finer_level_path, tensor_store.pool_size(finer_level_path, finer_level_count))
+            bulk_cond = np.mean(bulk_cond.reshape(-1, 2, 2), axis=0)
+        else:
+            bulk_cond = np.power(10, np.mean(bulk_conductivity['mean_log_conductivity'])) * np.eye(2)
+        return cls(basename, fr_range, fractures, level_dict['step'], bulk_cond, config_dict)
+
+    def make_network(self):
+        fr_model = self.config_dict['fracture_model']
+        lines = self.fractures.get_lines(self.fr_range)
+        fr_ids = list(lines.keys())
+        traces = np.array([lines[i] for i in fr_ids]).reshape(-1, 2, 2)
+        # cubic law, same as FractureModel
+        fr_size = np.array([self.fractures.fractures[i].rx for i in fr_ids])
+        cs = fr_size * float(fr_model['aperture_per_size'])
+        cond = cs ** 2 / 12 * float(fr_model['water_density']) * float(fr_model['gravity_accel']) \
+               / float(fr_model['water_viscosity'])
+        domain_box = self.config_dict['geometry']['domain_box']
+        return PipeNetwork(traces, cs, cond, domain_box, self.step, self.bulk_cond)
+
+    def effective_tensor(self):
+        """
+        :return: {0: conductivity_tensor}
+        """
+        network = self.make_network()
+        print("Pipe network {}, nodes: {} edges: {}".format(self.basename, len(network.points), len(network.edges)))
+        self.network_size = dict(n_fractures=len(self.fractures.get_lines(self.fr_range)),
+                                 n_nodes=len(network.points), n_edges=len(network.edges))
+        self.cond_tensors = {0: network.effective_tensor()}
+        return self.cond_tensors
+
+    def summary(self):
+        return dict(
+            pos=[[0.0, 0.0]],
+            cond_tn=[self.cond_tensors[0].tolist()]
+        )
+
+    def metrics(self):
+        return dict(self.network_size)
@@ -9,12 +9,18 @@ import yaml
 import pickle
 import shutil
 import traceback
+import contextlib
+import concurrent.futures as cf
 import numpy as np
 import matplotlib.pyplot as plt
 src_path = os.path.dirname(os.path.abspath(__file__))
 
 import pbs
 import mlmc
+import profiling
+import sample_summary
+import results_store
+import tensor_store
 
 """
 Script overview:
@@ -55,11 +61,50 @@ class change_cwd:
 
 
 
+def read_sample_result(sample_dir, has_coarse):
+    """
+    Read the result of a sample, executed in the extraction worker processes.
+    :param has_coarse: The level has a coarse problem.
+    :return: None - not yet finished, or dict:
+        fine, coarse - effective tensors of the fine and coarse problem (zero tensor on the zero level),
+        walltime,
+        metrics - stage and problem cost metrics, None in older summaries,
+        micro_pos, micro_cond_tn - positions and tensors of the microscale problem ('coarse_ref'), None if there is none
+    """
+    finished_file = os.path.join(sample_dir, "FINISHED")
+    if not os.path.exists(finished_file):
+        return None
+    with open(finished_file, "r") as f:
+        content = f.read().split()
+    if content[0] != "done":
+        return None
+    walltime = float(content[1]) if len(content) > 1 else 1
+    summary_dict = sample_summary.read(sample_dir)
+    result = dict(
+        fine=np.array(summary_dict['fine']['cond_tn'][0]),
+        coarse=np.array([[0, 0], [0, 0]]),
+        walltime=walltime,
+        metrics=summary_dict.get('metrics', None),
+        micro_pos=None,
+        micro_cond_tn=None)
+    if has_coarse:
+        result['coarse'] = np.array(summary_dict['coarse']['cond_tn'][0])
+        # no microscale problem if the coarse problem is a pipe network
+        if 'coarse_ref' in summary_dict:
+            result['micro_pos'] = np.array(summary_dict['coarse_ref']['pos'])
+            result['micro_cond_tn'] = np.array(summary_dict['coarse_ref']['cond_tn'])
+    return result
+
+
 class FractureFlowSimulation():
     total_sim_id = 0
 
-    def __init__(self, i_level, pbs_obj, coarse_step, work_dir, config_dict):
+    def __init__(self, i_level, pbs_obj, coarse_step, work_dir, config_dict, store=None):
+        """
+        :param store: results_store.ResultsStore, the extracted samples are committed into it.
+        """
         self.i_level = i_level
+        self.store = store
 
         self.coarse_step = coarse_step
         # Pbs script creater
@@ -70,7 +115,7 @@ class FractureFlowSimulation():
         self.cond_field_xy = []
         self.cond_field_values = []
         self.running_samples = {}
-        self.finished_samples = {}  # i_sample -> (sample_dir, (fine, coarse, walltime))
+        self.finished_samples = {}  # i_sample -> (sample_dir, (fine, coarse, walltime, metrics))
         self.work_dir = work_dir
         # top workdir
         self.config_dict = config_dict
@@ -78,7 +123,13 @@ class FractureFlowSimulation():
 
         self.step = self.level_config['step']
         self.n_samples = self.level_config['n_samples']
-        self.micro_cond_tn_samples = "micro_cond_tn_samples.csv"
+        # tensor_store.py file of the microscale tensors, used by the coarser level
+        self.micro_cond_tn_samples = "micro_cond_tn_samples.npy"
+        # rows of the tensor store including the committed ones not appended yet, None - not known yet
+        self.n_micro_rows = None
+        # names of the completed sample dirs, from the level journal
+        self.completed = set()
+        self.journal = sample_summary.JournalReader(self.level_dir())
         # data processing
         #self._cond_xy = None
         #self._cond_tn = None
@@ -96,6 +147,13 @@ class FractureFlowSimulation():
         return len(self.finished_samples)
 
 
+    @property
+    def n_micro_tensors(self):
+        """
+        Number of the microscale tensors in the store of the level.
+        """
+        return tensor_store.count(os.path.join(self.level_dir(), self.micro_cond_tn_samples))
+
     def level_dir(self, i_level=None):
         if i_level is None:
             i_level = self.i_level
@@ -108,6 +166,9 @@ class FractureFlowSimulation():
         """
         os.makedirs(self.level_dir(), mode=0o775, exist_ok=True)
         for i_sample in range(self.n_samples):
+            if i_sample in self.finished_samples:
+                # collected by a previous run
+                continue
             sample_dir = "L{:02d}_F_S{:07}".format(self.i_level, i_sample)
             sample_dir = os.path.join(self.level_dir(), sample_dir)
             os.makedirs(sample_dir, mode=0o775, exist_ok=True)
@@ -130,7 +191,9 @@ class FractureFlowSimulation():
             h_coarse_step=self.coarse_step,
             i_level=self.i_level,
             config_path=os.path.join(self.work_dir, "config.yaml"),
-            finer_level_path=finer_level_path
+            finer_level_path=finer_level_path,
+            # the sample draws from the tensors stored when it starts, the finer level keeps growing
+            finer_level_count=None
         )
         config_path = os.path.join(sample_dir, "sample_config.yaml")
         if not os.path.exists(config_path):
@@ -168,73 +231,132 @@ class FractureFlowSimulation():
                 src_dir=src_path)
         else:
             package_dir = "finished_job"
+            self.completed.add(os.path.basename(sample_dir))
 
         self.running_samples[i_sample] = sample_dir
 
 
 
-    def extract_results(self):
-        new_running = {}
+    def extract_results(self, pool=None):
+        """
+        Collect the results of the finished samples. The samples completed since the last call are given
+        by the level journal (sample_summary.JournalReader), the running samples are not checked one by one.
+        The summaries are read by `read_sample_result` in the `pool` (concurrent.futures executor,
+        the calling process if None), the results are merged in the calling process.
+        :return: List of the failed sample dirs.
+        """
+        has_coarse = self.coarse_step is not None
+        self.completed.update(self.journal.poll())
+        finished = {i_sample: sample_dir for i_sample, sample_dir in self.running_samples.items()
+                    if os.path.basename(sample_dir) in self.completed}
         failed = []
-        for i_sample, sample_dir in self.running_samples.items():
-            print("Extracting: ", sample_dir)
-            try:
-                result = self.extract_result(sample_dir)
-                if result is None:
-                    new_running[i_sample] = sample_dir
-                    continue
-                self.finished_samples[i_sample] = (sample_dir, result)
-            except:
+        extracted = []
+        for i_sample, result, error in self._read_results(finished, has_coarse, pool):
+            sample_dir = finished[i_sample]
+            if error is not None:
                 print("FAILED -------------------------------------------------\n",
                       sample_dir)
-                traceback.print_exc()
+                print(error)
                 print("-----------------------------")
                 failed.append(sample_dir)
-        self.running_samples = new_running
-
+            elif result is not None:
+                print("Extracted: ", sample_dir)
+                self.store_result(i_sample, sample_dir, result)
+                extracted.append((i_sample, sample_dir, result))
+            else:
+                continue
+            del self.running_samples[i_sample]
+        if extracted:
+            self.commit_results(extracted)
         return failed
 
-    def extract_result(self, sample_dir):
+    def commit_results(self, extracted):
         """
-        Return:
-         None - not yet finished
-         pair of (fine, coarse) sample, or None
-        :param sample_dir:
-        :return:
+        Commit the extracted samples into the results store first, then append their microscale tensors
+        to the tensor store by a single append. The store rows of the tensors are committed with the samples,
+        so the tensors missing after a crash are appended by `load_results` and none is appended twice.
+        :param extracted: List of (i_sample, sample_dir, result).
         """
-        finished_file = os.path.join(sample_dir, "FINISHED")
-        finished = False
-        if os.path.exists(finished_file):
-            with open(finished_file, "r") as f:
-                content = f.read().split()
-            finished = content[0] == "done"
-            if len(content) > 1:
-                walltime = float(content[1])
-            else:
-                walltime = 1
-        if finished:
-            with open(os.path.join(sample_dir, "summary.yaml"), "r") as f:
-                summary_dict = yaml.load(f) #, Loader=yaml.FullLoader
-            print("   ...store")
-            fine_cond_tn = np.array(summary_dict['fine']['cond_tn'][0])
-            if self.coarse_step is not None:
-                coarse_cond_tn = np.array(summary_dict['coarse']['cond_tn'][0])
-                self.cond_field_xy.append(np.array(summary_dict['coarse_ref']['pos']))
-                micro_cond_tn_samples = np.array(summary_dict['coarse_ref']['cond_tn'])
-                self.cond_field_values.append(micro_cond_tn_samples)
-                self.append_microscale(micro_cond_tn_samples)
-            else:
-                # zero level coarse
-                coarse_cond_tn = np.array([[0,0],[0,0]])
+        if self.n_micro_rows is None:
+            self.n_micro_rows = self.n_micro_tensors
+        micro_tensors = []
+        for i_sample, sample_dir, result in extracted:
+            if result['micro_cond_tn'] is not None:
+                result['micro_begin'] = self.n_micro_rows
+                self.n_micro_rows += len(result['micro_cond_tn'])
+                micro_tensors.append(result['micro_cond_tn'])
+        if self.store is not None:
+            self.store.add(self.i_level, extracted)
+        if micro_tensors:
+            self.append_microscale(np.concatenate(micro_tensors))
+
+    def fail_samples(self, sample_dirs):
+        """
+        Remove the running samples of the given directories, e.g. the samples of an ended job.
+        Called after `extract_results`, so the samples completed before the failure are collected.
+        :return: List of the removed sample dirs.
+        """
+        failed = [(i_sample, sample_dir) for i_sample, sample_dir in self.running_samples.items()
+                  if sample_dir in sample_dirs]
+        for i_sample, sample_dir in failed:
+            del self.running_samples[i_sample]
+        return [sample_dir for i_sample, sample_dir in failed]
 
-            return fine_cond_tn, coarse_cond_tn, walltime
+    @staticmethod
+    def _read_results(sample_dirs, has_coarse, pool):
+        """
+        Yield (i_sample, result, formatted exception) of the samples {i_sample: sample_dir} in the order of completion.
+        """
+        if pool is None:
+            for i_sample, sample_dir in sample_dirs.items():
+                try:
+                    yield i_sample, read_sample_result(sample_dir, has_coarse), None
+                except Exception:
+                    yield i_sample, None, traceback.format_exc()
         else:
-            return None
+            futures = {pool.submit(read_sample_result, sample_dir, has_coarse): i_sample
+                       for i_sample, sample_dir in sample_dirs.items()}
+            for future in cf.as_completed(futures):
+                try:
+                    yield futures[future], future.result(), None
+                except Exception:
+                    yield futures[future], None, traceback.format_exc()
+
+    def store_result(self, i_sample, sample_dir, result):
+        """
+        :param result: Result of `read_sample_result`.
+        """
+        if result['micro_cond_tn'] is not None:
+            self.cond_field_xy.append(result['micro_pos'])
+            self.cond_field_values.append(result['micro_cond_tn'])
+        self.finished_samples[i_sample] = \
+            (sample_dir, (result['fine'], result['coarse'], result['walltime'], result['metrics']))
+
+    def load_results(self):
+        """
+        Restore the samples collected by a previous run from the results store.
+        Microscale tensors committed but not appended to the tensor store (crash in `commit_results`)
+        are appended now.
+        """
+        self.n_micro_rows = self.n_micro_tensors
+        missing = []
+        for i_sample, (sample_dir, result) in sorted(self.store.load(self.i_level).items()):
+            self.store_result(i_sample, sample_dir, result)
+            micro_begin = result['micro_begin']
+            if micro_begin is not None and micro_begin >= self.n_micro_rows:
+                missing.append((micro_begin, result['micro_cond_tn']))
+        if missing:
+            missing.sort(key=lambda item: item[0])
+            assert missing[0][0] == self.n_micro_rows, "Tensor store of level {} inconsistent with the results."\
+                .format(self.i_level)
+            micro_tensors = np.concatenate([cond_tn for micro_begin, cond_tn in missing])
+            print("Level {}: appending {} missing microscale tensors.".format(self.i_level, len(micro_tensors)))
+            self.append_microscale(micro_tensors)
+            self.n_micro_rows += len(micro_tensors)
 
     def append_microscale(self, cond_values):
         micro_samples = os.path.join(self.level_dir(self.i_level), self.micro_cond_tn_samples)
-        with open(micro_samples, "a") as f:
-            np.savetxt(f, cond_values.reshape((-1, 4)))
+        tensor_store.append(micro_samples, cond_values.reshape((-1, 4)))
 
 
 
@@ -633,7 +755,7 @@ class Process():
     def make_pbs(self):
         pbs_config = dict(
             job_weight=150000,  # max number of elements per job
-            n_cores=3,
+            n_cores=self.config_dict.get('n_cores', 3),
             n_nodes=1,
             select_flags=[],
             mem='8gb',
@@ -642,9 +764,14 @@ class Process():
             qsub=None)
         if self.config_dict['metacentrum']:
             pbs_config['qsub'] = 'qsub'
+        worker_cmd = None
+        if self.config_dict.get('persistent_worker', False):
+            worker_cmd = '{src_dir}/env/bin/python {src_dir}/both_sample.py --worker {{samples_file}}'.format(src_dir=src_path)
         pbs_obj = pbs.Pbs(self.work_dir,
                                job_count=0,
-                               qsub=pbs_config['qsub']
+                               qsub=pbs_config['qsub'],
+                               worker_cmd=worker_cmd,
+                               local_jobs=self.config_dict.get('local_jobs', None)
                                )
         pbs_obj.pbs_common_setting(**pbs_config)
         return  pbs_obj
@@ -653,30 +780,28 @@ class Process():
     def run(self):
         os.makedirs(self.work_dir, mode=0o775, exist_ok=True)
         self.pbs=self.make_pbs()
+        self.store = results_store.ResultsStore(os.path.join(self.work_dir, results_store.db_file))
 
         # Create level simulations.
         self.levels = []
         last_step = None
         for il, level_config in enumerate(self.config_dict['levels']):
             sim_step = level_config['step']
-            sim = FractureFlowSimulation(il, self.pbs, last_step, self.work_dir, self.config_dict)
+            sim = FractureFlowSimulation(il, self.pbs, last_step, self.work_dir, self.config_dict, store=self.store)
             self.levels.append(sim)
             last_step = sim_step
 
-        try:
-            self.load_finished()
-            return
-        except FileNotFoundError:
-            pass
+        self.load_finished()
 
-        finer_l = None
+        # Levels sampling the bulk from the microscale tensors of the finer level are scheduled by `wait`,
+        # the other levels are not waiting for anything.
+        self.waiting_levels = []
         for l in reversed(self.levels):
             if l.choose_from_finer_level:
-                assert finer_l is not None
-                self.pbs.execute()
-                self.wait_for_level(finer_l, self.config_dict['n_finer_level_samples'])
-            l.run_level()
-            finer_l = l
+                assert l.i_level + 1 < len(self.levels)
+                self.waiting_levels.append(l)
+            else:
+                l.run_level()
 
 
     @staticmethod
@@ -686,19 +811,74 @@ class Process():
         return np.array([half_trace, sqrt_det])
 
 
+    @staticmethod
+    def sample_cost(walltime, metrics, cost):
+        """
+        Cost of a sample used for the MLMC sample allocation, given by the `mlmc_cost` config key:
+        walltime - walltime of the sample (default),
+        cpu - CPU time of the sample process and of its children (Flow123d, gmsh), walltime if there are no metrics.
+        """
+        if cost == 'cpu' and metrics is not None:
+            return metrics['cpu'] + metrics['children_cpu']
+        return walltime
+
+    def cost_breakdown(self):
+        """
+        Print mean cost metrics of the levels: wall and CPU time per stage, problem sizes,
+        Flow123d run times and solver iterations. Samples without metrics are skipped.
+        """
+        print("\nCost breakdown\n")
+        for il, level in enumerate(self.levels):
+            level_metrics = [result[3] for dir, result in level.finished_samples.values()
+                             if len(result) > 3 and result[3] is not None]
+            if not level_metrics:
+                continue
+            wall = np.mean([m['wall'] for m in level_metrics])
+            cpu = np.mean([m['cpu'] for m in level_metrics])
+            children_cpu = np.mean([m['children_cpu'] for m in level_metrics])
+            # samples of the persistent workers have just the worker lifetime peak
+            peak_rss = np.max([m.get('peak_rss_mb', 0) for m in level_metrics])
+            worker_rss = np.max([m.get('worker_peak_rss_mb', 0) for m in level_metrics])
+            children_rss = np.max([m['children_peak_rss_mb'] for m in level_metrics])
+            print(f"level {il:3}  samples {len(level_metrics)}  wall {wall:.2f}  cpu {cpu:.2f}  children cpu {children_cpu:.2f}"
+                  f"  peak rss {peak_rss:.0f}MB  worker peak rss {worker_rss:.0f}MB  flow peak rss {children_rss:.0f}MB")
+            stage_names = sorted({name for m in level_metrics for name in m['stages']},
+                                 key=lambda name: -np.mean([m['stages'].get(name, {}).get('wall', 0) for m in level_metrics]))
+            for name in stage_names:
+                stage_wall = np.mean([m['stages'][name]['wall'] for m in level_metrics if name in m['stages']])
+                stage_cpu = np.mean([m['stages'][name]['cpu'] for m in level_metrics if name in m['stages']])
+                print(f"    stage {name:20}  wall {stage_wall:10.2f} ({100 * stage_wall / wall:5.1f}%)  cpu {stage_cpu:10.2f}")
+            problem_names = sorted({name for m in level_metrics for name in m['problems']})
+            for name in problem_names:
+                problems = [m['problems'][name] for m in level_metrics if name in m['problems']]
+                sizes = "  ".join(f"{key} {np.mean([p[key] for p in problems if p.get(key) is not None]):.0f}"
+                                  for key in ['n_fractures', 'n_elements', 'n_nodes', 'n_edges', 'n_groups']
+                                  if any(p.get(key) is not None for p in problems))
+                print(f"    problem {name:12}  {sizes}")
+                runs = [run for p in problems for run in p.get('runs', []) if 'cpu' in run]
+                if runs:
+                    iterations = [run['iterations'] for run in runs if run.get('iterations') is not None]
+                    run_cpu = [run['cpu'] for run in runs]
+                    print(f"        runs {len(runs) / len(problems):.1f} per sample"
+                          f"  wall {np.mean([run['wall'] for run in runs]):.2f}  cpu {np.mean(run_cpu):.2f}"
+                          f"  iterations {np.mean(iterations) if iterations else float('nan'):.1f}")
+
     def mlmc_processing(self):
         statistics = self.cond_scalar_statistics
+        cost = self.config_dict.get('mlmc_cost', 'walltime')
         level_data = []
         level_times = []
         for level in self.levels:
             data = []
             times = []
             for dir, result in level.finished_samples.values():
-                fine, coarse, walltime = result
+                fine, coarse, walltime = result[:3]
+                metrics = result[3] if len(result) > 3 else None
                 data.append([statistics(fine), statistics(coarse)])
-                times.append(walltime)
+                times.append(self.sample_cost(walltime, metrics, cost))
             level_data.append(data)
             level_times.append(np.mean(times))
+        self.cost_breakdown()
 
         mc = mlmc.MLMC(level_data, level_times)
 
@@ -765,52 +945,94 @@ class Process():
             with open(os.path.join(sample_dir, "FINISHED"), "w") as f:
                 f.write('done')
 
-    def wait_for_level(self, level, n_finished):
+    def extract_pool(self):
         """
-        Wait until `level` have at least `n_finished` samples.
+        Process pool reading the sample results, `extract_workers` config key.
+        The pool is opt-in, the script usually runs on a shared login node.
+        :return: Context manager giving the executor or None (extraction in this process).
         """
-        while level.n_collected < n_finished and len(level.running_samples) > 0:
-                failed = level.extract_results()
-                self.move_failed(failed)
-                time.sleep(1)
-
-    def save_finished(self):
-        finished_file = os.path.join(self.work_dir, "finished_samples.json")
-        finished = [sim.finished_samples for sim in self.levels]
-        with open(finished_file, 'wb') as f:
-            pickle.dump(finished, f)
+        n_workers = self.config_dict.get('extract_workers', None) or 1
+        if n_workers <= 1:
+            return contextlib.nullcontext()
+        return cf.ProcessPoolExecutor(max_workers=n_workers)
 
+    def schedule_waiting_levels(self):
+        """
+        Schedule the waiting levels whose finer level has at least `n_finer_level_samples` collected samples
+        and as many stored microscale tensors (or no more running samples and some tensors).
+        The finer level keeps running, its tensors are added to the pool of the coarser samples not started yet.
+        A level whose finer level finished without any stored tensors is not run at all.
+        :return: True if a level was scheduled.
+        """
+        scheduled = False
+        n_finer_samples = self.config_dict['n_finer_level_samples']
+        for level in list(self.waiting_levels):
+            finer_level = self.levels[level.i_level + 1]
+            if finer_level in self.waiting_levels:
+                continue
+            n_tensors = finer_level.n_micro_tensors
+            if finer_level.n_collected >= n_finer_samples and n_tensors >= n_finer_samples \
+                    or not finer_level.running_samples and n_tensors > 0:
+                self.waiting_levels.remove(level)
+                level.run_level()
+                scheduled = True
+            elif not finer_level.running_samples:
+                self.waiting_levels.remove(level)
+                print("Level {} failed: the finer level {} finished with {} collected samples and no microscale "
+                      "tensors to choose from.".format(level.i_level, finer_level.i_level, finer_level.n_collected))
+        return scheduled
 
     def load_finished(self):
+        """
+        Restore the collected samples from the results store, these are not scheduled again.
+        Samples of the pickled 'finished_samples.json' of older runs are added if not in the store.
+        """
+        for sim in self.levels:
+            sim.load_results()
         finished_file = os.path.join(self.work_dir, "finished_samples.json")
+        if not os.path.exists(finished_file):
+            return
         with open(finished_file, 'rb') as f:
             finished = pickle.load(f)
         for sim, level_finished in zip(self.levels, finished):
-            sim.finished_samples = level_finished
-            new_running = {}
-            for ir, sample in sim.running_samples.items():
-                if ir not in sim.finished:
-                    new_running[ir] = sample
-            sim.running_samples = new_running
+            for i_sample, sample in level_finished.items():
+                sim.finished_samples.setdefault(i_sample, sample)
 
 
     def wait(self):
-        try:
-            self.load_finished()
-            return
-        except FileNotFoundError:
-            pass
         self.pbs.execute()
-        n_running = 1
-        while (n_running):
-            n_running = 0
-            for sim in self.levels:
-                failed = sim.extract_results()
-                self.move_failed(failed)
-                n_running += len(sim.running_samples)
-            time.sleep(1)
-        self.save_finished()
-
+        with self.extract_pool() as pool:
+            n_running = sum(len(sim.running_samples) for sim in self.levels)
+            while n_running or self.waiting_levels:
+                # start the queued local jobs; samples of the ended jobs not completed
+                # (killed, crashed without the journal record) are failed after the extraction
+                self.pbs.poll()
+                ended_jobs = set(self.pbs.ended_samples())
+                n_before = n_running
+                n_running = 0
+                for sim in self.levels:
+                    failed = sim.extract_results(pool)
+                    if ended_jobs:
+                        failed.extend(sim.fail_samples(ended_jobs))
+                    self.move_failed(failed)
+                    n_running += len(sim.running_samples)
+                if self.schedule_waiting_levels():
+                    self.pbs.execute()
+                    n_running = sum(len(sim.running_samples) for sim in self.levels)
+                # sleep only if there was nothing to extract, a backlog of finished samples is processed at once
+                elif n_running == n_before:
+                    time.sleep(1)
+
+
+    def profile_report(self):
+        """
+        Merge the sample profiles (see `profile` config key) of every level into the ranked
+        hot-spot report 'profile_report.txt' (and 'profile_report.prof') in the level directory.
+        """
+        for il in range(len(self.config_dict['levels'])):
+            level_dir = os.path.join(self.work_dir, "sim_level_{}".format(il))
+            n_profiles = profiling.level_report(level_dir)
+            print("Level {}: {} sample profiles merged.".format(il, n_profiles))
 
     def process(self):
         for sim in self.levels:
@@ -837,6 +1059,11 @@ class Process():
 
 
 if __name__ == "__main__":
+    # process_own.py <work_dir> [config] - run, wait for and process the samples
+    # process_own.py --profile-report <work_dir> - merge the sample profiles of the levels, see `profile_report`
+    if sys.argv[1] == "--profile-report":
+        Process(sys.argv[2], None).profile_report()
+        sys.exit(0)
     np.random.seed(123)
     work_dir = sys.argv[1]
     if len(sys.argv) > 2:
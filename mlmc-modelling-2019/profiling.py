@@ -0,0 +1,132 @@
+"""
+Opt-in profiling of the sample calculations.
+
+Enabled by the environment variable SAMPLE_PROFILE (any value but '0'), or by the config key `profile: true`.
+cProfile is used for the calling thread and for every callable wrapped by `Profiler.wrap`
+(e.g. the tasks of a TaskGraph, cProfile sees just the thread it is enabled in).
+A thread has at most one active profile: wrapped callables called in an already profiled thread
+are just a part of its profile. If the profile can't be enabled (Python >= 3.12 allows a single
+active profiler, e.g. another tool is profiling), the callable runs without the profile.
+Profiles of all threads are merged into '<name>.prof' (pstats format, see `merge_profiles`)
+with a ranked text report '<name>.txt'. tracemalloc records the allocations, the top lines
+and the peak of the traced memory are written to '<name>_memory.txt'.
+"""
+import os
+import io
+import glob
+import threading
+import cProfile
+import pstats
+import tracemalloc
+
+
+def enabled(config_dict=None):
+    env = os.environ.get("SAMPLE_PROFILE", "")
+    if env:
+        return env != "0"
+    return bool((config_dict or {}).get('profile', False))
+
+
+def write_report(stats, path, n_top=50):
+    """
+    Text report of the pstats.Stats: top functions by the cumulative and by the own time.
+    """
+    stream = io.StringIO()
+    stats.stream = stream
+    stats.sort_stats('cumulative').print_stats(n_top)
+    stats.sort_stats('tottime').print_stats(n_top)
+    with open(path, "w") as f:
+        f.write(stream.getvalue())
+
+
+def merge_profiles(paths, name, n_top=50):
+    """
+    Merge the '.prof' files into '<name>.prof' and the ranked report '<name>.txt'.
+    :return: Number of merged profiles.
+    """
+    paths = list(paths)
+    if not paths:
+        return 0
+    stats = pstats.Stats(paths[0])
+    for path in paths[1:]:
+        stats.add(path)
+    stats.dump_stats(name + ".prof")
+    write_report(stats, name + ".txt", n_top)
+    return len(paths)
+
+
+class Profiler:
+    def __init__(self, name="profile", memory=True, n_top=50):
+        """
+        :param name: Base name of the output files.
+        :param memory: Trace the memory allocations by tracemalloc.
+        :param n_top: Number of functions and allocation lines in the reports.
+        """
+        self.name = name
+        self.memory = memory
+        self.n_top = n_top
+        self._profiles = []
+        self._lock = threading.Lock()
+        # `active` is set in the threads running a profile
+        self._thread = threading.local()
+
+    def wrap(self, fn):
+        """
+        :return: The callable `fn` profiled in the thread it is called from.
+        """
+        def profiled(*args, **kwargs):
+            if getattr(self._thread, 'active', False):
+                return fn(*args, **kwargs)
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError as e:
+                print("Profile of '{}' not enabled: {}".format(getattr(fn, '__name__', fn), e))
+                return fn(*args, **kwargs)
+            with self._lock:
+                self._profiles.append(profile)
+            self._thread.active = True
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profile.disable()
+                self._thread.active = False
+        return profiled
+
+    def run(self, fn, *args, **kwargs):
+        """
+        Call `fn` profiled, write the reports even if it fails.
+        """
+        if self.memory:
+            tracemalloc.start()
+        try:
+            return self.wrap(fn)(*args, **kwargs)
+        finally:
+            self.write()
+
+    def write(self):
+        # memory first, not to include the allocations of the profile processing
+        if self.memory and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(self.name + "_memory.txt", "w") as f:
+                print("Traced memory current: {:.1f} MB peak: {:.1f} MB".format(current / 2**20, peak / 2**20), file=f)
+                for stat in snapshot.statistics('lineno')[:self.n_top]:
+                    print(stat, file=f)
+        if not self._profiles:
+            return
+        stats = pstats.Stats(self._profiles[0])
+        for profile in self._profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(self.name + ".prof")
+        write_report(stats, self.name + ".txt", self.n_top)
+
+
+def level_report(level_dir, name="profile", n_top=50):
+    """
+    Merge profiles '<sample_dir>/<name>.prof' of all samples of the level directory
+    into '<level_dir>/<name>_report.prof' and '.txt'.
+    """
+    paths = sorted(glob.glob(os.path.join(level_dir, "*", name + ".prof")))
+    return merge_profiles(paths, os.path.join(level_dir, name + "_report"), n_top)
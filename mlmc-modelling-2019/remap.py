@@ -0,0 +1,145 @@
+"""
+Conservative remapping of element tensors from a fine mesh to a coarser (target) triangle mesh.
+
+Fine elements are binned into the target triangles by locating their barycenters,
+the tensors are then averaged over every target with the fine element volumes as weights.
+Everything is vectorized, the cost is linear in the number of fine elements.
+"""
+import numpy as np
+import scipy.spatial as sc_spatial
+
+
+class TriangleLocator:
+    """
+    Point location in a set of triangles. Candidate triangles are the nearest ones
+    by their barycenters (cKDTree), the candidates are checked by the barycentric coordinates.
+    Points not found in the candidates (e.g. near large or elongated triangles) are checked
+    against all triangles.
+    """
+    def __init__(self, vertices, n_candidates=8):
+        """
+        :param vertices: Array (M, 3, 2) of the triangle vertices.
+        :param n_candidates: Number of the nearest triangles to check for every point.
+        """
+        self.vertices = np.asarray(vertices, dtype=float)[:, :, 0:2]
+        self.n_candidates = min(n_candidates, len(self.vertices))
+        self.centers = np.mean(self.vertices, axis=1)
+        self.tree = sc_spatial.cKDTree(self.centers)
+        jac = np.stack([self.vertices[:, 1] - self.vertices[:, 0], self.vertices[:, 2] - self.vertices[:, 0]], axis=2)
+        self.inv_jac = np.linalg.inv(jac)
+
+    def locate(self, points, tol=1e-10):
+        """
+        :param points: Array (N, 2).
+        :return: Index of the triangle containing each point, -1 for the points out of all triangles.
+        """
+        points = np.asarray(points, dtype=float)[:, 0:2]
+        result = np.full(len(points), -1, dtype=int)
+        if len(points) == 0:
+            return result
+        _, candidates = self.tree.query(points, k=self.n_candidates)
+        candidates = candidates.reshape(len(points), -1)
+        for col in range(candidates.shape[1]):
+            todo = np.nonzero(result < 0)[0]
+            if len(todo) == 0:
+                break
+            tri = candidates[todo, col]
+            inside = self._inside(points[todo], tri, tol)
+            result[todo[inside]] = tri[inside]
+        todo = np.nonzero(result < 0)[0]
+        if len(todo) > 0 and self.n_candidates < len(self.vertices):
+            result[todo] = self._locate_all(points[todo], tol)
+        return result
+
+    def _inside(self, points, tri, tol):
+        local = np.einsum('n...ij,n...j->n...i', self.inv_jac[tri], points - self.vertices[tri, 0])
+        return (local[..., 0] >= -tol) & (local[..., 1] >= -tol) & (local[..., 0] + local[..., 1] <= 1 + tol)
+
+    def _locate_all(self, points, tol, chunk_size=10**6):
+        """
+        Brute force check of all triangles, in chunks of at most chunk_size point-triangle pairs.
+        """
+        result = np.full(len(points), -1, dtype=int)
+        n_tri = len(self.vertices)
+        all_tri = np.arange(n_tri)
+        step = max(1, chunk_size // n_tri)
+        for begin in range(0, len(points), step):
+            chunk = points[begin:begin + step]
+            inside = self._inside(chunk[:, None, :], np.broadcast_to(all_tri, (len(chunk), n_tri)), tol)
+            found = np.any(inside, axis=1)
+            result[begin:begin + step][found] = np.argmax(inside, axis=1)[found]
+        return result
+
+
+def _sym_function(tensors, fn):
+    """
+    Apply the scalar function to the eigenvalues of the symmetric tensors (N, 2, 2).
+    """
+    e_val, e_vec = np.linalg.eigh(tensors)
+    return np.einsum('nij,nj,nkj->nik', e_vec, fn(e_val), e_vec)
+
+
+def average_tensors(target_idx, n_targets, volumes, tensors, average='arithmetic'):
+    """
+    Volume weighted averages of the tensors over the targets.
+    :param target_idx: Target index of every fine element, shape (N,); negative - not used.
+    :param n_targets: Number of targets.
+    :param volumes: Fine element volumes, shape (N,).
+    :param tensors: Fine element tensors, shape (N, 2, 2).
+    :param average: 'arithmetic', 'harmonic' or 'geometric' (log-Euclidean).
+    :return: (averages, weights); shapes (n_targets, 2, 2), (n_targets,). Averages of empty targets are NaN.
+    """
+    used = target_idx >= 0
+    target_idx, volumes, tensors = target_idx[used], volumes[used], tensors[used]
+    if average == 'arithmetic':
+        values = tensors
+    elif average == 'harmonic':
+        values = np.linalg.inv(tensors)
+    elif average == 'geometric':
+        values = _sym_function(tensors, np.log)
+    else:
+        raise ValueError("Unknown average: {}".format(average))
+
+    weights = np.bincount(target_idx, weights=volumes, minlength=n_targets)
+    sums = np.zeros((n_targets, 4))
+    for k, component in enumerate(values.reshape(-1, 4).T):
+        sums[:, k] = np.bincount(target_idx, weights=volumes * component, minlength=n_targets)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (sums / weights[:, None]).reshape(-1, 2, 2)
+    empty = weights == 0
+    result = np.full((n_targets, 2, 2), np.nan)
+    filled = ~empty
+    if average == 'arithmetic':
+        result[filled] = means[filled]
+    elif average == 'harmonic':
+        result[filled] = np.linalg.inv(means[filled])
+    else:
+        result[filled] = _sym_function(means[filled], np.exp)
+    return result, weights
+
+
+def remap_tensors(points, volumes, tensors, target_vertices, average='arithmetic'):
+    """
+    Remap fine element tensors to the target triangles.
+    Targets without any fine barycenter get the tensor of the fine element nearest to their barycenter.
+    Fine barycenters out of all targets are reported and not used.
+    :param points: Fine element barycenters, shape (N, 2).
+    :param volumes: Fine element volumes, shape (N,).
+    :param tensors: Fine element tensors, shape (N, 2, 2).
+    :param target_vertices: Target triangles, shape (M, 3, 2).
+    :param average: See `average_tensors`.
+    :return: Target tensors, shape (M, 2, 2).
+    """
+    points = np.asarray(points, dtype=float)[:, 0:2]
+    locator = TriangleLocator(target_vertices)
+    target_idx = locator.locate(points)
+    n_outside = np.sum(target_idx < 0)
+    if n_outside > 0:
+        print("Remap: {} of {} fine elements out of the target mesh, not used.".format(n_outside, len(points)))
+    result, weights = average_tensors(target_idx, len(locator.vertices), np.asarray(volumes, dtype=float),
+                                      np.asarray(tensors, dtype=float), average)
+    empty = np.nonzero(weights == 0)[0]
+    if len(empty) > 0:
+        _, nearest = sc_spatial.cKDTree(points).query(locator.centers[empty])
+        result[empty] = tensors[nearest]
+    return result
@@ -0,0 +1,91 @@
+"""
+Results of the finished samples stored in the SQLite database 'results.sqlite' of the work directory.
+
+A table 'level_<i>' per level, a row per sample keyed by the sample index. Rows are inserted and committed
+as the samples are extracted, so a restarted campaign takes the collected samples from the database
+instead of reading the sample directories again. Tensors are stored as '.npy' blobs, metrics as JSON.
+'micro_begin' is the first row of the sample microscale tensors in the tensor store of the level (tensor_store.py),
+it is committed before the tensors are appended, so the missing rows can be appended again after a crash.
+"""
+import io
+import json
+import sqlite3
+import numpy as np
+
+db_file = "results.sqlite"
+
+_array_columns = ['fine', 'coarse', 'micro_pos', 'micro_cond_tn']
+
+
+def _to_blob(array):
+    if array is None:
+        return None
+    f = io.BytesIO()
+    np.save(f, np.asarray(array), allow_pickle=False)
+    return f.getvalue()
+
+
+def _from_blob(blob):
+    if blob is None:
+        return None
+    return np.load(io.BytesIO(blob), allow_pickle=False)
+
+
+def _plain(value):
+    # numpy scalars in metrics
+    return value.item()
+
+
+class ResultsStore:
+    def __init__(self, path):
+        """
+        :param path: Database file, created if necessary.
+        """
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self._tables = set()
+
+    def _table(self, i_level):
+        table = "level_{}".format(int(i_level))
+        if table not in self._tables:
+            with self.conn:
+                self.conn.execute(
+                    "CREATE TABLE IF NOT EXISTS {} (i_sample INTEGER PRIMARY KEY, sample_dir TEXT, walltime REAL, "
+                    "metrics TEXT, micro_begin INTEGER, fine BLOB, coarse BLOB, micro_pos BLOB, micro_cond_tn BLOB)"
+                    .format(table))
+            self._tables.add(table)
+        return table
+
+    def add(self, i_level, samples):
+        """
+        Store the samples in a single transaction.
+        :param samples: List of (i_sample, sample_dir, result), result as given by `process_own.read_sample_result`
+            with optional 'micro_begin'.
+        """
+        table = self._table(i_level)
+        rows = [(i_sample, sample_dir, result['walltime'], json.dumps(result['metrics'], default=_plain),
+                 result.get('micro_begin', None))
+                + tuple(_to_blob(result[col]) for col in _array_columns)
+                for i_sample, sample_dir, result in samples]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO {} (i_sample, sample_dir, walltime, metrics, micro_begin, {}) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)".format(table, ", ".join(_array_columns)), rows)
+
+    def load(self, i_level):
+        """
+        :return: {i_sample: (sample_dir, result)}, the stored samples of the level.
+        """
+        table = self._table(i_level)
+        samples = {}
+        query = "SELECT i_sample, sample_dir, walltime, metrics, micro_begin, {} FROM {}".format(
+            ", ".join(_array_columns), table)
+        for row in self.conn.execute(query):
+            i_sample, sample_dir, walltime, metrics, micro_begin = row[:5]
+            result = dict(walltime=walltime, metrics=json.loads(metrics), micro_begin=micro_begin)
+            result.update({col: _from_blob(blob) for col, blob in zip(_array_columns, row[5:])})
+            samples[i_sample] = (sample_dir, result)
+        return samples
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,106 @@
+"""
+Binary summary of a sample: results of the problems and the cost metrics.
+
+'summary.npz' holds an array '<problem>/<quantity>' for every quantity of a problem summary
+(e.g. 'coarse_ref/pos', 'coarse_ref/cond_tn') and the nested metrics dict as a JSON string under 'metrics'.
+Reading it is much faster than parsing the YAML lists of thousands of microscale tensors.
+The YAML summary is an optional human readable export, `read` falls back to it for older samples.
+
+Finished samples append a record to the completion journal of the level ('finished_journal.txt'
+in the level directory), so the parent process polls a single file instead of the FINISHED file of every sample.
+"""
+import os
+import json
+import yaml
+import numpy as np
+
+import checkpoint
+
+npz_file = "summary.npz"
+yaml_file = "summary.yaml"
+journal_file = "finished_journal.txt"
+
+
+def _plain(value):
+    # numpy scalars in metrics
+    return value.item()
+
+
+def write(results, metrics, sample_dir=".", export_yaml=False):
+    """
+    :param results: {problem basename: {quantity: array like}}
+    :param metrics: Nested dict of the cost metrics, plain types or numpy scalars.
+    :param export_yaml: Write also the YAML summary.
+    """
+    arrays = {}
+    for problem, quantities in results.items():
+        for quantity, value in quantities.items():
+            arrays["{}/{}".format(problem, quantity)] = np.asarray(value, dtype=float)
+    arrays['metrics'] = np.array(json.dumps(metrics, default=_plain))
+    with checkpoint.atomic_open(os.path.join(sample_dir, npz_file), "wb") as f:
+        np.savez(f, **arrays)
+    if export_yaml:
+        yaml_results = {problem: {quantity: np.asarray(value).tolist() for quantity, value in quantities.items()}
+                        for problem, quantities in results.items()}
+        yaml_results['metrics'] = json.loads(arrays['metrics'].item())
+        with checkpoint.atomic_open(os.path.join(sample_dir, yaml_file), "w") as f:
+            yaml.dump(yaml_results, f)
+
+
+def read(sample_dir):
+    """
+    :return: {problem basename: {quantity: array}, 'metrics': dict}, the YAML summary is used if there is no NPZ file.
+    Values from the YAML summary are nested lists.
+    """
+    npz_path = os.path.join(sample_dir, npz_file)
+    if not os.path.exists(npz_path):
+        with open(os.path.join(sample_dir, yaml_file), "r") as f:
+            return yaml.safe_load(f)
+    summary = {}
+    with np.load(npz_path, allow_pickle=False) as data:
+        for name in data.files:
+            if name == 'metrics':
+                summary['metrics'] = json.loads(data[name].item())
+            else:
+                problem, quantity = name.split("/", 1)
+                summary.setdefault(problem, {})[quantity] = data[name]
+    return summary
+
+
+def append_journal(level_dir, sample_name, sample_time):
+    """
+    Append the completion record '<sample_name> done <sample_time>' to the journal of the level.
+    The record is a single short write with O_APPEND, records of concurrent samples are not interleaved.
+    """
+    line = "{} done {}\n".format(sample_name, sample_time).encode()
+    fd = os.open(os.path.join(level_dir, journal_file), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+class JournalReader:
+    def __init__(self, level_dir):
+        """
+        Reads the completion journal of the level incrementally.
+        """
+        self.path = os.path.join(level_dir, journal_file)
+        self.offset = 0
+
+    def poll(self):
+        """
+        :return: Names of the samples completed since the last call. A single stat if there are no new records.
+        """
+        try:
+            if os.stat(self.path).st_size <= self.offset:
+                return []
+        except FileNotFoundError:
+            return []
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+        # an incomplete last record is read by the next call
+        end = data.rfind(b"\n") + 1
+        self.offset += end
+        return [line.split()[0] for line in data[:end].decode().splitlines() if line.strip()]
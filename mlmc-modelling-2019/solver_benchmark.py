@@ -0,0 +1,107 @@
+"""
+Benchmark of the Flow123d linear solver settings, used to tune the `solver_policy` of the config.
+
+Usage:
+    python solver_benchmark.py <config.yaml> <sample_dir> [<sample_dir> ...]
+
+Every flow problem (fine, coarse, coarse_ref) with existing mesh and fields files in the given sample
+directories is solved with the default settings and with the settings of every rule of the `solver_policy`.
+Problem size, conductivity contrast, solver settings, wall time and convergence are appended
+to `solver_benchmark.csv` in the current directory. The current `flow_templ.yaml` is copied into the sample directories.
+"""
+import os
+import sys
+import csv
+import time
+import shutil
+import yaml
+import numpy as np
+
+src_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(src_path)
+
+import both_sample
+import gmsh_stream
+
+
+def read_physical_names(mesh_path):
+    names = []
+    with open(mesh_path, "rb") as f:
+        for line in f:
+            if line.strip() == b"$PhysicalNames":
+                n_names = int(f.readline())
+                for i in range(n_names):
+                    dim, tag, name = f.readline().decode().split(maxsplit=2)
+                    names.append(name.strip().strip('"'))
+                break
+    return names
+
+
+def read_n_elements(mesh_path):
+    with open(mesh_path, "rb") as f:
+        for line in f:
+            if line.strip() == b"$Elements":
+                return int(f.readline())
+    return 0
+
+
+def read_contrast(fields_path):
+    fields = gmsh_stream.read_element_data(fields_path, ['conductivity_tensor', 'cross_section'])
+    cond_frame = fields['conductivity_tensor'][0]
+    cs = both_sample.frame_values(fields['cross_section'][0], cond_frame.ele_ids)[:, 0]
+    scalar = cs * (cond_frame.values[:, 0] + cond_frame.values[:, 4]) / 2
+    return np.max(scalar) / np.min(scalar)
+
+
+def benchmark_problem(base, config_dict, solvers, writer, sample_dir):
+    mesh_path = both_sample.mesh_file(base)
+    fields_path = both_sample.fields_file(base)
+    if not (os.path.exists(mesh_path) and os.path.exists(fields_path)):
+        return
+    n_elements = read_n_elements(mesh_path)
+    contrast = read_contrast(fields_path)
+    outer_regions = [name for name in read_physical_names(mesh_path) if name.startswith('.')]
+    for rule_name, solver in solvers:
+        out_dir = "bench_{}_{}".format(base, rule_name)
+        shutil.rmtree(out_dir, ignore_errors=True)
+        thread = both_sample.FlowThread(base, outer_regions, config_dict, [], "water_balance.yaml",
+                                        out_dir=out_dir, solver=solver)
+        start = time.time()
+        status = thread.run()
+        elapsed = time.time() - start
+        # a failed run may have no log, it is recorded as not converged
+        converged = status and thread.check_conv_reasons(os.path.join(out_dir, "flow123.0.log"))
+        print("{} {} elements: {} contrast: {:.3g} rule: {} time: {:.2f}".format(
+            sample_dir, base, n_elements, contrast, rule_name, elapsed))
+        writer.writerow([sample_dir, base, n_elements, contrast, rule_name,
+                         solver['r_tol'], solver['a_tol'], solver['options'], elapsed, status, converged])
+
+
+def main(config_path, sample_dirs):
+    with open(config_path, "r") as f:
+        config_dict = yaml.safe_load(f)
+    solvers = [("default", dict(both_sample.default_solver))]
+    for i_rule, rule in enumerate(config_dict.get('solver_policy') or []):
+        solvers.append((str(i_rule), {key: rule.get(key, value) for key, value in both_sample.default_solver.items()}))
+
+    out_path = os.path.abspath("solver_benchmark.csv")
+    new_file = not os.path.exists(out_path)
+    with open(out_path, "a", newline='') as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(["sample_dir", "problem", "n_elements", "contrast", "rule",
+                             "r_tol", "a_tol", "options", "time", "status", "converged"])
+        for sample_dir in sample_dirs:
+            orig_cwd = os.getcwd()
+            os.chdir(sample_dir)
+            try:
+                shutil.copy(os.path.join(src_path, "flow_templ.yaml"), "flow_templ.yaml")
+                for base in ["fine", "coarse", "coarse_ref"]:
+                    benchmark_problem(base, config_dict, solvers, writer, sample_dir)
+                    f.flush()
+            finally:
+                os.chdir(orig_cwd)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,103 @@
+"""
+Minimal executor of a task dependency graph.
+Used to overlap independent stages (meshing, fields, flow runs) of a single sample.
+"""
+import time
+import resource
+import traceback
+import concurrent.futures as cf
+
+
+def peak_rss_mb(children=False):
+    """
+    Peak resident set size [MB] of the process or of its largest terminated child process.
+    """
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class TaskGraph:
+    """
+    Tasks are named callables without arguments. A task is submitted to a thread pool
+    as soon as all the tasks it depends on are finished. Tasks must be added after
+    their dependencies, so the graph is acyclic by construction.
+    """
+    def __init__(self, wrap=None):
+        """
+        :param wrap: Optional decorator applied to the task callables in the worker threads,
+            e.g. `profiling.Profiler.wrap`.
+        """
+        self.wrap = wrap
+        self.tasks = {}
+        # name -> (callable, list of dependency names)
+        self.results = {}
+        # name -> return value of the finished task
+        self.stats = {}
+        # name -> dict(start, wall, cpu, process_peak_rss_mb); start relative to the start of `run`,
+        # cpu is the time of the worker thread, external processes are not included,
+        # process_peak_rss_mb is the high-water mark of the whole process at the end of the task,
+        # shared by the concurrent tasks, not the memory of the task itself
+
+    def add(self, name, fn, deps=()):
+        """
+        :param name: Unique task name.
+        :param fn: Callable without arguments.
+        :param deps: Names of already added tasks that must finish before this one starts.
+        """
+        assert name not in self.tasks, "Duplicate task: {}".format(name)
+        for dep in deps:
+            assert dep in self.tasks, "Task '{}' depends on unknown task '{}'.".format(name, dep)
+        self.tasks[name] = (fn, list(deps))
+
+    def measure(self, name, fn, t_start=None):
+        """
+        Call `fn` and record its statistics in `stats` under the `name`. Used for all the graph tasks,
+        can be used for stages executed out of the graph as well.
+        :param t_start: Reference time of the `start` statistic, the call time by default.
+        """
+        start = time.time()
+        if t_start is None:
+            t_start = start
+        cpu_start = time.thread_time()
+        if self.wrap is not None:
+            fn = self.wrap(fn)
+        try:
+            return fn()
+        finally:
+            self.stats[name] = dict(start=start - t_start, wall=time.time() - start,
+                                    cpu=time.thread_time() - cpu_start, process_peak_rss_mb=peak_rss_mb())
+
+    def run(self, n_workers=1):
+        """
+        Execute all tasks. After a failure no new tasks are started, the running ones are waited for
+        and the first exception is raised again.
+        :param n_workers: Number of worker threads.
+        :return: {name: result}
+        """
+        t_start = time.time()
+        pending = dict(self.tasks)
+        running = {}
+        error = None
+        with cf.ThreadPoolExecutor(max_workers=n_workers) as pool:
+            while pending or running:
+                if error is None:
+                    ready = [name for name, (fn, deps) in pending.items()
+                             if all(dep in self.results for dep in deps)]
+                    for name in ready:
+                        fn, deps = pending.pop(name)
+                        running[pool.submit(self.measure, name, fn, t_start)] = name
+                if not running:
+                    break
+                finished, _ = cf.wait(running, return_when=cf.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                    except Exception as e:
+                        print("Task '{}' failed.".format(name))
+                        traceback.print_exc()
+                        if error is None:
+                            error = e
+        if error is not None:
+            raise error
+        return self.results
@@ -0,0 +1,92 @@
+"""
+Append-only binary store of the microscale conductivity tensors of a level.
+
+The store is a valid '.npy' file of float64 rows (flattened 2x2 tensors) with a fixed size header,
+so the number of rows in the header can be rewritten in place. The rows are written behind the last
+stored row first, then the header with the new count is written by a single write. A reader
+takes just the rows counted by the header, so it never sees a partially written row;
+rows written after a crash but not counted are overwritten by the next append.
+There is a single writer (the process collecting the sample results), readers map the file by `np.memmap`.
+"""
+import os
+import io
+import numpy as np
+
+header_len = 128
+# length of the whole header: magic, header size and the padded dict, multiple of 64 as required by the NPY format
+row_dtype = np.dtype('<f8')
+
+
+def _header(n_rows, row_size):
+    magic = np.lib.format.magic(1, 0)
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': ({}, {}), }}".format(
+        row_dtype.str, n_rows, row_size).encode('latin1')
+    header = header + b' ' * (header_len - len(magic) - 2 - len(header) - 1) + b'\n'
+    return magic + (len(header)).to_bytes(2, 'little') + header
+
+
+def _read_shape(header):
+    f = io.BytesIO(header)
+    np.lib.format.read_magic(f)
+    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    assert f.tell() == header_len and dtype == row_dtype, "Not a tensor store."
+    return shape
+
+
+def count(path):
+    """
+    :return: Number of rows in the store, 0 if there is no store.
+    """
+    try:
+        with open(path, "rb") as f:
+            return _read_shape(f.read(header_len))[0]
+    except FileNotFoundError:
+        return 0
+
+
+def pool_size(path, n_rows=None):
+    """
+    Size of a pool of tensors to sample from.
+    :param n_rows: Number of rows to use (a snapshot taken by `count`), all rows of the store if None.
+    :return: Number of rows, ValueError if there are none (no store, empty store or n_rows == 0).
+    """
+    if n_rows is None:
+        n_rows = count(path)
+    if n_rows <= 0:
+        raise ValueError("No tensors in the store {}, the finer level has no collected samples.".format(path))
+    return n_rows
+
+
+def append(path, rows):
+    """
+    :param rows: Array of rows, e.g. (n, 2, 2) tensors are stored as (n, 4) rows.
+    """
+    rows = np.asarray(rows, dtype=row_dtype)
+    rows = rows.reshape(len(rows), -1)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o664)
+    try:
+        if os.fstat(fd).st_size < header_len:
+            n_rows, row_size = 0, rows.shape[1]
+        else:
+            n_rows, row_size = _read_shape(os.pread(fd, header_len, 0))
+        assert rows.shape[1] == row_size, "Row size {} differs from the store {}.".format(rows.shape[1], row_size)
+        os.pwrite(fd, rows.tobytes(), header_len + n_rows * row_size * row_dtype.itemsize)
+        os.fsync(fd)
+        os.pwrite(fd, _header(n_rows + len(rows), row_size), 0)
+    finally:
+        os.close(fd)
+
+
+def load(path, n_rows=None):
+    """
+    :param n_rows: Number of rows to use (a snapshot taken by `count`), all rows of the store if None.
+    :return: Read-only memory mapped array (n_rows, row_size).
+    """
+    with open(path, "rb") as f:
+        stored_rows, row_size = _read_shape(f.read(header_len))
+    if n_rows is None:
+        n_rows = stored_rows
+    assert n_rows <= stored_rows, "Store {} has just {} rows.".format(path, stored_rows)
+    if n_rows == 0:
+        return np.empty((0, row_size), dtype=row_dtype)
+    return np.memmap(path, dtype=row_dtype, mode='r', offset=header_len, shape=(n_rows, row_size))
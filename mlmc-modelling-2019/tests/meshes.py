@@ -0,0 +1,25 @@
+"""
+Small meshes for the tests.
+"""
+import types
+import numpy as np
+
+
+def grid_mesh(n, size=1.0, reg_id=1):
+    """
+    GmshIO like mesh of the square [0, size]^2, n x n squares each split into two triangles.
+    """
+    mesh = types.SimpleNamespace(nodes={}, elements={}, physical={})
+    xs = np.linspace(0, size, n + 1)
+    node_id = lambda i, j: 1 + i * (n + 1) + j
+    for i, x in enumerate(xs):
+        for j, y in enumerate(xs):
+            mesh.nodes[node_id(i, j)] = [x, y, 0.0]
+    eid = 1
+    for i in range(n):
+        for j in range(n):
+            a, b, c, d = node_id(i, j), node_id(i + 1, j), node_id(i + 1, j + 1), node_id(i, j + 1)
+            for tri in [(a, b, c), (a, c, d)]:
+                mesh.elements[eid] = (2, [reg_id + 10000, reg_id + 10000], list(tri))
+                eid += 1
+    return mesh
@@ -0,0 +1,56 @@
+import os
+import pytest
+
+import checkpoint
+
+
+class Counter:
+    def __init__(self, path=None, value=1):
+        self.n_calls = 0
+        self.path = path
+        self.value = value
+
+    def __call__(self):
+        self.n_calls += 1
+        if self.path is not None:
+            with checkpoint.atomic_open(self.path) as f:
+                f.write("output")
+        return self.value
+
+
+def test_resume(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    mesh, fields = Counter("mesh.msh", 2), Counter("fields.msh", 3)
+
+    def run_stages(sample_key="sample"):
+        stages = checkpoint.StageMarkers(sample_key)
+        a = stages.run('mesh', mesh, outputs=["mesh.msh"], save=int, restore=int)
+        b = stages.run('fields', fields, deps=['mesh'], outputs=["fields.msh"], save=int, restore=int)
+        return a, b
+
+    assert run_stages() == (2, 3)
+    # resumed sample, nothing is executed again
+    assert run_stages() == (2, 3)
+    assert (mesh.n_calls, fields.n_calls) == (1, 1)
+    # missing output, the stage and the stages depending on it are executed again
+    os.remove("mesh.msh")
+    assert run_stages() == (2, 3)
+    assert (mesh.n_calls, fields.n_calls) == (2, 2)
+    # different inputs of the sample
+    run_stages("other sample")
+    assert (mesh.n_calls, fields.n_calls) == (3, 3)
+
+
+def test_failed_stage(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    stages = checkpoint.StageMarkers("sample")
+
+    def fail():
+        with checkpoint.atomic_open("out.txt") as f:
+            f.write("partial")
+            raise RuntimeError("killed")
+
+    with pytest.raises(RuntimeError):
+        stages.run('stage', fail, outputs=["out.txt"])
+    assert os.listdir(".") == ["stages"]
+    assert stages.stamp('stage') is None
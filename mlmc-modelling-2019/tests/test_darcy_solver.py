@@ -0,0 +1,117 @@
+import types
+import numpy as np
+
+import both_sample
+import darcy_solver
+from meshes import grid_mesh
+
+
+def grid_arrays(n):
+    """
+    :return: (nodes, triangles, boundary_nodes) of the unit square grid mesh.
+    """
+    mesh = grid_mesh(n)
+    node_ids = sorted(mesh.nodes)
+    nodes = np.array([mesh.nodes[nid][0:2] for nid in node_ids])
+    triangles = np.array([mesh.elements[eid][2] for eid in sorted(mesh.elements)]) - 1
+    boundary = np.nonzero(np.any((nodes == 0) | (nodes == 1), axis=1))[0]
+    return nodes, triangles, boundary
+
+
+def mean_flux(solver, tri_velocity, line_velocity):
+    """
+    Integral of -u over the domain, the fractures weighted by the cross-section.
+    """
+    return -(np.einsum('t,lta->la', solver.tri_area, tri_velocity)
+             + np.einsum('e,lea->la', solver.line_cs * solver.line_length, line_velocity))
+
+
+def test_homogeneous_anisotropic():
+    n = 6
+    nodes, triangles, boundary = grid_arrays(n)
+    cond = np.array([[4.0, -1.0], [-1.0, 2.0]])
+    solver = darcy_solver.DarcySolver2d(nodes, triangles, np.tile(cond, (len(triangles), 1, 1)),
+                                        np.zeros((0, 2)), [], [], boundary)
+    loads = np.array([[1.0, 0.0], [0.0, 1.0], [0.6, -0.8]])
+    pressure, tri_velocity, line_velocity = solver.solve(loads)
+    assert np.allclose(pressure, loads @ nodes.T)
+    assert np.allclose(tri_velocity, -(loads @ cond.T)[:, None, :])
+    # effective tensor of the unit square
+    assert np.allclose(mean_flux(solver, tri_velocity, line_velocity), loads @ cond.T)
+
+
+def test_single_fracture():
+    n = 8
+    nodes, triangles, boundary = grid_arrays(n)
+    # fracture along x = 0.5, nodes are ordered by x then y
+    column = n // 2 * (n + 1) + np.arange(n + 1)
+    lines = np.stack([column[:-1], column[1:]], axis=1)
+    cond = 2.0 * np.eye(2)
+    fr_cond, fr_cs = 1e4, 1e-3
+    solver = darcy_solver.DarcySolver2d(nodes, triangles, np.tile(cond, (len(triangles), 1, 1)),
+                                        lines, np.full(n, fr_cond), np.full(n, fr_cs), boundary)
+    loads = np.array([[1.0, 0.0], [0.0, 1.0], [1.0, 1.0]])
+    pressure, tri_velocity, line_velocity = solver.solve(loads)
+    assert np.allclose(pressure, loads @ nodes.T)
+    assert np.allclose(line_velocity, -fr_cond * loads[:, None, 1:2] * np.array([0.0, 1.0]))
+    exact = cond + fr_cond * fr_cs * np.array([[0.0, 0.0], [0.0, 1.0]])
+    assert np.allclose(mean_flux(solver, tri_velocity, line_velocity), loads @ exact.T)
+
+
+def test_boundary_flux_moment():
+    """
+    The water balance mode of Flow123d computes the mean flux from the boundary fluxes:
+        int -u dx = sum_boundary x * flux
+    The same identity holds for the discrete solution of a heterogeneous problem.
+    """
+    n = 10
+    nodes, triangles, boundary = grid_arrays(n)
+    rng = np.random.default_rng(1)
+    a = rng.lognormal(size=(len(triangles), 2, 2))
+    tri_cond = np.einsum('tij,tkj->tik', a, a) + 0.1 * np.eye(2)
+    # fracture along the diagonal, ends inside the domain
+    lines = np.array([[i * (n + 1) + i, (i + 1) * (n + 1) + i + 1] for i in range(3, 8)])
+    solver = darcy_solver.DarcySolver2d(nodes, triangles, tri_cond, lines, np.full(len(lines), 1e3),
+                                        np.full(len(lines), 1e-2), boundary)
+    loads = np.array([[1.0, 0.0], [0.0, 1.0]])
+    pressure, tri_velocity, line_velocity = solver.solve(loads)
+    # boundary fluxes are the residuals of the Dirichlet nodes
+    matrix = solver._assemble(len(nodes))
+    boundary_flux = (matrix @ pressure.T).T[:, boundary]
+    assert np.allclose(np.sum(boundary_flux, axis=1), 0, atol=1e-9)
+    moment = boundary_flux @ nodes[boundary]
+    assert np.allclose(moment, mean_flux(solver, tri_velocity, line_velocity))
+
+
+def test_solve_darcy_effective_tensor():
+    """
+    FlowProblem solved in-process: homogeneous anisotropic bulk gives the exact effective tensor.
+    """
+    n = 6
+    mesh = grid_mesh(n)
+    ele_ids = sorted(mesh.elements)
+    # outer boundary as line elements of the physical group '.side'
+    mesh.physical['.side'] = (20000, 1)
+    eid = max(ele_ids) + 1
+    for nid, (x, y, z) in mesh.nodes.items():
+        if x == 0 or y == 0 or x == 1 or y == 1:
+            mesh.elements[eid] = (1, [20000, 20000], [nid, nid])
+            eid += 1
+    cond = np.array([[3.0, 1.0], [1.0, 2.0]])
+
+    problem = both_sample.FlowProblem.__new__(both_sample.FlowProblem)
+    problem.config_dict = dict(n_pressure_loads=4)
+    problem.basename = "fine"
+    problem.mesh = mesh
+    problem.regions = [types.SimpleNamespace(name=name) for name in ["none", "bulk"]]
+    problem.reg_to_group = {1: 0}
+    problem.side_regions = [types.SimpleNamespace(name='.side', sub_reg=types.SimpleNamespace(name='.side_sub'))]
+    problem._elem_ids = ele_ids
+    problem._cs_field = np.ones(len(ele_ids))
+    cond_3d = np.zeros((3, 3))
+    cond_3d[0:2, 0:2] = cond
+    problem._cond_tn_field = np.tile(cond_3d.ravel(), (len(ele_ids), 1))
+    problem.plot_effective_tensor = lambda *args: None
+
+    problem._inprocess_run = problem.solve_darcy()
+    assert np.allclose(problem.effective_tensor_from_bulk()[0], cond)
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+import gmsh_stream
+
+
+nodes = {1: [0.0, 0.0, 0.0], 2: [1.0, 0.0, 0.0], 3: [1.0, 1.0, 0.0], 4: [0.0, 1.0, 0.0]}
+# id: (type, tags, node ids)
+elements = {1: (1, [10001, 1], [1, 2]), 2: (2, [10002, 2], [1, 2, 3]), 3: (2, [10002, 2], [1, 3, 4])}
+
+
+def frames(n_steps):
+    """
+    Test fields: {name: [(time_idx, values (n_elements, n_comp)), ...]}
+    """
+    rng = np.random.default_rng(0)
+    return {'pressure_p0': [(i, rng.random((3, 1))) for i in range(n_steps)],
+            'velocity_p0': [(i, rng.random((3, 3))) for i in range(n_steps)]}
+
+
+def write_msh(path, fields, binary):
+    """
+    GMSH 2.2 file with the mesh and the element data frames as written by Flow123d.
+    """
+    with open(path, "wb") as f:
+        def line(text):
+            f.write((text + "\n").encode())
+        line("$MeshFormat")
+        line("2.2 {} 8".format(1 if binary else 0))
+        if binary:
+            f.write(np.array([1], dtype='<i4').tobytes() + b"\n")
+        line("$EndMeshFormat")
+        line("$Nodes")
+        line(str(len(nodes)))
+        for nid, xyz in nodes.items():
+            if binary:
+                f.write(np.array([nid], dtype='<i4').tobytes() + np.array(xyz, dtype='<f8').tobytes())
+            else:
+                line("{} {} {} {}".format(nid, *xyz))
+        if binary:
+            f.write(b"\n")
+        line("$EndNodes")
+        line("$Elements")
+        line(str(len(elements)))
+        for eid, (el_type, tags, node_ids) in elements.items():
+            if binary:
+                f.write(np.array([el_type, 1, len(tags), eid] + tags + node_ids, dtype='<i4').tobytes())
+            else:
+                line(" ".join(str(v) for v in [eid, el_type, len(tags)] + tags + node_ids))
+        if binary:
+            f.write(b"\n")
+        line("$EndElements")
+        for name, field_frames in fields.items():
+            for time_idx, values in field_frames:
+                line("$ElementData")
+                line("1")
+                line('"{}"'.format(name))
+                line("1")
+                line(str(float(time_idx)))
+                line("3")
+                line(str(time_idx))
+                line(str(values.shape[1]))
+                line(str(len(values)))
+                for eid, row in zip(elements, values):
+                    if binary:
+                        f.write(np.array([eid], dtype='<i4').tobytes() + np.array(row, dtype='<f8').tobytes())
+                    else:
+                        line(" ".join([str(eid)] + ["{:.17g}".format(v) for v in row]))
+                if binary:
+                    f.write(b"\n")
+                line("$EndElementData")
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_round_trip(tmp_path, binary):
+    fields = frames(3)
+    path = str(tmp_path / "flow_fields.msh")
+    write_msh(path, fields, binary)
+    read = gmsh_stream.read_element_data(path, ['pressure_p0', 'velocity_p0'])
+    for name, field_frames in fields.items():
+        assert [frame.time_idx for frame in read[name]] == [time_idx for time_idx, values in field_frames]
+        for frame, (time_idx, values) in zip(read[name], field_frames):
+            assert np.array_equal(frame.ele_ids, list(elements))
+            assert frame.time == float(time_idx)
+            assert np.array_equal(frame.values, values)
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_selected_frames(tmp_path, binary):
+    fields = frames(4)
+    path = str(tmp_path / "flow_fields.msh")
+    write_msh(path, fields, binary)
+    read = gmsh_stream.read_element_data(path, ['velocity_p0'], time_indices={'velocity_p0': [1, 3]})
+    assert list(read) == ['velocity_p0']
+    assert [frame.time_idx for frame in read['velocity_p0']] == [1, 3]
+    assert np.array_equal(read['velocity_p0'][1].values, fields['velocity_p0'][3][1])
@@ -0,0 +1,61 @@
+import os
+import time
+import pytest
+
+import pbs
+
+
+def test_parse_mem():
+    assert pbs.parse_mem("8gb") == 8 * 2**30
+    assert pbs.parse_mem("500mb") == 500 * 2**20
+    assert pbs.parse_mem(" 1.5 GB ") == 1.5 * 2**30
+    assert pbs.parse_mem("100") == 100
+    with pytest.raises(ValueError):
+        pbs.parse_mem("8 gigabytes")
+
+
+def test_local_capacity():
+    n_cpus = os.cpu_count() or 1
+    assert pbs.Pbs.local_capacity(1) == n_cpus
+    assert pbs.Pbs.local_capacity(n_cpus + 1) == 1
+    # memory limits the number of jobs
+    total_mem = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    assert pbs.Pbs.local_capacity(1, "{}b".format(total_mem)) == 1
+
+
+def run_jobs(tmp_path, jobs):
+    """
+    Execute local jobs, one sample per job with the given script lines, wait for all of them.
+    """
+    pbs_obj = pbs.Pbs(str(tmp_path), qsub=None, local_jobs=2)
+    pbs_obj.pbs_common_setting(n_nodes=1, n_cores=1, mem="1gb", walltime="1:00:00", queue="q")
+    pbs_obj.job_weight = 0
+    for sample_dir, lines in jobs:
+        pbs_obj.add_realization(1, lines, sample_dir=sample_dir)
+    start = time.time()
+    while pbs_obj.poll():
+        assert time.time() - start < 10
+        time.sleep(0.05)
+    return pbs_obj
+
+
+def test_local_jobs(tmp_path):
+    pbs_obj = run_jobs(tmp_path, [("S0", ["true"]), ("S1", ["exit 3"]), ("S2", ["true"])])
+    states = [pbs_obj.local_state[job] for job in sorted(pbs_obj.local_state)]
+    assert states == ['done', 'failed', 'done']
+    assert sorted(pbs_obj.ended_samples()) == ["S0", "S1", "S2"]
+    assert pbs_obj.ended_samples() == []
+    assert os.path.exists(str(tmp_path / "0000" / "FINISHED"))
+
+
+def test_sample_without_finished(tmp_path):
+    """
+    A sample killed without writing its FINISHED file, the job script still exits 0.
+    """
+    sample_dir = tmp_path / "S0"
+    sample_dir.mkdir()
+    lines = ["cd {}".format(sample_dir), "sh -c 'kill -9 $$' 2>&1 | tee both_sample_out"]
+    pbs_obj = run_jobs(tmp_path / "jobs", [(str(sample_dir), lines)])
+    assert list(pbs_obj.local_state.values()) == ['done']
+    assert not (sample_dir / "FINISHED").exists()
+    assert pbs_obj.ended_samples() == [str(sample_dir)]
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+import pipe_network
+
+
+def test_homogeneous():
+    bulk = np.array([[3.0, 0.5], [0.5, 2.0]])
+    network = pipe_network.PipeNetwork(np.zeros((0, 2, 2)), [], [], [10, 20], 2.5, bulk)
+    # off-diagonal terms are neglected
+    assert np.allclose(network.effective_tensor(), np.diag([3.0, 2.0]))
+
+
+def test_single_fracture():
+    bulk = np.eye(2)
+    domain = [10.0, 10.0]
+    aperture, fr_cond = 1e-3, 1e5
+    # vertical fracture through the whole domain on a grid line, the coupling to the grid carries no flux
+    traces = np.array([[[0.0, -7.0], [0.0, 7.0]]])
+    network = pipe_network.PipeNetwork(traces, [aperture], [fr_cond], domain, 1.0, bulk)
+    length = domain[1]
+    exact = bulk + aperture * fr_cond * length / np.prod(domain) * np.array([[0.0, 0.0], [0.0, 1.0]])
+    assert np.allclose(network.effective_tensor(), exact)
+
+
+def test_clip_segment():
+    box_min, box_max = np.array([-1.0, -1.0]), np.array([1.0, 1.0])
+    q0, q1 = pipe_network.clip_segment(np.array([-2.0, 0.0]), np.array([2.0, 0.0]), box_min, box_max)
+    assert np.allclose([q0, q1], [[-1, 0], [1, 0]])
+    assert pipe_network.clip_segment(np.array([2.0, 2.0]), np.array([3.0, 2.0]), box_min, box_max) is None
+
+
+def test_make_without_tensor_store():
+    config_dict = dict(levels=[dict(step=10, bulk_conductivity=dict(choose_from_finer_level=True))])
+    with pytest.raises(ValueError, match="mean_log_conductivity"):
+        pipe_network.PipeNetworkProblem.make("coarse", 0, (10, np.inf), None, None, config_dict)
@@ -0,0 +1,32 @@
+import os
+import pstats
+
+import profiling
+import task_graph
+
+
+def busy(n=20000):
+    return sum(i * i for i in range(n))
+
+
+def test_nested_stages(tmp_path):
+    """
+    Stages measured in the profiled thread and in the graph workers are all in the merged profile.
+    """
+    profiler = profiling.Profiler(str(tmp_path / "profile"), memory=False)
+
+    def calculate():
+        graph = task_graph.TaskGraph(wrap=profiler.wrap)
+        graph.measure('main_stage', busy)
+        graph.add('a', busy)
+        graph.add('b', busy, deps=['a'])
+        graph.run(n_workers=2)
+        return busy()
+
+    assert profiler.run(calculate) == busy()
+    # the main thread and the two tasks, the nested stage is a part of the main thread profile
+    assert len(profiler._profiles) == 3
+    stats = pstats.Stats(str(tmp_path / "profile.prof"))
+    assert any(func[2] == 'calculate' for func in stats.stats)
+    assert stats.stats[[func for func in stats.stats if func[2] == 'busy'][0]][1] == 4
+    assert os.path.exists(str(tmp_path / "profile.txt"))
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+import remap
+
+
+def square_triangles(n):
+    """
+    Triangles of the unit square, n x n cells each split into two triangles, shape (2 n^2, 3, 2).
+    """
+    xs = np.linspace(0, 1, n + 1)
+    triangles = []
+    for i in range(n):
+        for j in range(n):
+            a, b, c, d = [xs[i], xs[j]], [xs[i + 1], xs[j]], [xs[i + 1], xs[j + 1]], [xs[i], xs[j + 1]]
+            triangles.extend([[a, b, c], [a, c, d]])
+    return np.array(triangles)
+
+
+def fine_elements(n, rng):
+    fine = square_triangles(n)
+    points = np.mean(fine, axis=1)
+    volumes = np.full(len(fine), 0.5 / n ** 2)
+    a = rng.random((len(fine), 2, 2))
+    tensors = np.einsum('nij,nkj->nik', a, a) + 0.1 * np.eye(2)
+    return points, volumes, tensors
+
+
+def test_conservation():
+    rng = np.random.default_rng(0)
+    points, volumes, tensors = fine_elements(12, rng)
+    targets = square_triangles(3)
+    locator = remap.TriangleLocator(targets)
+    target_idx = locator.locate(points)
+    assert np.all(target_idx >= 0)
+    means, weights = remap.average_tensors(target_idx, len(targets), volumes, tensors)
+    # every target has the fine elements of its area
+    assert np.allclose(weights, 0.5 / 9)
+    # integral of the tensor field is preserved
+    assert np.allclose(np.einsum('t,tij->ij', weights, means), np.einsum('n,nij->ij', volumes, tensors))
+
+
+@pytest.mark.parametrize("average", ['arithmetic', 'harmonic', 'geometric'])
+def test_homogeneous(average):
+    rng = np.random.default_rng(1)
+    points, volumes, _ = fine_elements(8, rng)
+    tensor = np.array([[2.0, 0.3], [0.3, 1.0]])
+    result = remap.remap_tensors(points, volumes, np.tile(tensor, (len(points), 1, 1)), square_triangles(2), average)
+    assert np.allclose(result, tensor)
+
+
+def test_harmonic_average():
+    # two fine elements in the single target, volumes 1 and 3
+    target = np.array([[[0.0, 0.0], [4.0, 0.0], [0.0, 4.0]]])
+    points = np.array([[1.0, 1.0], [0.5, 2.0]])
+    tensors = np.array([np.eye(2), 4 * np.eye(2)])
+    means, weights = remap.average_tensors(remap.TriangleLocator(target).locate(points), 1,
+                                           np.array([1.0, 3.0]), tensors, 'harmonic')
+    assert np.allclose(means[0], 1 / (0.25 * 1 + 0.75 / 4) * np.eye(2))
+
+
+def test_locate_fallback():
+    # a large triangle far from the barycenters of many small ones
+    small = np.array([[[10.0 + i, 10.0], [10.1 + i, 10.0], [10.0 + i, 10.1]] for i in range(20)])
+    large = np.array([[[-100.0, -100.0], [100.0, -100.0], [0.0, 100.0]]])
+    locator = remap.TriangleLocator(np.concatenate([small, large]), n_candidates=4)
+    assert list(locator.locate(np.array([[0.0, 0.0], [10.02, 10.02], [500.0, 500.0]]))) == [20, 0, -1]
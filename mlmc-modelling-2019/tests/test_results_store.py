@@ -0,0 +1,22 @@
+import numpy as np
+
+import results_store
+
+
+def test_add_load(tmp_path):
+    store = results_store.ResultsStore(str(tmp_path / results_store.db_file))
+    result = dict(fine=np.eye(2), coarse=2 * np.eye(2), walltime=3.5, metrics=dict(n_elements=np.int64(10)),
+                  micro_pos=np.zeros((2, 2)), micro_cond_tn=np.ones((2, 2, 2)), micro_begin=4)
+    plain = dict(result, micro_pos=None, micro_cond_tn=None)
+    del plain['micro_begin']
+    store.add(1, [(0, "S0", result), (1, "S1", plain)])
+    store.close()
+
+    samples = results_store.ResultsStore(str(tmp_path / results_store.db_file)).load(1)
+    sample_dir, loaded = samples[0]
+    assert sample_dir == "S0"
+    assert loaded['micro_begin'] == 4 and loaded['walltime'] == 3.5
+    assert loaded['metrics'] == dict(n_elements=10)
+    for col in ['fine', 'coarse', 'micro_pos', 'micro_cond_tn']:
+        assert np.array_equal(loaded[col], result[col])
+    assert samples[1][1]['micro_begin'] is None and samples[1][1]['micro_cond_tn'] is None
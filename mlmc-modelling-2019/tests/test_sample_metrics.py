@@ -0,0 +1,15 @@
+import os
+
+import both_sample
+
+
+def test_sample_metrics():
+    start = os.times()
+    runs = [dict(wall=1.0, cpu=1.0, peak_rss_mb=120.0), dict(wall=1.0, peak_rss_mb=300.0), dict(reused=True)]
+    metrics = both_sample.BothSample.sample_metrics(start, {}, runs)
+    assert metrics['children_peak_rss_mb'] == 300.0
+    assert 'peak_rss_mb' in metrics and 'worker_peak_rss_mb' not in metrics
+    # persistent worker: the process peak covers the previous samples
+    metrics = both_sample.BothSample.sample_metrics(start, {}, [], worker=True)
+    assert metrics['children_peak_rss_mb'] == 0.0
+    assert 'worker_peak_rss_mb' in metrics and 'peak_rss_mb' not in metrics
@@ -0,0 +1,22 @@
+import os
+
+import sample_summary
+
+
+def test_journal(tmp_path):
+    level_dir = str(tmp_path)
+    reader = sample_summary.JournalReader(level_dir)
+    assert reader.poll() == []
+    sample_summary.append_journal(level_dir, "L00_F_S0000000", 1.5)
+    sample_summary.append_journal(level_dir, "L00_F_S0000001", 2.5)
+    assert reader.poll() == ["L00_F_S0000000", "L00_F_S0000001"]
+    assert reader.poll() == []
+    # incomplete record of a sample being written
+    with open(os.path.join(level_dir, sample_summary.journal_file), "ab") as f:
+        f.write(b"L00_F_S00")
+    assert reader.poll() == []
+    with open(os.path.join(level_dir, sample_summary.journal_file), "ab") as f:
+        f.write(b"00002 done 3.0\n")
+    assert reader.poll() == ["L00_F_S0000002"]
+    # a new reader reads the whole journal
+    assert len(sample_summary.JournalReader(level_dir).poll()) == 3
@@ -0,0 +1,44 @@
+import os
+import numpy as np
+import pytest
+
+import tensor_store
+
+
+def test_append_count_load(tmp_path):
+    path = str(tmp_path / "tensors.npy")
+    assert tensor_store.count(path) == 0
+    first = np.arange(12, dtype=float).reshape(3, 2, 2)
+    tensor_store.append(path, first)
+    assert tensor_store.count(path) == 3
+    second = -np.arange(8, dtype=float).reshape(2, 2, 2)
+    tensor_store.append(path, second)
+    assert tensor_store.count(path) == 5
+    rows = tensor_store.load(path)
+    assert np.array_equal(rows, np.concatenate([first, second]).reshape(-1, 4))
+    # snapshot of the first append
+    assert np.array_equal(tensor_store.load(path, 3), first.reshape(-1, 4))
+    # still a valid npy file
+    assert np.array_equal(np.load(path), rows)
+
+
+def test_uncounted_rows_overwritten(tmp_path):
+    path = str(tmp_path / "tensors.npy")
+    tensor_store.append(path, np.ones((2, 4)))
+    # rows written without the header update, as after a crash
+    with open(path, "ab") as f:
+        f.write(np.full((3, 4), 7.0).tobytes())
+    assert tensor_store.count(path) == 2
+    tensor_store.append(path, np.zeros((1, 4)))
+    assert np.array_equal(tensor_store.load(path), np.concatenate([np.ones((2, 4)), np.zeros((1, 4))]))
+
+
+def test_pool_size(tmp_path):
+    path = str(tmp_path / "tensors.npy")
+    with pytest.raises(ValueError):
+        tensor_store.pool_size(path)
+    tensor_store.append(path, np.ones((2, 4)))
+    assert tensor_store.pool_size(path) == 2
+    assert tensor_store.pool_size(path, 1) == 1
+    with pytest.raises(ValueError):
+        tensor_store.pool_size(path, 0)
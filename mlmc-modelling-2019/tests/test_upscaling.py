@@ -0,0 +1,92 @@
+import types
+import numpy as np
+
+import both_sample
+from meshes import grid_mesh
+
+
+class HomogeneousFineProblem:
+    """
+    Exact solution of a homogeneous anisotropic medium: p = g . x, u = -K g.
+    """
+    def __init__(self, mesh, cond, loads):
+        self.mesh = mesh
+        self.cond = cond
+        self.loads = np.array(loads, dtype=float)
+        self.fractures = types.SimpleNamespace(fractures=[])
+        self.reg_to_fr = {}
+
+    def velocity_runs(self, pressure=False):
+        ele_ids = np.array(sorted(self.mesh.elements.keys()))
+        _, centers, _ = both_sample.element_geometry(self.mesh, ele_ids)
+        velocities = -np.einsum('ij,lj->li', self.cond, self.loads)[:, None, :].repeat(len(ele_ids), axis=1)
+        pressures = self.loads @ centers[:, 0:2].T
+        yield types.SimpleNamespace(ele_ids=ele_ids, cross_sections=np.ones(len(ele_ids)), loads=self.loads,
+                                    velocities=velocities, pressures=pressures)
+
+
+def test_element_geometry_areas():
+    mesh = grid_mesh(4, size=2.0)
+    _, centers, volumes = both_sample.element_geometry(mesh, sorted(mesh.elements.keys()))
+    assert np.allclose(volumes, 0.5 * 0.5 * 0.5)
+    assert np.isclose(np.sum(volumes), 4.0)
+
+
+def test_fine_solution_homogeneous():
+    cond = np.array([[3.0, 1.0], [1.0, 2.0]])
+    loads = [[1, 0], [0, 1], [1, 1], [1, -1]]
+    fine = HomogeneousFineProblem(grid_mesh(24), cond, loads)
+    coarse = types.SimpleNamespace(mesh=grid_mesh(3))
+    upscaling = both_sample.FineSolutionUpscaling(fine, fr_max_size=1.0, coarse_problem=coarse)
+    tensors = upscaling.effective_tensor()
+    assert len(tensors) == len(coarse.mesh.elements)
+    for tn in tensors.values():
+        assert np.allclose(tn, cond)
+
+
+def fractured_problem(n, cond, fr_cond, fr_cs, n_loads=4):
+    """
+    FlowProblem of the unit square with a vertical fracture at x = 0.5, both regions in a single group,
+    with the exact solution for the linear pressure p = g . x.
+    """
+    mesh = grid_mesh(n, reg_id=1)
+    eid = max(mesh.elements) + 1
+    i = n // 2
+    for j in range(n):
+        mesh.elements[eid] = (1, [10002, 10002], [1 + i * (n + 1) + j, 1 + i * (n + 1) + j + 1])
+        eid += 1
+    ele_ids = np.array(sorted(mesh.elements.keys()))
+    is_fracture = np.array([len(mesh.elements[e][2]) == 2 for e in ele_ids])
+    problem = both_sample.FlowProblem.__new__(both_sample.FlowProblem)
+    problem.config_dict = dict(n_pressure_loads=n_loads)
+    loads = problem.pressure_loads
+    tangent = np.array([0.0, 1.0])
+    velocities = np.empty((len(loads), len(ele_ids), 2))
+    velocities[:, ~is_fracture] = -(loads @ cond.T)[:, None, :]
+    velocities[:, is_fracture] = -(fr_cond * (loads @ tangent))[:, None, None] * tangent
+    cs = np.where(is_fracture, fr_cs, 1.0)
+
+    problem.basename = "fine"
+    problem.mesh = mesh
+    problem.regions = [types.SimpleNamespace(name=name) for name in ["none", "bulk", "fracture"]]
+    problem.reg_to_group = {1: 0, 2: 0}
+    problem._inprocess_run = both_sample.RunSolution(loads, ele_ids, cs, velocities, None)
+    problem.plot_effective_tensor = lambda *args: None
+    return problem
+
+
+def test_effective_tensor_from_bulk_fracture():
+    cond = np.array([[2.0, 0.5], [0.5, 1.0]])
+    fr_cond, fr_cs = 1e3, 1e-2
+    problem = fractured_problem(8, cond, fr_cond, fr_cs)
+    tensors = problem.effective_tensor_from_bulk()
+    # fracture of length 1 in the unit square
+    exact = cond + fr_cond * fr_cs * np.array([[0, 0], [0, 1]])
+    assert np.allclose(tensors[0], exact)
+
+
+def test_tensor_mode_by_role():
+    config_dict = dict(effective_tensor=dict(coarse_ref='balance'))
+    batch = both_sample.FlowProblem(0, "coarse_ref_b0001", (1, 10), None, None, config_dict, role="coarse_ref")
+    assert batch.tensor_mode == 'balance'
+    assert both_sample.FlowProblem(0, "fine", (1, 10), None, None, config_dict).tensor_mode == 'bulk'
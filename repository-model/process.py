@@ -15,6 +15,8 @@ from bgem.gmsh import heal_mesh
 
 import fracture
 import mesh
+import mesh_cache
+import profiling
 
 @attr.s(auto_attribs=True)
 class ValueDescription:
@@ -162,16 +164,30 @@ def create_fractures_polygons(gmsh_geom, fractures):
 def prepare_mesh(config_dict, fractures):
     mesh_name = config_dict["mesh_name"]
     mesh_file = mesh_name + ".msh"
-    if not os.path.isfile(mesh_file):
-        mesh.make_mesh(config_dict, fractures, mesh_name, mesh_file)
-
     mesh_healed = mesh_name + "_healed.msh"
+    heal_stats = mesh_name + "_heal_stats.yaml"
+    node_tol, gamma_tol = 1e-4, 0.01
+
+    # The healed mesh and its stats are taken from the shared mesh cache if possible.
+    cache = mesh_cache.MeshCache.from_config(config_dict)
+    mesh_key = None
+    if cache is not None and not os.path.isfile(mesh_healed):
+        mesh_key = mesh_cache.make_key([attr.asdict(fr) for fr in fractures], config_dict["geometry"],
+                                       mesh_cache.file_digest(mesh.__file__), node_tol, gamma_tol)
+        if cache.fetch(mesh_key, mesh_healed) and not cache.fetch(mesh_key, heal_stats, suffix="_heal_stats.yaml"):
+            os.remove(mesh_healed)
+
     if not os.path.isfile(mesh_healed):
-        hm = heal_mesh.HealMesh.read_mesh(mesh_file, node_tol=1e-4)
-        hm.heal_mesh(gamma_tol=0.01)
-        hm.stats_to_yaml(mesh_name + "_heal_stats.yaml")
+        if not os.path.isfile(mesh_file):
+            mesh.make_mesh(config_dict, fractures, mesh_name, mesh_file)
+        hm = heal_mesh.HealMesh.read_mesh(mesh_file, node_tol=node_tol)
+        hm.heal_mesh(gamma_tol=gamma_tol)
+        hm.stats_to_yaml(heal_stats)
         hm.write()
         assert hm.healed_mesh_name == mesh_healed
+        if mesh_key is not None:
+            cache.store(mesh_key, mesh_healed)
+            cache.store(mesh_key, heal_stats, suffix="_heal_stats.yaml")
     return mesh_healed
 
 
@@ -458,4 +474,8 @@ if __name__ == "__main__":
 
     os.chdir(sample_dir)
     np.random.seed()
-    sample(config_dict)
+    if profiling.enabled(config_dict):
+        # profile.prof, profile.txt and profile_memory.txt in the sample dir
+        profiling.Profiler("profile").run(sample, config_dict)
+    else:
+        sample(config_dict)